@@ -14,8 +14,11 @@ def __max_probs_values_indices(masked_indices, log_probs, topk=1000):
     # score only first mask
     masked_indices = masked_indices[:1]
 
-    masked_index = masked_indices[0]
-    log_probs = log_probs[masked_index]
+    # log_probs are either given for the whole sequence or, if the LM head
+    # was applied only at the first mask (masked_only), for that row only
+    if log_probs.dim() > 1:
+        masked_index = masked_indices[0]
+        log_probs = log_probs[masked_index]
 
     value_max_probs, index_max_probs = torch.topk(input=log_probs,k=topk,dim=0)
     index_max_probs = index_max_probs.numpy().astype(int)
@@ -112,12 +115,170 @@ def get_ranking(log_probs, masked_indices, vocab, label_index = None, index_list
     return MRR, P_AT_X, experiment_result, return_msg
 
 
+def get_ranking_batch(log_probs, masked_indices_list, label_indices, topk=0, P_AT=10):
+    """Compute the ranking metrics of a whole batch at once
+
+    The rank of a label is one plus the number of tokens with a strictly
+    greater log probability, so no top-k over the vocabulary is needed.
+    Note that, unlike get_ranking, labels outside the top 10000 still get a
+    reciprocal rank.
+
+    Args:
+        log_probs: tensor [batch_size, vocab_size], or [batch_size, seq_len,
+            vocab_size] in which case only the first mask is scored
+        masked_indices_list: masked indices of every sample
+        label_indices: label index of every sample, in the (possibly
+            filtered) vocabulary of log_probs
+        topk: number of top predictions to return, 0 for none
+        P_AT: cutoff for the precision at P_AT
+
+    Returns:
+        A dict of numpy arrays with the "rank", "MRR", "P_AT_X", "P_AT_1" and
+        "PERPLEXITY" (label log probability) of every sample and, if topk > 0,
+        the "topk_indices" and "topk_log_probs" of shape [batch_size, topk].
+    """
+    if log_probs.dim() > 2:
+        # score only first mask
+        positions = torch.as_tensor([m[0] for m in masked_indices_list], dtype=torch.long)
+        log_probs = log_probs[torch.arange(log_probs.shape[0]), positions]
+
+    labels = torch.as_tensor(label_indices, dtype=torch.long).view(-1, 1)
+    label_log_probs = log_probs.gather(dim=1, index=labels)
+    rank = (log_probs > label_log_probs).sum(dim=1) + 1
+
+    ranking = {
+        "rank": rank.numpy(),
+        "MRR": (1.0 / rank.double()).numpy(),
+        "P_AT_X": (rank <= P_AT).double().numpy(),
+        "P_AT_1": (rank == 1).double().numpy(),
+        "PERPLEXITY": label_log_probs.squeeze(1).numpy(),
+    }
+    if topk > 0:
+        value_max_probs, index_max_probs = torch.topk(log_probs, k=min(topk, log_probs.shape[1]), dim=1)
+        ranking["topk_indices"] = index_max_probs.numpy()
+        ranking["topk_log_probs"] = value_max_probs.numpy()
+    return ranking
+
+
+def get_ranking_results(ranking, vocab, index_list=None, max_printouts=10, printed=None):
+    """Per-sample experiment results of get_ranking_batch
+
+    Args:
+        printed: for every sample, whether its top predictions are printed
+            in return_msg (defaults: all of them). The message of the other
+            samples is empty, it is not built at all.
+
+    Returns:
+        A list with, for every sample, the (MRR, P_AT_X, experiment_result,
+        return_msg) tuple that get_ranking returns.
+    """
+    results = []
+    for i in range(len(ranking["rank"])):
+        experiment_result = {}
+        return_msg = ""
+        if "topk_indices" in ranking:
+            topk = ranking["topk_indices"].shape[1]
+            sample_printouts = min(topk, max_printouts)
+            if printed is not None and not printed[i]:
+                sample_printouts = 0
+            experiment_result["topk"], return_msg = __print_top_k(
+                ranking["topk_log_probs"][i], ranking["topk_indices"][i], vocab,
+                topk, index_list, max_printouts=sample_printouts)
+            if sample_printouts == 0:
+                return_msg = ""
+        experiment_result["MRR"] = ranking["MRR"][i].item()
+        experiment_result["P_AT_X"] = ranking["P_AT_X"][i].item()
+        experiment_result["P_AT_1"] = ranking["P_AT_1"][i].item()
+        experiment_result["PERPLEXITY"] = ranking["PERPLEXITY"][i].item()
+        experiment_result["rank"] = ranking["rank"][i].item()
+        results.append((experiment_result["MRR"], experiment_result["P_AT_X"],
+                        experiment_result, return_msg))
+    return results
+
+
 def __overlap_negation(index_max_probs__negated, index_max_probs):
     # compares first ranked prediction of affirmative and negated statements
     # if true 1, else: 0
     return int(index_max_probs__negated == index_max_probs)
 
 
+def _first_masked_rows(log_probs, masked_indices_list):
+    # [batch_size, vocab_size] log_probs at the first mask of every sample
+    if log_probs.dim() > 2:
+        positions = torch.as_tensor(
+            [m[0] if len(m) > 0 else 0 for m in masked_indices_list], dtype=torch.long)
+        log_probs = log_probs[torch.arange(log_probs.shape[0]), positions]
+    return log_probs
+
+
+def average_ranks(values):
+    """Ranks of the values of every row of a [batch_size, n] tensor
+
+    Like scipy.stats.rankdata: the ranks start at 1 and tied values get the
+    average of their ranks. The ranks are the positions of the values in
+    the sorted rows (argsort of the argsort), the ties are then resolved
+    with the first and last position of every run of equal values.
+    """
+    sorted_values, order = values.sort(dim=1)
+    n = values.shape[1]
+    positions = torch.arange(n, dtype=torch.float64).expand(values.shape[0], n)
+    starts = torch.ones(sorted_values.shape, dtype=torch.bool)
+    starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    ends = torch.ones(sorted_values.shape, dtype=torch.bool)
+    ends[:, :-1] = starts[:, 1:]
+    # first and last position of the run of equal values of every position
+    first = torch.where(starts, positions, torch.zeros_like(positions)).cummax(dim=1).values
+    last = torch.where(ends, positions, torch.full_like(positions, n)).flip(1).cummin(dim=1).values.flip(1)
+    ranks = torch.empty_like(positions)
+    ranks.scatter_(1, order, (first + last) / 2 + 1)
+    return ranks
+
+
+def get_negation_metrics_batch(log_probs, masked_indices_list, log_probs_negated,
+                               masked_indices_negated_list):
+    """Compute the negation metrics of a whole batch at once
+
+    The Spearman rank correlation is the Pearson correlation of the ranks
+    of the affirmative and negated log probabilities (see average_ranks),
+    computed for all the samples together; it matches scipy.stats.spearmanr.
+
+    Args:
+        log_probs, log_probs_negated: tensors [batch_size, vocab_size] or
+            [batch_size, seq_len, vocab_size] of the affirmative and negated
+            samples, only the first mask is scored
+        masked_indices_list, masked_indices_negated_list: masked indices of
+            every sample, a sample without negated masked indices has no
+            negated sentence
+
+    Returns:
+        (overlap, spearman) numpy arrays [batch_size]: whether the first
+        predictions of both sentences are the same (0 or 1) and the rank
+        correlation of their log probabilities, nan for the samples without
+        negated sentence.
+    """
+    log_probs = _first_masked_rows(log_probs, masked_indices_list)
+    log_probs_negated = _first_masked_rows(log_probs_negated, masked_indices_negated_list)
+
+    # overlap btw. affirmative and negated first ranked prediction: 0 or 1
+    overlap = (
+        torch.topk(log_probs, k=1, dim=1)[1] == torch.topk(log_probs_negated, k=1, dim=1)[1]
+    ).squeeze(1).double()
+
+    # rank corrl. btw. affirmative and negated predicted log_probs
+    ranks = average_ranks(log_probs)
+    ranks_negated = average_ranks(log_probs_negated)
+    ranks -= ranks.mean(dim=1, keepdim=True)
+    ranks_negated -= ranks_negated.mean(dim=1, keepdim=True)
+    spearman = (ranks * ranks_negated).sum(dim=1) / (
+        ranks.norm(dim=1) * ranks_negated.norm(dim=1))
+
+    missing = torch.as_tensor([len(m) == 0 for m in masked_indices_negated_list])
+    invalid = missing | torch.isnan(log_probs).any(dim=1) | torch.isnan(log_probs_negated).any(dim=1)
+    overlap[missing] = float("nan")
+    spearman[invalid] = float("nan")
+    return overlap.numpy(), spearman.numpy()
+
+
 def get_negation_metric(log_probs, masked_indices, log_probs_negated,
                         masked_indices_negated, vocab, index_list=None,
                         topk = 1):
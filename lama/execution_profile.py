@@ -0,0 +1,70 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import collections
+import functools
+import multiprocessing
+
+import torch
+
+ExecutionProfile = collections.namedtuple(
+    "ExecutionProfile", "intra_op_threads inter_op_threads metric_workers replicas"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def per_thread_intra_op_threads():
+    """Whether torch keeps the intra-op thread count per thread
+
+    That's the case with the OpenMP parallel backend. With the native thread
+    pool, torch.set_num_threads sets the size of a pool shared by the whole
+    process.
+    """
+    return "parallel backend: OpenMP" in torch.__config__.parallel_info()
+
+
+def execution_profile(args):
+    """Thread counts of a run, from --intra-op-threads, --inter-op-threads,
+    --threads and --replicas (None: leave the torch default)
+
+    With several replicas and the OpenMP backend, every replica gets its
+    share of the cores unless --intra-op-threads is given. With the native
+    thread pool, the replicas share the intra-op threads of the process.
+    """
+    cpu_count = multiprocessing.cpu_count()
+    replicas = max(1, getattr(args, "replicas", 1) or 1)
+    intra_op_threads = getattr(args, "intra_op_threads", 0) or None
+    if intra_op_threads is None and replicas > 1 and per_thread_intra_op_threads():
+        intra_op_threads = max(1, cpu_count // replicas)
+    inter_op_threads = getattr(args, "inter_op_threads", 0) or None
+    metric_workers = args.threads if args.threads > 0 else cpu_count
+    return ExecutionProfile(intra_op_threads, inter_op_threads, metric_workers, replicas)
+
+
+def apply_execution_profile(profile, logger=None):
+    """Set the torch thread counts of the calling process"""
+    if profile.inter_op_threads is not None and torch.get_num_interop_threads() != profile.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(profile.inter_op_threads)
+        except RuntimeError as e:
+            # it can only be set before the first inter-op parallel work
+            if logger is not None:
+                logger.warning("inter-op threads left at {}: {}".format(
+                    torch.get_num_interop_threads(), e))
+    if profile.intra_op_threads is not None:
+        torch.set_num_threads(profile.intra_op_threads)
+
+
+def set_replica_threads(profile):
+    """Set the intra-op threads of the calling replica thread
+
+    Only with the OpenMP backend: otherwise the count is the process-wide one
+    set by apply_execution_profile, see per_thread_intra_op_threads.
+    """
+    if not per_thread_intra_op_threads():
+        return
+    if profile.intra_op_threads is not None and torch.get_num_threads() != profile.intra_op_threads:
+        torch.set_num_threads(profile.intra_op_threads)
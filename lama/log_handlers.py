@@ -0,0 +1,69 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+# listener thread of every logger set up by attach_queue_listener
+_listeners = {}
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """File handler rotating the log at max_bytes, the old logs are gzipped
+
+    info.log is moved to info.log.1.gz, info.log.1.gz to info.log.2.gz, ...
+    and at most backup_count old logs are kept.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count=5):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotator
+
+
+def attach_queue_listener(logger, handlers):
+    """Route the records of logger to handlers through a queue
+
+    The logging calls only put the records in the queue, the handlers
+    format and write them on a listener thread. The handlers previously
+    attached to logger are closed.
+    """
+    detach_queue_listener(logger)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    _listeners[logger.name] = listener
+
+
+def detach_queue_listener(logger):
+    """Write the pending records of logger and close its handlers"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    listener = _listeners.pop(logger.name, None)
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+@atexit.register
+def _detach_all():
+    # a run that crashed still writes its pending records
+    for name in list(_listeners):
+        detach_queue_listener(logging.getLogger(name))
@@ -4,15 +4,39 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-#from .bert_connector import Bert
-#from .elmo_connector import Elmo
-#from .gpt_connector import GPT
-#from .transformerxl_connector import TransformerXL
-#from .roberta_connector import Roberta
-from .colake_connector import Colake
-from .hfroberta_connector import HfRoberta
-from .hfluke_connector import HfLuke
-from .gpt2_connector import GPT2
+import importlib
+import time
+
+# name of the LM -> (module, class) of its connector, the module is only
+# imported when the LM is built (e.g. transformers is not imported by the
+# tools that only need base_connector)
+CONNECTORS = dict(
+    #elmo=("lama.modules.elmo_connector", "Elmo"),
+    #bert=("lama.modules.bert_connector", "Bert"),
+    #gpt=("lama.modules.gpt_connector", "GPT"),
+    #transformerxl=("lama.modules.transformerxl_connector", "TransformerXL"),
+    #roberta=("lama.modules.roberta_connector", "Roberta"),
+    colake=("lama.modules.colake_connector", "Colake"),
+    hfroberta=("lama.modules.hfroberta_connector", "HfRoberta"),
+    hfluke=("lama.modules.hfluke_connector", "HfLuke"),
+    gpt2=("lama.modules.gpt2_connector", "GPT2"),
+)
+
+
+def get_connector_class(lm):
+    """Import the connector class of the LM named lm"""
+    if lm not in CONNECTORS:
+        raise ValueError("Unrecognized Language Model: %s." % lm)
+    module_name, class_name = CONNECTORS[lm]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def __getattr__(name):
+    # from lama.modules import HfRoberta imports that connector only
+    for module_name, class_name in CONNECTORS.values():
+        if class_name == name:
+            return getattr(importlib.import_module(module_name), class_name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def build_model_by_name(lm, args, verbose=True):
@@ -21,19 +45,34 @@ def build_model_by_name(lm, args, verbose=True):
     Note, args.lm is not used for model selection. args are only passed to the
     model's initializator.
     """
-    MODEL_NAME_TO_CLASS = dict(
-        #elmo=Elmo,
-        #bert=Bert,
-        #gpt=GPT,
-        #transformerxl=TransformerXL,
-        #roberta=Roberta,
-        colake=Colake,
-        hfroberta=HfRoberta,
-        hfluke=HfLuke,
-        gpt2=GPT2
-    )
-    if lm not in MODEL_NAME_TO_CLASS:
-        raise ValueError("Unrecognized Language Model: %s." % lm)
+    connector_class = get_connector_class(lm)
     if verbose:
         print("Loading %s model..." % lm)
-    return MODEL_NAME_TO_CLASS[lm](args)
+    start = time.perf_counter()
+    model = connector_class(args)
+    # the rest of the construction: vocabulary, special tokens, ...
+    model.startup_times["other"] = time.perf_counter() - start - sum(model.startup_times.values())
+    quantize = getattr(args, "quantize", None)
+    if quantize:
+        if verbose:
+            print("Quantizing %s model (%s)..." % (lm, quantize))
+        with model.startup_phase("quantize"):
+            model.quantize(quantize)
+    compile_forward = getattr(args, "compile_forward", None)
+    if compile_forward:
+        if verbose:
+            print("Compiling %s model (%s)..." % (lm, compile_forward))
+        buckets = getattr(args, "compile_buckets", None)
+        kwargs = {}
+        if buckets:
+            kwargs["length_buckets"] = [int(length) for length in str(buckets).split(",")]
+        with model.startup_phase("compile"):
+            model.compile_forward(
+                compile_forward, warmup_batch_size=getattr(args, "batch_size", None) or 1, **kwargs)
+    if verbose:
+        print("Loaded %s model in %.2fs (%s)" % (
+            lm,
+            sum(model.startup_times.values()),
+            ", ".join("%s %.2fs" % phase for phase in model.startup_times.items()),
+        ))
+    return model
@@ -4,8 +4,18 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import collections
+import contextlib
+import hashlib
+import os
 import re
+import threading
+import time
+import numpy as np
 import torch
+import torch.nn.functional as F
+
+from lama.modules.compiled_encoder import BucketedEncoder, DEFAULT_LENGTH_BUCKETS
 
 MASK = "[MASK]"
 BERT_UNK = "[UNK]"
@@ -52,6 +62,15 @@ SPECIAL_SYMBOLS = [
 
 SPACE_NORMALIZER = re.compile(r"\s+")
 
+# An entry of the object label table of a connector (see get_label_table):
+#   token_ids: token ids of the label, as returned by get_id
+#   in_vocab: the label is reconstructed by the words of its token ids
+#   single_token: the label is a single token of the model vocabulary
+#   in_subset: all the words of the label are in the vocab subset (None if
+#              no vocab subset is given)
+ObjectLabel = collections.namedtuple(
+    'ObjectLabel', 'token_ids, in_vocab, single_token, in_subset')
+
 
 def default_tokenizer(line):
     """Default tokenizer for models that don't have one
@@ -81,8 +100,371 @@ def default_tokenizer(line):
     return result
 
 
+def gather_first_masked(hidden_states, masked_indices_list):
+    """Select the hidden state at the first [MASK] of every sample
+
+    Only the first mask of a sample is scored (see evaluation_metrics), so the
+    LM head and the softmax only need to run on these rows.
+
+    Args:
+        hidden_states: tensor of shape [batch_size, seq_len, hidden_size]
+        masked_indices_list: list with the masked indices of every sample.
+            Samples without a mask (e.g. empty negated probes) use position 0.
+
+    Returns:
+        A tensor of shape [batch_size, hidden_size]
+    """
+    positions = torch.as_tensor(
+        [m[0] if len(m) > 0 else 0 for m in masked_indices_list],
+        dtype=torch.long, device=hidden_states.device)
+    rows = torch.arange(hidden_states.shape[0], device=hidden_states.device)
+    return hidden_states[rows, positions]
+
+
+def collate_token_ids(encodings, pad_id, pin_memory=False, share_memory=False):
+    """Pad a batch of encoded samples into model input tensors
+
+    The output tensors are allocated once and filled row by row.
+
+    Args:
+        encodings: list of (token_ids, segment_ids, masked_indices), as
+            returned by encode_sentences. Ids may be lists or numpy arrays.
+        pad_id: token id used for padding (segments are padded with 0).
+        pin_memory: allocate the tensors in page-locked memory (needs CUDA),
+            for asynchronous host to device copies.
+        share_memory: allocate the tensors in shared memory, so that they
+            can be handed over by a prefetch worker process.
+
+    Returns:
+        A tuple (input_ids, token_type_ids, attention_mask, masked_indices_list)
+        with three LongTensors of shape [batch_size, max_tokens].
+    """
+    batch_size = len(encodings)
+    max_tokens = max((len(encoding[0]) for encoding in encodings), default=0)
+    pin_memory = pin_memory and torch.cuda.is_available()
+
+    def allocate(fill_value):
+        tensor = torch.full(
+            (batch_size, max_tokens), fill_value, dtype=torch.long, pin_memory=pin_memory)
+        if share_memory:
+            tensor.share_memory_()
+        return tensor
+
+    input_ids = allocate(pad_id)
+    token_type_ids = allocate(0)
+    attention_mask = allocate(0)
+
+    # fill through numpy views of the tensors: no intermediate tensors per sample
+    input_ids_view = input_ids.numpy()
+    token_type_ids_view = token_type_ids.numpy()
+    attention_mask_view = attention_mask.numpy()
+    masked_indices_list = []
+    for i, (token_ids, segment_ids, masked_indices) in enumerate(encodings):
+        num_tokens = len(token_ids)
+        input_ids_view[i, :num_tokens] = token_ids
+        token_type_ids_view[i, :num_tokens] = segment_ids
+        attention_mask_view[i, :num_tokens] = 1
+        masked_indices_list.append(list(masked_indices))
+
+    return input_ids, token_type_ids, attention_mask, masked_indices_list
+
+
+# threads building modules in _parameters_on_meta
+_meta_parameters = threading.local()
+_meta_parameters_hook = None
+_meta_parameters_lock = threading.Lock()
+
+
+def _parameter_to_meta(module, name, param):
+    # global parameter registration hook, only active in _parameters_on_meta
+    if param is not None and getattr(_meta_parameters, "active", False):
+        return type(param)(param.to("meta"), requires_grad=param.requires_grad)
+
+
+@contextlib.contextmanager
+def _parameters_on_meta():
+    # build modules with their parameters on the meta device (no memory, no
+    # random init), the buffers are still created on CPU since the
+    # checkpoints don't hold the non-persistent ones (position ids, causal
+    # masks). Only the calling thread is affected.
+    global _meta_parameters_hook
+    with _meta_parameters_lock:
+        if _meta_parameters_hook is None:
+            _meta_parameters_hook = torch.nn.modules.module.register_module_parameter_registration_hook(
+                _parameter_to_meta)
+    active = getattr(_meta_parameters, "active", False)
+    _meta_parameters.active = True
+    try:
+        yield
+    finally:
+        _meta_parameters.active = active
+
+
+def _align_state_dict_keys(state_dict, model_keys, prefix):
+    # checkpoints of a base model (e.g. the hub GPT-2) lack the prefix of the
+    # head model weights, checkpoints of a head model loaded into its base
+    # model have one too many
+    aligned = {}
+    for key, tensor in state_dict.items():
+        if key not in model_keys and prefix:
+            if "{}.{}".format(prefix, key) in model_keys:
+                key = "{}.{}".format(prefix, key)
+            elif key.startswith(prefix + ".") and key[len(prefix) + 1:] in model_keys:
+                key = key[len(prefix) + 1:]
+        aligned[key] = tensor
+    return aligned
+
+
+def _init_missing_modules(model):
+    # the modules without any weight in the checkpoint (e.g. the entity head
+    # of LUKE) get their initial weights, as from_pretrained does
+    modules = []
+    for module in model.modules():
+        params = list(module.parameters(recurse=False))
+        if any(param.is_meta for param in params):
+            if not all(param.is_meta for param in params):
+                return False
+            modules.append(module)
+    for module in modules:
+        for name, param in list(module.named_parameters(recurse=False)):
+            module._parameters[name] = type(param)(
+                torch.zeros(param.shape, dtype=param.dtype), requires_grad=param.requires_grad)
+        model._init_weights(module)
+    return True
+
+
+def build_pretrained(model_class, config, state_dict):
+    """model_class(config) holding the tensors of state_dict as its weights
+
+    The model is built without weights first, then takes the tensors of
+    state_dict as they are instead of copying them: with a memory-mapped
+    state_dict the weights stay in the page cache, shared with the other
+    processes loading the same checkpoint. Float weights are cast to the
+    default dtype. As with from_pretrained, the keys are matched with or
+    without the base model prefix, keys the model doesn't have are ignored
+    and the modules missing from state_dict are initialized.
+
+    Returns:
+        The model in eval mode, or None if state_dict misses only part of the
+        weights of a module.
+    """
+    from transformers.modeling_utils import no_init_weights
+
+    with _parameters_on_meta(), no_init_weights():
+        model = model_class(config)
+    dtype = torch.get_default_dtype()
+    state_dict = _align_state_dict_keys(
+        state_dict, set(model.state_dict()), getattr(model, "base_model_prefix", ""))
+    state_dict = {
+        key: tensor.to(dtype) if tensor.is_floating_point() and tensor.dtype != dtype else tensor
+        for key, tensor in state_dict.items()
+    }
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    if any(param.is_meta for param in model.parameters()):
+        if not hasattr(model, "_init_weights") or not _init_missing_modules(model):
+            return None
+        if hasattr(model, "tie_weights"):
+            model.tie_weights()
+    return model.eval()
+
+
+def from_pretrained_mmap(model_class, name_or_path):
+    """model_class.from_pretrained(name_or_path), with the weights memory-mapped
+
+    The model is built with build_pretrained from the single safetensors or
+    pytorch_model.bin checkpoint of name_or_path. Falls back to
+    from_pretrained for the checkpoints it can't load that way (sharded,
+    with renamed weights, ...).
+    """
+    from transformers.utils import cached_file, SAFE_WEIGHTS_NAME, WEIGHTS_NAME
+
+    config = model_class.config_class.from_pretrained(name_or_path)
+    for weights_name in (SAFE_WEIGHTS_NAME, WEIGHTS_NAME):
+        weights_file = cached_file(
+            name_or_path, weights_name,
+            _raise_exceptions_for_missing_entries=False,
+            _raise_exceptions_for_connection_errors=False,
+        )
+        if weights_file is None:
+            continue
+        if weights_name == SAFE_WEIGHTS_NAME:
+            from safetensors.torch import load_file
+            state_dict = load_file(weights_file)
+        else:
+            state_dict = load_state_dict_mmap(weights_file)
+        model = build_pretrained(model_class, config, state_dict)
+        if model is not None:
+            return model
+        break
+    return model_class.from_pretrained(name_or_path).eval()
+
+
+def _conv1d_to_linear(module):
+    # GPT-2 implements its projections with transformers' Conv1D (a linear
+    # layer with a transposed weight), which dynamic quantization skips
+    for name, child in list(module.named_children()):
+        if type(child).__name__ == "Conv1D":
+            nx, nf = child.weight.shape
+            linear = torch.nn.Linear(nx, nf)
+            linear.weight.data.copy_(child.weight.detach().t())
+            linear.bias.data.copy_(child.bias.detach())
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+def load_state_dict_mmap(path):
+    """Load a torch checkpoint on CPU, memory-mapped if its format allows it
+
+    The tensors are then read from the page cache when they are copied into
+    the model, instead of being loaded in process memory first.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except RuntimeError:
+        # legacy (non zip) checkpoints can't be memory-mapped
+        return torch.load(path, map_location="cpu")
+
+
+def quantize_linear_layers(module, exclude=()):
+    """Dynamic int8 quantization of the linear layers of module, in place
+
+    The weights are stored as int8 and the activations quantized on the fly,
+    on CPU. The layers in exclude (e.g. the output projection, see
+    init_subset_output_layer) are kept in float.
+    """
+    _conv1d_to_linear(module)
+    excluded = set(id(layer) for layer in exclude)
+    names = set(
+        name for name, child in module.named_modules()
+        if isinstance(child, torch.nn.Linear) and id(child) not in excluded
+    )
+    torch.quantization.quantize_dynamic(module, names, dtype=torch.qint8, inplace=True)
+
+
+class SubsetOutputLayer(torch.nn.Module):
+    """Output layer restricted to a subset of the vocabulary
+
+    Replaces the output projection of a LM (similar to
+    Elmo.optimize_top_layer) so that only the logits of the vocab subset are
+    computed. The layer returns log probabilities over the subset, normalized
+    either over the subset only ("subset") or, exactly, over the full
+    vocabulary with a logsumexp of the full logits ("full"). Only "subset"
+    saves compute, "full" is there to check parity with the full head.
+    """
+
+    def __init__(self, output_layer, indices, normalization="full"):
+        super().__init__()
+        if normalization not in ("full", "subset"):
+            raise ValueError("Unrecognized normalization: %s." % normalization)
+        self.normalization = normalization
+        self.register_buffer("indices", torch.as_tensor(indices, dtype=torch.long))
+        if normalization == "full":
+            # the full logits are needed for the normalization constant
+            self.output_layer = output_layer
+        else:
+            weight = output_layer.weight.detach().index_select(0, self.indices)
+            bias = output_layer.bias
+            self.output_layer = torch.nn.Linear(
+                weight.shape[1], weight.shape[0], bias=bias is not None)
+            self.output_layer.to(weight.device)
+            self.output_layer.weight.data.copy_(weight)
+            if bias is not None:
+                self.output_layer.bias.data.copy_(
+                    bias.detach().index_select(0, self.indices))
+
+    def forward(self, x):
+        logits = self.output_layer(x)
+        if self.normalization == "subset":
+            return F.log_softmax(logits, dim=-1)
+        log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+        return logits.index_select(-1, self.indices) - log_normalizer
+
+
+class VocabSubsetIndex():
+    """Mapping between a vocab subset and the vocabulary of a model
+
+    subset_to_model holds the model id of every entry of the subset,
+    model_to_subset the position in the subset of every model id (-1 if the
+    token is not in the subset). Both lookups are O(1). The index also
+    behaves like the index_list returned by init_indices_for_filter_logprobs
+    (index_list[i], index_list.index(model_id)).
+    """
+
+    def __init__(self, subset_to_model, vocab_size):
+        self.subset_to_model = np.asarray(subset_to_model, dtype=np.int64)
+        self.model_to_subset = np.full(vocab_size, -1, dtype=np.int64)
+        self.model_to_subset[self.subset_to_model] = np.arange(
+            len(self.subset_to_model), dtype=np.int64)
+        # indices for index_select on the vocabulary dimension
+        self.indices = torch.from_numpy(self.subset_to_model)
+
+    @classmethod
+    def from_words(cls, words, inverse_vocab, vocab_size, logger=None):
+        subset_to_model = []
+        for word in words:
+            if word in inverse_vocab:
+                subset_to_model.append(inverse_vocab[word])
+            else:
+                msg = "word {} from vocab_subset not in model vocabulary!".format(word)
+                if logger is not None:
+                    logger.warning(msg)
+                else:
+                    print("WARNING: {}".format(msg))
+        return cls(subset_to_model, vocab_size)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["subset_to_model"], int(data["vocab_size"]))
+
+    def save(self, path):
+        # write to a temporary file first, concurrent runs may share the cache
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, subset_to_model=self.subset_to_model,
+                     vocab_size=len(self.model_to_subset))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.subset_to_model)
+
+    def __getitem__(self, subset_id):
+        return int(self.subset_to_model[subset_id])
+
+    def __contains__(self, model_id):
+        return 0 <= model_id < len(self.model_to_subset) and self.model_to_subset[model_id] >= 0
+
+    def index(self, model_id):
+        if model_id not in self:
+            raise ValueError("{} is not in the vocab subset".format(model_id))
+        return int(self.model_to_subset[model_id])
+
+    def to_subset(self, model_ids):
+        """Positions in the subset of the given model ids (-1 if missing)."""
+        return self.model_to_subset[np.asarray(model_ids, dtype=np.int64)]
+
+    def to_model(self, subset_ids):
+        """Model ids of the given positions in the subset."""
+        return self.subset_to_model[np.asarray(subset_ids, dtype=np.int64)]
+
+
 class Base_Connector():
 
+    # connectors of which the linear layers can be quantized, see quantize
+    quantizable = False
+    # quantization mode applied to the model, if any
+    quantization = None
+    # accuracy lost by the quantization, measured once, see quantization_parity
+    parity_report = None
+    # BucketedEncoder running the encoder, see compile_forward
+    compiled_encoder = None
+    # number of VocabSubsetIndex kept in memory (None: all of them), the
+    # least recently used ones are dropped first
+    vocab_subset_cache_size = None
+
     def __init__(self):
 
         # these variables should be initialized
@@ -91,22 +473,94 @@ class Base_Connector():
         # This defines where the device where the model is. Changed by try_cuda.
         self._model_device = 'cpu'
 
+        # output layer restricted to a vocab subset, see init_subset_output_layer
+        self.subset_output_layer = None
+        self._full_output_layer = None
+
+        # VocabSubsetIndex cache, see get_vocab_subset_index
+        self._vocab_subset_indices = collections.OrderedDict()
+
+        # token ids of the object labels, see get_label_table
+        self._label_ids = {}
+
+        # seconds spent in every phase of the construction, see startup_phase
+        self.startup_times = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def startup_phase(self, name):
+        """Time a phase of the construction of the connector (e.g. loading the
+        tokenizer or the weights), the times add up in startup_times"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_times[name] = self.startup_times.get(name, 0.0) + time.perf_counter() - start
+
     def optimize_top_layer(self, vocab_subset):
         """
         optimization for some LM
         """
         pass
 
+    def _get_output_layer_owner(self):
+        """Return (module, attribute name) of the output projection of the LM,
+        or None if the connector doesn't support a subset output layer."""
+        return None
+
+    def init_subset_output_layer(self, indices, normalization="full"):
+        """Restrict the output layer of the LM to the given vocab indices
+
+        Once set, get_batch_generation returns log probabilities over the
+        subset (in the order of indices), so filter_logprobs must not be
+        applied on top.
+
+        Returns:
+            True if the output layer has been replaced, False if the
+            connector doesn't support it.
+        """
+        owner = self._get_output_layer_owner()
+        if owner is None:
+            return False
+        self.reset_output_layer()
+        module, name = owner
+        self._full_output_layer = getattr(module, name)
+        self.subset_output_layer = SubsetOutputLayer(
+            self._full_output_layer, indices, normalization=normalization)
+        setattr(module, name, self.subset_output_layer)
+        return True
+
+    def reset_output_layer(self):
+        """Restore the full vocabulary output layer."""
+        if self.subset_output_layer is None:
+            return
+        module, name = self._get_output_layer_owner()
+        setattr(module, name, self._full_output_layer)
+        self.subset_output_layer = None
+        self._full_output_layer = None
+
+    def _log_softmax(self, logits):
+        # the subset output layer already returns log probabilities
+        if self.subset_output_layer is not None:
+            return logits
+        return F.log_softmax(logits, dim=-1)
+
     def _init_inverse_vocab(self):
         self.inverse_vocab = {w: i for i, w in enumerate(self.vocab)}
+        # the token ids of the labels depend on the vocabulary
+        self._label_ids = {}
+        self._vocab_sha1 = None
 
     def try_cuda(self):
         """Move model to GPU if one is available."""
-        if torch.cuda.is_available():
+        # quantized models run on CPU only
+        if torch.cuda.is_available() and self.quantization is None:
             if self._model_device != 'cuda':
                 # print('Moving model to CUDA')
                 self._cuda()
                 self._model_device = 'cuda'
+                # the compiled graphs hold the device of their inputs
+                if self.compiled_encoder is not None:
+                    self.compiled_encoder.reset()
         # else:
         #     print('No CUDA found')
 
@@ -114,38 +568,228 @@ class Base_Connector():
         """Move model to GPU."""
         raise NotImplementedError
 
+    def quantize(self, mode="int8"):
+        """Quantize the linear layers of the model for CPU inference
+
+        Only dynamic int8 quantization is supported. The output projection is
+        kept in float: the ranking of the labels is the most sensitive to it
+        and it is computed only at the masked positions with masked_only.
+        """
+        if mode != "int8":
+            raise ValueError("Unrecognized quantization: %s." % mode)
+        if not self.quantizable:
+            raise ValueError("{} can not be quantized".format(type(self).__name__))
+        if self.quantization is not None:
+            return
+        self.reset_output_layer()
+        exclude = []
+        owner = self._get_output_layer_owner()
+        if owner is not None:
+            module, name = owner
+            exclude.append(getattr(module, name))
+        for module in vars(self).values():
+            if isinstance(module, torch.nn.Module):
+                quantize_linear_layers(module, exclude=exclude)
+        self.quantization = mode
+
+    def _get_encoder(self):
+        """Return (encoder, keywords of its inputs, longest input) of the LM,
+        the encoder returning the last hidden states first, or None if the
+        connector doesn't support a compiled forward."""
+        return None
+
+    def _encode(self, *inputs):
+        """Last hidden states of the encoder, inputs in the order of the
+        keywords of _get_encoder"""
+        inputs = [tensor.to(self._model_device) for tensor in inputs]
+        if self.compiled_encoder is not None:
+            return self.compiled_encoder(*inputs)
+        encoder, keywords, _ = self._get_encoder()
+        return encoder(**dict(zip(keywords, inputs)))[0]
+
+    def compile_forward(self, backend="trace", length_buckets=DEFAULT_LENGTH_BUCKETS,
+                        warmup_batch_size=None):
+        """Run the encoder of the LM compiled, on inputs padded to length_buckets
+
+        The output layer stays eager, so it can still be restricted to a
+        vocab subset. If warmup_batch_size is given, the graphs of every length
+        bucket are compiled right away for batches of up to that size, instead
+        of on the first batches of the run; larger batches compile lazily.
+        """
+        encoder = self._get_encoder()
+        if encoder is None:
+            raise ValueError("{} can not be compiled".format(type(self).__name__))
+        encoder, keywords, max_length = encoder
+        encoder.eval()
+        self.compiled_encoder = BucketedEncoder(
+            encoder, backend=backend,
+            length_buckets=[length for length in length_buckets if length <= max_length],
+            pad_id=getattr(self, "pad_id", 0), keywords=keywords)
+        if warmup_batch_size:
+            self.compiled_encoder.warm_up(warmup_batch_size, device=self._model_device)
+
+    def share_memory(self):
+        """Move the weights of the model to shared memory
+
+        Processes forked afterwards (see lama.process_pool) then use the
+        same copy of the weights instead of one each.
+        """
+        for module in vars(self).values():
+            if isinstance(module, torch.nn.Module):
+                module.share_memory()
+
     def init_indices_for_filter_logprobs(self, vocab_subset, logger=None):
-        index_list = []
-        new_vocab_subset = []
-        for word in vocab_subset:
-            if word in self.inverse_vocab:
-                inverse_id = self.inverse_vocab[word]
-                index_list.append(inverse_id)
-                new_vocab_subset.append(word)
-            else:
-                msg = "word {} from vocab_subset not in model vocabulary!".format(word)
-                if logger is not None:
-                    logger.warning(msg)
-                else:
-                    print("WARNING: {}".format(msg))
+        index_list = VocabSubsetIndex.from_words(
+            vocab_subset, self.inverse_vocab, len(self.vocab), logger=logger)
 
         # 1. gather correct indices
-        indices = torch.as_tensor(index_list)
+        indices = index_list.indices
         return indices, index_list
 
+    def _vocab_digest(self):
+        # hashed once per vocabulary, see _init_inverse_vocab
+        if getattr(self, "_vocab_sha1", None) is None:
+            self._vocab_sha1 = hashlib.sha1("\n".join(self.vocab).encode("utf-8")).hexdigest()
+        return self._vocab_sha1
+
+    def tokenizer_signature(self):
+        """Digest identifying how this connector turns text into token ids
+
+        Two connectors with the same signature produce the same
+        encode_sentences output, so pre-tokenized probes can be shared.
+        """
+        if getattr(self, "_tokenizer_signature", None) is None:
+            tokenizer = getattr(self, "tokenizer", None)
+            h = hashlib.sha1()
+            h.update(type(self).__name__.encode("utf-8"))
+            h.update(type(tokenizer).__name__.encode("utf-8"))
+            h.update(str(getattr(tokenizer, "add_prefix_space", None)).encode("utf-8"))
+            h.update(self._vocab_digest().encode("utf-8"))
+            self._tokenizer_signature = h.hexdigest()
+        return self._tokenizer_signature
+
+    def get_vocab_subset_index(self, vocab_subset, vocab_filename=None, logger=None):
+        """Return the VocabSubsetIndex of vocab_subset for this model
+
+        The index is built once per (model vocabulary, vocab subset): it is
+        kept in memory (up to vocab_subset_cache_size of them) and, if
+        vocab_filename is given, cached on disk next to that file.
+        """
+        digest = hashlib.sha1(self._vocab_digest().encode("utf-8"))
+        digest.update("\n".join(vocab_subset).encode("utf-8"))
+        key = digest.hexdigest()[:16]
+        if key in self._vocab_subset_indices:
+            self._vocab_subset_indices.move_to_end(key)
+            return self._vocab_subset_indices[key]
+
+        cache_path = None
+        index = None
+        if vocab_filename is not None:
+            cache_path = "{}.{}.npz".format(vocab_filename, key)
+            if os.path.exists(cache_path):
+                index = VocabSubsetIndex.load(cache_path)
+        if index is None:
+            index = VocabSubsetIndex.from_words(
+                vocab_subset, self.inverse_vocab, len(self.vocab), logger=logger)
+            if cache_path is not None:
+                try:
+                    index.save(cache_path)
+                except OSError as e:
+                    msg = "cannot cache vocab subset index: {}".format(e)
+                    if logger is not None:
+                        logger.warning(msg)
+                    else:
+                        print("WARNING: {}".format(msg))
+
+        self._vocab_subset_indices[key] = index
+        if self.vocab_subset_cache_size is not None:
+            while len(self._vocab_subset_indices) > self.vocab_subset_cache_size:
+                self._vocab_subset_indices.popitem(last=False)
+        return index
+
     def filter_logprobs(self, log_probs, indices):
-        new_log_probs = log_probs.index_select(dim=2 , index=indices)
+        # the vocabulary is always the last dimension, both for full
+        # [batch, seq_len, vocab] and masked-only [batch, vocab] log_probs
+        new_log_probs = log_probs.index_select(dim=-1, index=indices)
         return new_log_probs
 
     def get_id(self, string):
         raise NotImplementedError()
 
+    def get_ids(self, strings):
+        """get_id for a list of strings
+
+        Connectors can override this with a single batch-tokenizer call.
+        """
+        return [self.get_id(string) for string in strings]
+
+    def get_label_table(self, labels, vocab_subset=None):
+        """Return a dict mapping every distinct label to its ObjectLabel
+
+        The labels are tokenized once per connector: labels repeat heavily
+        within and across relations, so the token ids are cached and only
+        new labels go through get_ids.
+
+        Args:
+            labels: iterable of object labels
+            vocab_subset: optional VocabSubsetIndex for the in_subset flag
+        """
+        labels = set(labels)
+        new_labels = [label for label in labels if label not in self._label_ids]
+        if new_labels:
+            for label, token_ids in zip(new_labels, self.get_ids(new_labels)):
+                self._label_ids[label] = token_ids
+
+        label_table = {}
+        for label in labels:
+            token_ids = self._label_ids[label]
+            if token_ids:
+                recostructed_word = " ".join(
+                    [self.vocab[x] for x in token_ids]
+                ).strip()
+            else:
+                recostructed_word = None
+            in_vocab = recostructed_word == label
+            in_subset = None
+            if vocab_subset is not None:
+                in_subset = all(
+                    x in self.inverse_vocab and self.inverse_vocab[x] in vocab_subset
+                    for x in label.split(" ")
+                )
+            label_table[label] = ObjectLabel(
+                token_ids=token_ids,
+                in_vocab=in_vocab,
+                single_token=in_vocab and len(token_ids) == 1,
+                in_subset=in_subset,
+            )
+        return label_table
+
     def get_generation(self, sentences, logger=None):
         [log_probs], [token_ids], [masked_indices] = self.get_batch_generation(
             [sentences], logger=logger, try_cuda=False)
         return log_probs, token_ids, masked_indices
 
-    def get_batch_generation(self, sentences_list, logger= None, try_cuda=True):
+    def get_batch_generation(self, sentences_list, logger= None, try_cuda=True, masked_only=False):
+        """Compute the log probabilities for a batch of sentences
+
+        If masked_only is True the LM head is applied only at the first [MASK]
+        of every sample and the returned log_probs have shape
+        [batch_size, vocab_size] instead of [batch_size, seq_len, vocab_size].
+        """
+        raise NotImplementedError()
+
+    def encode_sentences(self, sentences):
+        """Tokenize the sentences of a single sample into model inputs
+
+        Returns:
+        token_ids (list[int]), segment_ids (list[int]) and masked_indices
+        (list[int]), the encoding consumed by get_batch_generation_from_ids
+        """
+        raise NotImplementedError()
+
+    def get_batch_generation_from_ids(self, encodings, logger=None, try_cuda=True, masked_only=False):
+        """Same as get_batch_generation, for samples already encoded with
+        encode_sentences (e.g. read back from a probe shard)"""
         raise NotImplementedError()
 
     def get_contextual_embeddings(self, sentences):
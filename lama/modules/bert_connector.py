@@ -4,6 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import logging
 import torch
 import pytorch_pretrained_bert.tokenization as btok
 from pytorch_pretrained_bert import BertTokenizer, BertForMaskedLM, BasicTokenizer, BertModel
@@ -104,52 +105,15 @@ class Bert(Base_Connector):
         return indexed_string
 
     def __get_input_tensors_batch(self, sentences_list):
-        tokens_tensors_list = []
-        segments_tensors_list = []
-        masked_indices_list = []
+        encodings = []
         tokenized_text_list = []
-        max_tokens = 0
         for sentences in sentences_list:
-            tokens_tensor, segments_tensor, masked_indices, tokenized_text = self.__get_input_tensors(sentences)
-            tokens_tensors_list.append(tokens_tensor)
-            segments_tensors_list.append(segments_tensor)
-            masked_indices_list.append(masked_indices)
+            indexed_tokens, segments_ids, masked_indices, tokenized_text = self.__get_input_tensors(sentences)
+            encodings.append((indexed_tokens, segments_ids, masked_indices))
             tokenized_text_list.append(tokenized_text)
-            # assert(tokens_tensor.shape[1] == segments_tensor.shape[1])
-            if (tokens_tensor.shape[1] > max_tokens):
-                max_tokens = tokens_tensor.shape[1]
-        # print("MAX_TOKENS: {}".format(max_tokens))
-        # apply padding and concatenate tensors
-        # use [PAD] for tokens and 0 for segments
-        final_tokens_tensor = None
-        final_segments_tensor = None
-        final_attention_mask = None
-        for tokens_tensor, segments_tensor in zip(tokens_tensors_list, segments_tensors_list):
-            dim_tensor = tokens_tensor.shape[1]
-            pad_lenght = max_tokens - dim_tensor
-            attention_tensor = torch.full([1,dim_tensor], 1, dtype= torch.long)
-            if pad_lenght>0:
-                pad_1 = torch.full([1,pad_lenght], self.pad_id, dtype= torch.long)
-                pad_2 = torch.full([1,pad_lenght], 0, dtype= torch.long)
-                attention_pad = torch.full([1,pad_lenght], 0, dtype= torch.long)
-                tokens_tensor = torch.cat((tokens_tensor,pad_1), dim=1)
-                segments_tensor = torch.cat((segments_tensor,pad_2), dim=1)
-                attention_tensor = torch.cat((attention_tensor,attention_pad), dim=1)
-            if final_tokens_tensor is None:
-                final_tokens_tensor = tokens_tensor
-                final_segments_tensor = segments_tensor
-                final_attention_mask = attention_tensor
-            else:
-                final_tokens_tensor = torch.cat((final_tokens_tensor,tokens_tensor), dim=0)
-                final_segments_tensor = torch.cat((final_segments_tensor,segments_tensor), dim=0)
-                final_attention_mask = torch.cat((final_attention_mask,attention_tensor), dim=0)
-        # print(final_tokens_tensor)
-        # print(final_segments_tensor)
-        # print(final_attention_mask)
-        # print(final_tokens_tensor.shape)
-        # print(final_segments_tensor.shape)
-        # print(final_attention_mask.shape)
-        return final_tokens_tensor, final_segments_tensor, final_attention_mask, masked_indices_list, tokenized_text_list
+        # apply padding: use [PAD] for tokens and 0 for segments
+        tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list = collate_token_ids(encodings, self.pad_id)
+        return tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, tokenized_text_list
 
     def __get_input_tensors(self, sentences):
 
@@ -191,11 +155,7 @@ class Bert(Base_Connector):
 
         indexed_tokens = self.tokenizer.convert_tokens_to_ids(tokenized_text)
 
-        # Convert inputs to PyTorch tensors
-        tokens_tensor = torch.tensor([indexed_tokens])
-        segments_tensors = torch.tensor([segments_ids])
-
-        return tokens_tensor, segments_tensors, masked_indices, tokenized_text
+        return indexed_tokens, segments_ids, masked_indices, tokenized_text
 
     def __get_token_ids_from_tensor(self, indexed_string):
         token_ids = []
@@ -219,7 +179,7 @@ class Bert(Base_Connector):
 
         tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, tokenized_text_list = self.__get_input_tensors_batch(sentences_list)
 
-        if logger is not None:
+        if logger is not None and logger.isEnabledFor(logging.DEBUG):
             logger.debug("\n{}\n".format(tokenized_text_list))
 
         with torch.no_grad():
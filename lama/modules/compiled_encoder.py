@@ -0,0 +1,128 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import torch
+
+DEFAULT_LENGTH_BUCKETS = (16, 32, 64, 128, 256, 512)
+
+
+def bucket_size(size, buckets):
+    """Smallest bucket that fits size, None if size is larger than all of them"""
+    for bucket in buckets:
+        if size <= bucket:
+            return bucket
+    return None
+
+
+def batch_bucket_size(batch_size):
+    # batches are padded to a power of two
+    bucket = 1
+    while bucket < batch_size:
+        bucket *= 2
+    return bucket
+
+
+class _EncoderForward(torch.nn.Module):
+    # positional wrapper returning the last hidden states, for tracing
+
+    def __init__(self, encoder, keywords):
+        super().__init__()
+        self.encoder = encoder
+        self.keywords = keywords
+
+    def forward(self, *inputs):
+        return self.encoder(**dict(zip(self.keywords, inputs)))[0]
+
+
+class BucketedEncoder():
+    """Compiled forward of an encoder, on inputs padded to a few fixed shapes
+
+    Every batch is padded to the smallest length bucket that fits it (and
+    its batch size to a power of two), so the encoder is compiled once per
+    (batch bucket, length bucket) instead of once per input shape. The
+    padded positions are masked (or come after the real ones, for causal
+    LMs without attention mask) and cut from the output, so the hidden states
+    of the real tokens are the ones of the eager encoder. Batches longer than
+    the largest bucket run on the eager encoder.
+
+    Backends: "trace" (TorchScript trace) or "compile" (torch.compile).
+    """
+
+    def __init__(self, encoder, backend="trace", length_buckets=DEFAULT_LENGTH_BUCKETS,
+                 pad_id=0, keywords=("input_ids", "token_type_ids", "attention_mask")):
+        if backend not in ("trace", "compile"):
+            raise ValueError("Unrecognized compiled backend: %s." % backend)
+        self.encoder = encoder
+        self.backend = backend
+        self.length_buckets = sorted(length_buckets)
+        self.pad_id = pad_id
+        self.keywords = keywords
+        self.forward = _EncoderForward(encoder, keywords)
+        self.compiled = {}
+        if backend == "compile":
+            self.compiled_forward = torch.compile(self.forward, dynamic=False)
+            # one graph per shape bucket (torch.compile imported torch._dynamo)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, 8 * len(self.length_buckets))
+
+    def reset(self):
+        """Drop the compiled graphs (e.g. after the encoder moved to another device)"""
+        self.compiled = {}
+        if self.backend == "compile":
+            self.compiled_forward = torch.compile(self.forward, dynamic=False)
+
+    def _pad(self, inputs, batch_size, length):
+        padded = []
+        for keyword, tensor in zip(self.keywords, inputs):
+            fill_value = self.pad_id if keyword == "input_ids" else 0
+            padded_tensor = tensor.new_full((batch_size, length), fill_value)
+            padded_tensor[: tensor.shape[0], : tensor.shape[1]] = tensor
+            padded.append(padded_tensor)
+        return padded
+
+    def _get_compiled(self, inputs):
+        key = tuple(inputs[0].shape)
+        if key not in self.compiled:
+            if self.backend == "trace":
+                self.compiled[key] = torch.jit.trace(
+                    self.forward, tuple(inputs), check_trace=False, strict=False)
+            else:
+                self.compiled[key] = self.compiled_forward
+        return self.compiled[key]
+
+    def __call__(self, *inputs):
+        """Last hidden states of the encoder, inputs are given in keywords order"""
+        batch_size, length = inputs[0].shape
+        length_bucket = bucket_size(length, self.length_buckets)
+        if length_bucket is None:
+            return self.forward(*inputs)
+        padded = self._pad(inputs, batch_bucket_size(batch_size), length_bucket)
+        with torch.no_grad():
+            hidden_states = self._get_compiled(padded)(*padded)
+        return hidden_states[:batch_size, :length]
+
+    def warm_up(self, batch_size, device="cpu"):
+        """Compile the graphs of every length bucket for every batch bucket up
+        to batch_size, so that the last partial batches don't compile during
+        the run. Larger batches (e.g. token-budget batches) compile lazily.
+        """
+        batch_buckets = []
+        bucket = 1
+        while bucket <= batch_bucket_size(batch_size):
+            batch_buckets.append(bucket)
+            bucket *= 2
+        if self.backend == "compile":
+            # with room for the graphs of larger batches
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, 2 * len(batch_buckets) * len(self.length_buckets))
+        for bucket in batch_buckets:
+            for length in self.length_buckets:
+                inputs = [
+                    torch.full((bucket, length), self.pad_id if keyword == "input_ids" else 1,
+                               dtype=torch.long, device=device)
+                    for keyword in self.keywords
+                ]
+                self(*inputs)
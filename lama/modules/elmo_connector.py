@@ -4,6 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import logging
 import json
 import torch
 import h5py
@@ -132,7 +133,7 @@ class Elmo(Base_Connector):
         for sentences in sentences_list:
             tokenized_text_list.append(get_text(sentences))
 
-        if logger is not None:
+        if logger is not None and logger.isEnabledFor(logging.DEBUG):
             logger.debug("\n{}\n".format(tokenized_text_list))
 
         # look for masked indices
@@ -14,6 +14,9 @@ from lama.modules.base_connector import *
 
 class GPT2(Base_Connector):
 
+    # see Base_Connector.quantize
+    quantizable = True
+
     def __init__(self, args):
         super().__init__()
 
@@ -28,7 +31,8 @@ class GPT2(Base_Connector):
             #dict_file = gpt_model_name
 
         # Load pre-trained model tokenizer (vocabulary)
-        self.tokenizer = GPT2Tokenizer.from_pretrained(os.path.join(args.data_path, args.tokenizer_dir))
+        with self.startup_phase("tokenizer"):
+            self.tokenizer = GPT2Tokenizer.from_pretrained(os.path.join(args.data_path, args.tokenizer_dir))
 
         # GPT uses different way to represent BPE then BERT. Namely, the
         # final suffixes are indicated with </w> suffix, while pieces that must
@@ -55,7 +59,8 @@ class GPT2(Base_Connector):
         self._init_inverse_vocab()
 
         # Load pre-trained model (weights)
-        self.gpt_model = GPT2LMHeadModel.from_pretrained(gpt_model_name)
+        with self.startup_phase("weights"):
+            self.gpt_model = from_pretrained_mmap(GPT2LMHeadModel, gpt_model_name)
         self.gpt_model.eval()
         # print(self.gpt_model.config)
 
@@ -72,10 +77,22 @@ class GPT2(Base_Connector):
     def _cuda(self):
         self.gpt_model.cuda()
 
+    def _get_output_layer_owner(self):
+        return self.gpt_model, "lm_head"
+
+    def _get_encoder(self):
+        # causal: the padding after the tokens doesn't change their states
+        return self.gpt_model.transformer, ("input_ids",), self.gpt_model.config.n_positions
+
     def get_id(self, string):
         indexed_string = self.tokenizer.encode(f'a {string}')[1:]
         return indexed_string
 
+    def get_ids(self, strings):
+        # same as get_id, in a single tokenizer call
+        batch = self.tokenizer([f'a {string}' for string in strings])
+        return [indexed_string[1:] for indexed_string in batch["input_ids"]]
+
     def __get_input_tensors(self, sentence_list):
         """Concatenates, tokenize and converts a sentences to model inputs.
 
@@ -117,13 +134,36 @@ class GPT2(Base_Connector):
 
         return src_tensor, dst_tensor, masked_indices, tokenized_text
 
-    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+    def encode_sentences(self, sentences):
+        # token ids are the full sequence, BOS included: src/dst are its shifted views
+        src_tensor, dst_tensor, masked_indices, _ = self.__get_input_tensors(sentences)
+        full_indexed_tokens = [self.bos_id] + dst_tensor.tolist()
+        return full_indexed_tokens, [0] * len(full_indexed_tokens), masked_indices
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True, masked_only=False):
         if try_cuda:
             self.try_cuda()
         src_tensor_list, dst_tensor_list, masked_indices_list, _ = zip(*[
             self.__get_input_tensors(sentences) for sentences in sentences_list
         ])
+        return self.__get_batch_generation(
+            src_tensor_list, dst_tensor_list, masked_indices_list, masked_only)
 
+    def get_batch_generation_from_ids(self, encodings, logger=None, try_cuda=True, masked_only=False):
+        if try_cuda:
+            self.try_cuda()
+        src_tensor_list = []
+        dst_tensor_list = []
+        masked_indices_list = []
+        for full_indexed_tokens, _, masked_indices in encodings:
+            full_tokens_tensor = torch.tensor(full_indexed_tokens, dtype=torch.long)
+            src_tensor_list.append(full_tokens_tensor[:-1])
+            dst_tensor_list.append(full_tokens_tensor[1:])
+            masked_indices_list.append(list(masked_indices))
+        return self.__get_batch_generation(
+            src_tensor_list, dst_tensor_list, masked_indices_list, masked_only)
+
+    def __get_batch_generation(self, src_tensor_list, dst_tensor_list, masked_indices_list, masked_only):
         src_tensor_batch = torch.nn.utils.rnn.pad_sequence(
             src_tensor_list, batch_first=True)
 
@@ -134,10 +174,17 @@ class GPT2(Base_Connector):
         # as result some of output "symbols" correspond to positions. To fix
         # that we have to manually remove logits for positions.
         with torch.no_grad():
-            logits = self.gpt_model(src_tensor_batch.to(self._model_device))[0]
+            if masked_only or self.compiled_encoder is not None:
+                # run the transformer, then the LM head (only at the first [MASK] with masked_only)
+                hidden_states = self._encode(src_tensor_batch)
+                if masked_only:
+                    hidden_states = gather_first_masked(hidden_states, masked_indices_list)
+                logits = self.gpt_model.lm_head(hidden_states)
+            else:
+                logits = self.gpt_model(src_tensor_batch.to(self._model_device))[0]
             logits = logits[..., :self.gpt_model.config.vocab_size]
 
-            log_probs = torch.nn.functional.log_softmax(logits, dim=-1).cpu()
+            log_probs = self._log_softmax(logits).cpu()
 
         token_ids_list = [
             np.array(dst_tensor.numpy()) for dst_tensor in dst_tensor_list
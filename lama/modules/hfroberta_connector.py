@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import logging
 import os
 
 from transformers import RobertaTokenizer, RobertaModel, RobertaForMaskedLM
@@ -17,6 +18,8 @@ import torch.nn.functional as F
 
 class HfRoberta(Base_Connector):
 
+    quantizable = True
+
     def __init__(self, args):
         super().__init__()
 
@@ -41,7 +44,8 @@ class HfRoberta(Base_Connector):
             do_lower_case=True
 
         # Load pre-trained model tokenizer (vocabulary)
-        self.tokenizer = RobertaTokenizer.from_pretrained(tokenizer_dir)
+        with self.startup_phase("tokenizer"):
+            self.tokenizer = RobertaTokenizer.from_pretrained(tokenizer_dir)
 
         # original vocab
 
@@ -87,7 +91,8 @@ class HfRoberta(Base_Connector):
         self.mask_symbol = self.tokenizer.decoder[mask_index]
 
         # Load pre-trained model (weights)
-        self.masked_roberta_model = RobertaForMaskedLM.from_pretrained(roberta_model_name)
+        with self.startup_phase("weights"):
+            self.masked_roberta_model = from_pretrained_mmap(RobertaForMaskedLM, roberta_model_name)
         self.masked_roberta_model.eval()
         #print(self.masked_roberta_model.config)
 
@@ -112,6 +117,15 @@ class HfRoberta(Base_Connector):
     def _cuda(self):
         self.masked_roberta_model.cuda()
 
+    def _get_output_layer_owner(self):
+        return self.masked_roberta_model.lm_head, "decoder"
+
+    def _get_encoder(self):
+        config = self.masked_roberta_model.config
+        # the positions start after the padding index
+        max_length = config.max_position_embeddings - config.pad_token_id - 1
+        return self.masked_roberta_model.roberta, ("input_ids", "token_type_ids", "attention_mask"), max_length
+
     def get_id(self, string):
         # tokenize "a " + string, in order to create token_id(s) corresponding to the string.
         # the first token of the string starts with a whitespace.
@@ -120,55 +134,22 @@ class HfRoberta(Base_Connector):
         indexed_string = self.tokenizer.convert_tokens_to_ids(tokenized_text)
         return indexed_string
 
+    def get_ids(self, strings):
+        # same as get_id, in a single tokenizer call
+        batch = self.tokenizer([f'a {string}' for string in strings], add_special_tokens=False)
+        return [indexed_string[1:] for indexed_string in batch["input_ids"]]
+
     def __get_input_tensors_batch(self, sentences_list):
-        tokens_tensors_list = []
-        segments_tensors_list = []
-        masked_indices_list = []
+        encodings = []
         tokenized_text_list = []
-        max_tokens = 0
         for sentences in sentences_list:
-            tokens_tensor, segments_tensor, masked_indices, tokenized_text = self.__get_input_tensors(sentences)
-            tokens_tensors_list.append(tokens_tensor)
-            segments_tensors_list.append(segments_tensor)
-            masked_indices_list.append(masked_indices)
+            indexed_tokens, segment_indices, masked_indices, tokenized_text = self.__get_input_ids(sentences)
+            encodings.append((indexed_tokens, segment_indices, masked_indices))
             tokenized_text_list.append(tokenized_text)
-            # assert(tokens_tensor.shape[1] == segments_tensor.shape[1])
-            if (tokens_tensor.shape[1] > max_tokens):
-                max_tokens = tokens_tensor.shape[1]
-        # print("MAX_TOKENS: {}".format(max_tokens))
-        # apply padding and concatenate tensors
-        # use [PAD] for tokens and 0 for segments
-        final_tokens_tensor = None
-        final_segments_tensor = None
-        final_attention_mask = None
-        for tokens_tensor, segments_tensor in zip(tokens_tensors_list, segments_tensors_list):
-            dim_tensor = tokens_tensor.shape[1]
-            pad_lenght = max_tokens - dim_tensor
-            attention_tensor = torch.full([1,dim_tensor], 1, dtype= torch.long)
-            if pad_lenght>0:
-                pad_1 = torch.full([1,pad_lenght], self.pad_id, dtype= torch.long)
-                pad_2 = torch.full([1,pad_lenght], 0, dtype= torch.long)
-                attention_pad = torch.full([1,pad_lenght], 0, dtype= torch.long)
-                tokens_tensor = torch.cat((tokens_tensor,pad_1), dim=1)
-                segments_tensor = torch.cat((segments_tensor,pad_2), dim=1)
-                attention_tensor = torch.cat((attention_tensor,attention_pad), dim=1)
-            if final_tokens_tensor is None:
-                final_tokens_tensor = tokens_tensor
-                final_segments_tensor = segments_tensor
-                final_attention_mask = attention_tensor
-            else:
-                final_tokens_tensor = torch.cat((final_tokens_tensor,tokens_tensor), dim=0)
-                final_segments_tensor = torch.cat((final_segments_tensor,segments_tensor), dim=0)
-                final_attention_mask = torch.cat((final_attention_mask,attention_tensor), dim=0)
-        # print(final_tokens_tensor)
-        # print(final_segments_tensor)
-        # print(final_attention_mask)
-        # print(final_tokens_tensor.shape)
-        # print(final_segments_tensor.shape)
-        # print(final_attention_mask.shape)
-        return final_tokens_tensor, final_segments_tensor, final_attention_mask, masked_indices_list, tokenized_text_list
-
-    def __get_input_tensors(self, sentences):
+        tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list = collate_token_ids(encodings, self.pad_id)
+        return tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, tokenized_text_list
+
+    def __get_input_ids(self, sentences):
         tokenized_text = []
         masked_indices = []
         segment_indices = []
@@ -207,32 +188,59 @@ class HfRoberta(Base_Connector):
 
         indexed_tokens = self.tokenizer.convert_tokens_to_ids(tokenized_text)
 
-        # Convert inputs to PyTorch tensors
-        tokens_tensor = torch.tensor([indexed_tokens])
-        segments_tensors = torch.tensor([segment_indices])
+        return indexed_tokens, segment_indices, masked_indices, tokenized_text
 
-        return tokens_tensor, segments_tensors, masked_indices, tokenized_text
+    def encode_sentences(self, sentences):
+        indexed_tokens, segment_indices, masked_indices, _ = self.__get_input_ids(sentences)
+        return indexed_tokens, segment_indices, masked_indices
 
 
-    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True, masked_only=False):
         if not sentences_list:
             return None
         if try_cuda:
             self.try_cuda()
-        #print(sentences_list)
-        tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, tokenized_text_list = self.__get_input_tensors_batch(sentences_list)
+        # print(sentences_list)
+        tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, tokenized_text_list = self.__get_input_tensors_batch(
+            sentences_list)
 
-        if logger is not None:
+        if logger is not None and logger.isEnabledFor(logging.DEBUG):
             logger.debug("\n{}\n".format(tokenized_text_list))
 
+        return self.__get_batch_generation(
+            tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, masked_only)
+
+    def get_batch_generation_from_ids(self, encodings, logger=None, try_cuda=True, masked_only=False):
+        if not encodings:
+            return None
+        if try_cuda:
+            self.try_cuda()
+        tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list = collate_token_ids(encodings, self.pad_id)
+
+        if logger is not None and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\n{}\n".format(
+                [self.tokenizer.convert_ids_to_tokens(list(x[0])) for x in encodings]))
+
+        return self.__get_batch_generation(
+            tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list, masked_only)
+
+    def __get_batch_generation(self, tokens_tensor, segments_tensor, attention_mask_tensor, masked_indices_list,
+                               masked_only):
         with torch.no_grad():
-            logits = self.masked_roberta_model(
-                input_ids=tokens_tensor.to(self._model_device),
-                token_type_ids=segments_tensor.to(self._model_device),
-                attention_mask=attention_mask_tensor.to(self._model_device),
-            )[0]
+            if masked_only or self.compiled_encoder is not None:
+                # run the encoder, then the LM head (only at the first [MASK] with masked_only)
+                hidden_states = self._encode(tokens_tensor, segments_tensor, attention_mask_tensor)
+                if masked_only:
+                    hidden_states = gather_first_masked(hidden_states, masked_indices_list)
+                logits = self.masked_roberta_model.lm_head(hidden_states)
+            else:
+                logits = self.masked_roberta_model(
+                    input_ids=tokens_tensor.to(self._model_device),
+                    token_type_ids=segments_tensor.to(self._model_device),
+                    attention_mask=attention_mask_tensor.to(self._model_device),
+                )[0]
 
-            log_probs = F.log_softmax(logits, dim=-1).cpu()
+            log_probs = self._log_softmax(logits).cpu()
 
         token_ids_list = []
         for indexed_string in tokens_tensor.numpy():
@@ -7,6 +7,13 @@
 import argparse
 
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("expected a positive integer, got {}".format(value))
+    return value
+
+
 def get_general_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -43,6 +50,31 @@ def get_general_parser():
         default=100,
         help="max sentence lenght",
     )
+    parser.add_argument(
+        "--quantize",
+        dest="quantize",
+        choices=["int8"],
+        default=None,
+        help="dynamic int8 quantization of the linear layers after loading, for "
+        "CPU inference (HfRoBERTa, HfLuke, CoLAKE and GPT-2)",
+    )
+    parser.add_argument(
+        "--compile-forward",
+        dest="compile_forward",
+        choices=["trace", "compile"],
+        default=None,
+        help="run the encoder traced with TorchScript (trace) or with torch.compile "
+        "(compile), on inputs padded to --compile-buckets; the graphs of batches of up "
+        "to --batch-size samples are compiled when the model is loaded, larger batches "
+        "(with --max-tokens) on their first use (HfRoBERTa, HfLuke, CoLAKE and GPT-2)",
+    )
+    parser.add_argument(
+        "--compile-buckets",
+        dest="compile_buckets",
+        default="16,32,64,128,256,512",
+        help="comma separated input lengths of the compiled forward, longer inputs "
+        "run on the eager model",
+    )
     __add_bert_args(parser)
     __add_elmo_args(parser)
     __add_gpt_args(parser)
@@ -67,6 +99,73 @@ def get_eval_generation_parser():
     return parser
 
 
+def get_probe_server_parser():
+    parser = get_general_parser()
+    parser.add_argument(
+        "--host", dest="host", default="127.0.0.1", help="address to listen on"
+    )
+    parser.add_argument(
+        "--port", dest="port", type=int, default=8765, help="port to listen on"
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        default=None,
+        help="listen on this Unix socket instead of --host and --port",
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=32,
+        help="maximum number of samples, of one or several requests, run through a "
+        "model at once",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        dest="max_wait_ms",
+        type=float,
+        default=5.0,
+        help="time a batch waits for the samples of other requests before running",
+    )
+    parser.add_argument(
+        "--topk", dest="topk", type=int, default=10, help="default number of predictions returned"
+    )
+    parser.add_argument(
+        "--vocab-subset-cache",
+        dest="vocab_subset_cache_size",
+        type=int,
+        default=16,
+        help="number of request vocab subsets kept indexed per model",
+    )
+    parser.add_argument(
+        "--verbose", dest="verbose", action="store_true", help="log every request"
+    )
+    # the model paths that run_experiments sets for every LM
+    parser.add_argument(
+        "--data-path",
+        dest="data_path",
+        default="",
+        help="directory the model directories are relative to",
+    )
+    parser.add_argument(
+        "--tokenizer-dir", dest="tokenizer_dir", default=None, help="tokenizer directory"
+    )
+    parser.add_argument(
+        "--colake-model-dir", dest="colake_model_dir", default=None, help="CoLAKE checkpoint"
+    )
+    parser.add_argument(
+        "--luke-model-dir", dest="luke_model_dir", default=None, help="LUKE model directory"
+    )
+    parser.add_argument(
+        "--luke-model-name",
+        dest="luke_model_name",
+        default="studio-ousia/luke-base",
+        help="name of the LUKE pretrained model",
+    )
+    return parser
+
+
 def get_eval_KB_completion_parser():
     parser = get_general_parser()
     parser.add_argument(
@@ -91,6 +190,14 @@ def get_eval_KB_completion_parser():
     parser.add_argument(
         "--batch-size", dest="batch_size", type=int, default=32, help="batch size"
     )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        type=int,
+        default=None,
+        help="batch the samples by tokenized length, up to this number of padded "
+        "tokens per batch (overrides --batch-size)",
+    )
     parser.add_argument(
         "--lowercase",
         "--lower",
@@ -103,7 +210,136 @@ def get_eval_KB_completion_parser():
         dest="threads",
         type=int,
         default=-1,
-        help="number of threads for evaluation metrics computation (defaults: all available)",
+        help="number of threads for evaluation metrics computation in interactive mode "
+        "(defaults: all available)",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        dest="intra_op_threads",
+        type=int,
+        default=0,
+        help="torch threads of every model forward (defaults: the torch default, "
+        "or the cores divided between the --replicas with an OpenMP build of torch; "
+        "otherwise the replicas share the threads of the process)",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        dest="inter_op_threads",
+        type=int,
+        default=0,
+        help="torch inter-op threads (defaults: the torch default)",
+    )
+    parser.add_argument(
+        "--replicas",
+        dest="replicas",
+        type=int,
+        default=1,
+        help="number of batches run through the model at once, each on its own thread "
+        "with --intra-op-threads threads; the replicas share the weights (implies "
+        "--pipeline)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        help="run tokenization, the model and the ranking as overlapping stages "
+        "on separate threads (ignored with --interactive)",
+    )
+    parser.add_argument(
+        "--pipeline-queue-size",
+        dest="pipeline_queue_size",
+        type=int,
+        default=2,
+        help="number of batches buffered between two pipeline stages",
+    )
+    parser.add_argument(
+        "--masked-only",
+        dest="masked_only",
+        action="store_true",
+        help="apply the LM head and softmax only at the first [MASK] of every sample "
+        "(ignored with --interactive)",
+    )
+    parser.add_argument(
+        "--subset-output-layer",
+        dest="subset_output_layer",
+        choices=["full", "subset"],
+        default=None,
+        help="with --common-vocab-filename, compute only the logits of the common "
+        "vocabulary and normalize them over the subset (subset, faster); full still "
+        "computes all the logits to normalize over the full vocabulary and only exists "
+        "to check parity with the default head (ignored with --interactive)",
+    )
+    parser.add_argument(
+        "--probe-shard-dir",
+        dest="probe_shard_dir",
+        default=None,
+        help="directory of the pre-tokenized probe shards: the first run compiles "
+        "the shard of a relation, the following runs skip tokenization",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        dest="checkpoint_every",
+        type=int,
+        default=0,
+        help="save the results accumulated so far every this number of batches, "
+        "a rerun in the same --full-logdir resumes from the last checkpoint "
+        "(default: 0, no checkpoints)",
+    )
+    parser.add_argument(
+        "--result-format",
+        dest="result_format",
+        choices=["columnar", "pickle"],
+        default="columnar",
+        help="columnar: per-sample arrays in the results directory of the log "
+        "directory, see lama.result_store; pickle: the legacy result.pkl",
+    )
+    parser.add_argument(
+        "--result-topk",
+        dest="result_topk",
+        type=positive_int,
+        default=10,
+        help="number of top predictions stored for every sample in the results "
+        "directory (default: 10); the legacy result.pkl keeps the top 10000",
+    )
+    parser.add_argument(
+        "--quantize-parity-samples",
+        dest="quantize_parity_samples",
+        type=int,
+        default=100,
+        help="with --quantize, compare the P@1 and MRR of the quantized model and of "
+        "the float model on this number of samples of the first relation evaluated, "
+        "the report is written to quantization_parity.json in its log directory; the "
+        "float model is freed right after (0: no report)",
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        choices=["debug", "info", "warning"],
+        default="debug",
+        help="level of info.log, the messages below it are not even built "
+        "(debug: the tokenized batches, info: the predictions)",
+    )
+    parser.add_argument(
+        "--log-predictions-every",
+        dest="log_predictions_every",
+        type=int,
+        default=1,
+        help="log the top predictions of every N-th sample only (0: none)",
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        dest="log_max_bytes",
+        type=int,
+        default=0,
+        help="rotate info.log at this size, the previous logs are gzipped "
+        "(default: 0, no rotation)",
+    )
+    parser.add_argument(
+        "--log-backups",
+        dest="log_backups",
+        type=int,
+        default=5,
+        help="number of rotated logs kept with --log-max-bytes",
     )
     return parser
 
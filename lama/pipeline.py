@@ -0,0 +1,137 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import queue
+import sys
+import threading
+
+_DONE = object()
+
+
+class _Failure():
+    # exception raised by a stage, handed down to the consumer
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def run_stages(items, stages, pipelined=True, queue_size=2, workers=None):
+    """Apply a chain of stages to every item, in order
+
+    With pipelined=True every stage runs on its own thread and the stages are
+    connected by bounded queues of queue_size items, so stage k can work on
+    item i while stage k + 1 works on item i - 1 (e.g. tokenize the next
+    batch while the model runs on the current one). Otherwise the stages run
+    one after the other on the calling thread.
+
+    A stage given several workers runs on that many threads, each taking
+    the next item (e.g. model replicas working on different batches); the
+    items may then reach the next stages out of order, but they are still
+    yielded in the input order.
+
+    Args:
+        items: iterable of inputs of the first stage.
+        stages: list of functions, each taking the output of the previous one.
+        workers: number of threads of every stage (defaults: 1 each), only
+            used with pipelined=True.
+
+    Yields:
+        The output of the last stage for every item, in the input order.
+        An exception raised by a stage is re-raised in the caller.
+    """
+    if not pipelined or not stages:
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+
+    if workers is None:
+        workers = [1] * len(stages)
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    # workers of every stage still running, the last one hands _DONE down
+    running = list(workers)
+    lock = threading.Lock()
+
+    def put(q, item):
+        # give up if the consumer went away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed():
+        try:
+            for i, item in enumerate(items):
+                if not put(queues[0], (i, item)):
+                    return
+        except Exception:
+            put(queues[0], _Failure(sys.exc_info()))
+            return
+        put(queues[0], _DONE)
+
+    def work(k, stage, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if isinstance(item, _Failure):
+                put(q_out, item)
+                return
+            if item is _DONE:
+                with lock:
+                    running[k] -= 1
+                    last = running[k] == 0
+                # the other workers of the stage stop on _DONE too
+                put(q_in if not last else q_out, _DONE)
+                return
+            i, item = item
+            try:
+                item = stage(item)
+            except Exception:
+                put(q_out, _Failure(sys.exc_info()))
+                return
+            if not put(q_out, (i, item)):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for k, stage in enumerate(stages):
+        for _ in range(workers[k]):
+            threads.append(threading.Thread(
+                target=work, args=(k, stage, queues[k], queues[k + 1]), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        # items finished ahead of the next one in order
+        pending = {}
+        next_index = 0
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc_info[1].with_traceback(item.exc_info[2])
+            i, item = item
+            pending[i] = item
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+    finally:
+        stop.set()
+        # unblock the stages waiting on a full queue or an empty one
+        for q in queues:
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                q.put_nowait(_DONE)
+            except queue.Full:
+                pass
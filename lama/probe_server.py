@@ -0,0 +1,407 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Local server keeping language models loaded between probes:
+#
+#   python -m lama.probe_server --lm hfroberta --port 8765
+#   curl -s localhost:8765/probe -d '{"sentences": ["Paris is the capital of [MASK] ."],
+#                                     "labels": ["France"], "topk": 5}'
+#
+# or, on a Unix socket, python -m lama.probe_server --lm hfroberta --socket /tmp/lama.sock
+# and request_probe(payload, socket_path="/tmp/lama.sock").
+#
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import torch
+
+import lama.evaluation_metrics as metrics
+import lama.modules.base_connector as base
+import lama.options as options
+
+
+# stops the worker thread of a ProbeBatcher
+_CLOSE = object()
+
+
+class _Probe():
+    # samples of a request waiting for their log probabilities
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.log_probs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ProbeBatcher():
+    """Runs the probes of concurrent requests through a model in shared batches
+
+    Requests submit their samples and wait. A worker thread takes the
+    pending samples, up to max_batch_size of them (waiting at most max_wait
+    seconds for more after the first one), and runs them through the model
+    as a single masked_only batch.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_batches = 0
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences_list):
+        """Log probabilities at the first [MASK] of every sample
+
+        Args:
+            sentences_list: list of samples, each a list of sentences.
+
+        Returns:
+            A tensor [len(sentences_list), vocab_size], once computed.
+        """
+        probes = [
+            _Probe(sentences_list[start:start + self.max_batch_size])
+            for start in range(0, len(sentences_list), self.max_batch_size)
+        ]
+        for probe in probes:
+            self.pending.put(probe)
+        for probe in probes:
+            probe.done.wait()
+            if probe.error is not None:
+                raise probe.error
+        return torch.cat([probe.log_probs for probe in probes])
+
+    def close(self):
+        self.pending.put(_CLOSE)
+        self.thread.join()
+
+    def _run(self):
+        carried = None
+        while True:
+            probe = carried if carried is not None else self.pending.get()
+            carried = None
+            if probe is _CLOSE:
+                return
+            probes = [probe]
+            size = len(probe.samples)
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    probe = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if probe is _CLOSE or size + len(probe.samples) > self.max_batch_size:
+                    # run it (or stop) after this batch
+                    carried = probe
+                    break
+                probes.append(probe)
+                size += len(probe.samples)
+            self._forward(probes)
+
+    def _forward(self, probes):
+        sentences_list = [sentences for probe in probes for sentences in probe.samples]
+        try:
+            try:
+                encodings = [self.model.encode_sentences(sentences) for sentences in sentences_list]
+                log_probs, _, _ = self.model.get_batch_generation_from_ids(encodings, masked_only=True)
+            except NotImplementedError:
+                log_probs, _, _ = self.model.get_batch_generation(sentences_list, masked_only=True)
+            self.num_batches += 1
+        except Exception as e:
+            for probe in probes:
+                probe.error = e
+                probe.done.set()
+            return
+        start = 0
+        for probe in probes:
+            probe.log_probs = log_probs[start:start + len(probe.samples)]
+            start += len(probe.samples)
+            probe.done.set()
+
+
+class ProbeServer():
+    """Loaded models answering probe requests, see probe"""
+
+    def __init__(self, models, max_batch_size=32, max_wait=0.005, topk=10, vocab_subset_cache_size=16):
+        self.models = models
+        self.topk = topk
+        # every client vocab subset builds an index, keep only the recent ones
+        for model in models.values():
+            model.vocab_subset_cache_size = vocab_subset_cache_size
+        self.batchers = {
+            name: ProbeBatcher(model, max_batch_size=max_batch_size, max_wait=max_wait)
+            for name, model in models.items()
+        }
+        # the label and vocab subset caches of the models are not thread-safe
+        self.locks = {name: threading.Lock() for name in models}
+
+    def warm_up(self):
+        """Run a probe through every model, so that the first request doesn't
+        pay for the initializations done on the first call"""
+        for name in self.models:
+            self.probe({"model": name, "sentences": ["{} .".format(base.MASK)], "labels": ["."]})
+
+    def describe(self):
+        return {
+            "models": {
+                name: {"connector": type(model).__name__, "vocab_size": len(model.vocab)}
+                for name, model in self.models.items()
+            }
+        }
+
+    def probe(self, request):
+        """Rank the predictions of a model for a batch of masked samples
+
+        Args:
+            request: dict with the "sentences" of every sample (a string or a
+                list of sentences, with a [MASK]), and optionally the "model"
+                (needed if the server holds several), the object "labels" of
+                the samples, the number of "topk" predictions and a
+                "vocab_subset" (list of words) to rank in.
+
+        Returns:
+            A dict with the top "predictions" (token, log_prob) of every
+            sample and, with labels, the "ranks" and "label_log_probs" of the
+            labels (None for labels that are not single tokens of the
+            vocabulary or subset) and the "metrics" over the ranked samples.
+
+        Raises:
+            ValueError: if the request is malformed.
+        """
+        name = request.get("model")
+        if name is None and len(self.models) == 1:
+            [name] = self.models
+        if name not in self.models:
+            raise ValueError("unknown model: {} (available: {})".format(name, ", ".join(self.models)))
+        model = self.models[name]
+
+        sentences_list = request.get("sentences")
+        if not isinstance(sentences_list, list) or not sentences_list:
+            raise ValueError("sentences must be a non empty list")
+        sentences_list = [[s] if isinstance(s, str) else s for s in sentences_list]
+        if not all(isinstance(sentences, list) for sentences in sentences_list):
+            raise ValueError("every sample must be a sentence or a list of sentences")
+        for sentences in sentences_list:
+            if not all(isinstance(sentence, str) for sentence in sentences):
+                raise ValueError("sentences must be strings: {}".format(sentences))
+            if not any(base.MASK in sentence for sentence in sentences):
+                raise ValueError("no {} in sample: {}".format(base.MASK, sentences))
+        labels = request.get("labels")
+        if labels is not None:
+            if not isinstance(labels, list) or len(labels) != len(sentences_list):
+                raise ValueError("expected one label per sample")
+            if not all(isinstance(label, str) for label in labels):
+                raise ValueError("labels must be strings")
+        topk = request.get("topk", self.topk)
+        if isinstance(topk, bool) or not isinstance(topk, int) or topk < 1:
+            raise ValueError("topk must be a positive integer, got {!r}".format(topk))
+        vocab_subset = request.get("vocab_subset")
+        if vocab_subset is not None and (
+                not isinstance(vocab_subset, list) or not all(isinstance(word, str) for word in vocab_subset)):
+            raise ValueError("vocab_subset must be a list of words")
+
+        index = None
+        label_table = None
+        with self.locks[name]:
+            if vocab_subset:
+                index = model.get_vocab_subset_index(vocab_subset)
+            if labels is not None:
+                label_table = model.get_label_table(labels, vocab_subset=index)
+
+        log_probs = self.batchers[name].submit(sentences_list)
+        if index is not None:
+            log_probs = model.filter_logprobs(log_probs, index.indices)
+
+        topk_log_probs, topk_indices = torch.topk(log_probs, k=min(topk, log_probs.shape[1]), dim=1)
+        topk_ids = topk_indices.numpy()
+        if index is not None:
+            topk_ids = index.to_model(topk_ids)
+        response = {
+            "model": name,
+            "predictions": [
+                [
+                    {"token": model.vocab[token_id], "log_prob": float(log_prob)}
+                    for token_id, log_prob in zip(sample_ids, sample_log_probs)
+                ]
+                for sample_ids, sample_log_probs in zip(topk_ids.tolist(), topk_log_probs.tolist())
+            ],
+        }
+        if labels is not None:
+            response.update(self._rank_labels(model, labels, label_table, index, log_probs))
+        return response
+
+    def _rank_labels(self, model, labels, label_table, index, log_probs):
+        rows = []
+        label_indices = []
+        for row, label in enumerate(labels):
+            obj_label = label_table[label]
+            if obj_label.single_token and (index is None or obj_label.in_subset):
+                rows.append(row)
+                label_indices.append(obj_label.token_ids[0])
+        ranks = [None] * len(labels)
+        label_log_probs = [None] * len(labels)
+        scores = {"num_ranked": len(rows)}
+        if rows:
+            if index is not None:
+                label_indices = index.to_subset(label_indices)
+            ranking = metrics.get_ranking_batch(log_probs[rows], None, label_indices)
+            for k, row in enumerate(rows):
+                ranks[row] = int(ranking["rank"][k])
+                label_log_probs[row] = float(ranking["PERPLEXITY"][k])
+            scores.update(
+                P_AT_1=float(ranking["P_AT_1"].mean()),
+                P_AT_10=float(ranking["P_AT_X"].mean()),
+                MRR=float(ranking["MRR"].mean()),
+            )
+        return {"ranks": ranks, "label_log_probs": label_log_probs, "metrics": scores}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class _ProbeHandler(http.server.BaseHTTPRequestHandler):
+    # GET /models, GET /health, POST /probe with a JSON request
+
+    def do_GET(self):
+        if self.path == "/models":
+            self._reply(200, self.server.probe_server.describe())
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/probe":
+            self._reply(404, {"error": "unknown path: {}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            response = self.server.probe_server.probe(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            self._reply(500, {"error": "{}: {}".format(type(e).__name__, e)})
+        else:
+            self._reply(200, response)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # the clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a socket file left by a previous server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def make_http_server(probe_server, host="127.0.0.1", port=8765, socket_path=None, verbose=False):
+    """HTTP server answering with probe_server, on host:port or on the Unix
+    socket socket_path; call serve_forever() to run it"""
+    if socket_path is not None:
+        server = _UnixHTTPServer(socket_path, _ProbeHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), _ProbeHandler)
+    server.probe_server = probe_server
+    server.verbose = verbose
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_probe(payload=None, host="127.0.0.1", port=8765, socket_path=None, path="/probe",
+                  timeout=None):
+    """Send a request to a probe server: POST payload to path, or GET path
+    if payload is None
+
+    Raises:
+        RuntimeError: with the error message of the server.
+    """
+    if socket_path is not None:
+        connection = _UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        if payload is None:
+            connection.request("GET", path)
+        else:
+            connection.request(
+                "POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        body = json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError("probe server error {}: {}".format(response.status, body["error"]))
+    return body
+
+
+def main(args):
+    from lama.modules import build_model_by_name
+
+    models = {lm: build_model_by_name(lm, args) for lm in args.models_names}
+    probe_server = ProbeServer(
+        models, max_batch_size=args.batch_size, max_wait=args.max_wait_ms / 1000.0, topk=args.topk,
+        vocab_subset_cache_size=args.vocab_subset_cache_size)
+    probe_server.warm_up()
+    server = make_http_server(
+        probe_server, host=args.host, port=args.port, socket_path=args.socket, verbose=args.verbose)
+    print("serving {} on {}".format(
+        ", ".join(models), args.socket if args.socket else "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        probe_server.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    parser = options.get_probe_server_parser()
+    args = options.parse_args(parser)
+    main(args)
@@ -0,0 +1,193 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+SHARD_FORMAT_VERSION = 2
+
+# flat arrays of a shard, row i spans offsets[i]:offsets[i + 1]
+SHARD_ARRAYS = [
+    "token_ids",
+    "segment_ids",
+    "offsets",
+    "masked_indices",
+    "mask_offsets",
+    "label_ids",
+]
+
+
+def shard_key(model, dataset_filename, template="", lowercase=False,
+              max_sentence_length=None, vocab_subset_index=None):
+    """Key of the shard compiled for a relation file
+
+    The key covers everything that changes the tokenized probes: the
+    tokenizer, the relation file (path, size and modification time), the
+    template, lowercasing and the filters applied by filter_samples.
+    Returns None if the relation file can not be found.
+    """
+    try:
+        stat = os.stat(dataset_filename)
+    except (OSError, TypeError):
+        return None
+    h = hashlib.sha1()
+    for field in [
+        SHARD_FORMAT_VERSION,
+        model.tokenizer_signature(),
+        os.path.abspath(dataset_filename),
+        stat.st_size,
+        stat.st_mtime_ns,
+        template or "",
+        bool(lowercase),
+        max_sentence_length,
+    ]:
+        h.update(str(field).encode("utf-8"))
+        h.update(b"\0")
+    if vocab_subset_index is not None:
+        h.update(vocab_subset_index.subset_to_model.tobytes())
+    return h.hexdigest()[:16]
+
+
+class ProbeShard():
+    """Pre-tokenized probes of a relation, memory-mapped from disk
+
+    A shard holds the encode_sentences output and the object label id of
+    every sample, so reruns skip tokenization. Rows are looked up by uuid.
+    from_samples builds the same arrays in memory, without writing them.
+    """
+
+    def __init__(self, path, arrays, uuids):
+        self.path = path
+        self.token_ids = arrays["token_ids"]
+        self.segment_ids = arrays["segment_ids"]
+        self.offsets = arrays["offsets"]
+        self.masked_indices = arrays["masked_indices"]
+        self.mask_offsets = arrays["mask_offsets"]
+        self.label_ids = arrays["label_ids"]
+        self.uuids = uuids
+        self.rows = {uuid: row for row, uuid in enumerate(uuids)}
+
+    @classmethod
+    def load(cls, path):
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in SHARD_ARRAYS
+        }
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != SHARD_FORMAT_VERSION:
+            raise ValueError("unsupported probe shard version: {}".format(meta["version"]))
+        return cls(path, arrays, meta["uuids"])
+
+    @classmethod
+    def from_samples(cls, model, samples, label_table=None):
+        """Tokenize the samples with the model into an in-memory shard"""
+        arrays, meta = encode_samples(model, samples, label_table=label_table)
+        return cls(None, arrays, meta["uuids"])
+
+    @classmethod
+    def compile(cls, path, model, samples, label_table=None):
+        """Tokenize the samples with the model and write the shard to path"""
+        arrays, meta = encode_samples(model, samples, label_table=label_table)
+
+        # write the shard next to its final location, then move it in place
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run compiled the same shard in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls.load(path)
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def __contains__(self, uuid):
+        return uuid in self.rows
+
+    def encoding(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        mask_start, mask_end = self.mask_offsets[row], self.mask_offsets[row + 1]
+        return (
+            self.token_ids[start:end].tolist(),
+            self.segment_ids[start:end].tolist(),
+            self.masked_indices[mask_start:mask_end].tolist(),
+        )
+
+    def encodings(self, samples):
+        return [self.encoding(self.rows[sample["uuid"]]) for sample in samples]
+
+    def token_lengths(self, samples):
+        lengths = np.diff(self.offsets)
+        return [int(lengths[self.rows[sample["uuid"]]]) for sample in samples]
+
+
+def encode_samples(model, samples, label_table=None):
+    """Tokenize the samples with the model into the arrays of a shard"""
+    token_ids = []
+    segment_ids = []
+    offsets = [0]
+    masked_indices = []
+    mask_offsets = [0]
+    label_ids = []
+    for sample in samples:
+        sample_token_ids, sample_segment_ids, sample_masked_indices = model.encode_sentences(
+            sample["masked_sentences"]
+        )
+        token_ids.extend(sample_token_ids)
+        segment_ids.extend(sample_segment_ids)
+        offsets.append(len(token_ids))
+        masked_indices.extend(sample_masked_indices)
+        mask_offsets.append(len(masked_indices))
+        label_id = -1
+        if label_table is not None:
+            obj_label = label_table[sample["obj_label"]]
+            if obj_label.single_token:
+                label_id = obj_label.token_ids[0]
+        label_ids.append(label_id)
+
+    segment_ids = np.asarray(segment_ids, dtype=np.int64)
+    if len(segment_ids) and (segment_ids.min() < 0 or segment_ids.max() > np.iinfo(np.int16).max):
+        raise ValueError("segment ids out of the int16 range of a probe shard")
+    arrays = dict(
+        token_ids=np.asarray(token_ids, dtype=np.int32),
+        segment_ids=segment_ids.astype(np.int16),
+        offsets=np.asarray(offsets, dtype=np.int64),
+        masked_indices=np.asarray(masked_indices, dtype=np.int32),
+        mask_offsets=np.asarray(mask_offsets, dtype=np.int64),
+        label_ids=np.asarray(label_ids, dtype=np.int32),
+    )
+    meta = dict(
+        version=SHARD_FORMAT_VERSION,
+        num_samples=len(samples),
+        uuids=[sample["uuid"] for sample in samples],
+    )
+    return arrays, meta
+
+
+def load_or_compile_shard(shard_dir, key, model, samples, label_table=None, logger=None):
+    """Load the shard stored under key in shard_dir, compiling it first if needed"""
+    path = os.path.join(shard_dir, key)
+    if os.path.isdir(path):
+        try:
+            shard = ProbeShard.load(path)
+            if all(sample["uuid"] in shard for sample in samples):
+                return shard
+        except (OSError, ValueError, KeyError) as e:
+            if logger is not None:
+                logger.warning("could not load probe shard {}: {}".format(path, e))
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(shard_dir, exist_ok=True)
+    return ProbeShard.compile(path, model, samples, label_table=label_table)
@@ -0,0 +1,91 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import multiprocessing
+import queue
+import traceback
+
+import torch
+
+
+def threads_per_worker(num_workers):
+    # split the cores between the workers instead of oversubscribing them
+    return max(1, multiprocessing.cpu_count() // max(1, num_workers))
+
+
+def _work(func, tasks, results, num_threads):
+    torch.set_num_threads(num_threads)
+    while True:
+        i = tasks.get()
+        if i is None:
+            return
+        try:
+            results.put((i, func(i), None))
+        except Exception:
+            results.put((i, None, traceback.format_exc()))
+
+
+def run_in_workers(func, num_items, num_workers, num_threads=None):
+    """Call func(i) for every i in range(num_items) on a pool of processes
+
+    The workers are forked from the calling process, so they share its
+    memory copy-on-write: models built before the call (ideally moved to
+    shared memory with share_memory()) are not copied per worker. Every
+    worker pulls item indices from a queue and runs torch with num_threads
+    threads (defaults: the cores divided between the workers). The models
+    must still be on CPU when the workers are forked.
+
+    Falls back to calling func on the calling process if num_workers < 2 or
+    the platform can't fork.
+
+    Yields:
+        (i, func(i)) in completion order. An exception raised by func, or a
+        worker dying, is re-raised in the caller as a RuntimeError.
+    """
+    if num_workers < 2 or "fork" not in multiprocessing.get_all_start_methods():
+        for i in range(num_items):
+            yield i, func(i)
+        return
+
+    if num_threads is None:
+        num_threads = threads_per_worker(num_workers)
+    context = multiprocessing.get_context("fork")
+    tasks = context.Queue()
+    results = context.Queue()
+    for i in range(num_items):
+        tasks.put(i)
+    num_workers = min(num_workers, num_items)
+    for _ in range(num_workers):
+        tasks.put(None)
+
+    workers = [
+        context.Process(target=_work, args=(func, tasks, results, num_threads), daemon=True)
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for _ in range(num_items):
+            while True:
+                try:
+                    i, result, error = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    dead = [w for w in workers if w.exitcode not in (None, 0)]
+                    if dead:
+                        raise RuntimeError(
+                            "worker {} died with exit code {}".format(dead[0].pid, dead[0].exitcode))
+            if error is not None:
+                raise RuntimeError("item {} failed in a worker:\n{}".format(i, error))
+            yield i, result
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
@@ -0,0 +1,218 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+RESULT_FORMAT_VERSION = 1
+
+# name -> (dtype, True if the column has one value per top-k prediction)
+RESULT_COLUMNS = {
+    "label_ids": (np.int32, False),
+    "ranks": (np.int32, False),
+    "label_log_probs": (np.float32, False),
+    "judgements": (np.int8, False),
+    "topk_ids": (np.int32, True),
+    "topk_log_probs": (np.float16, True),
+}
+
+# only written for the negated probes
+NEGATION_COLUMNS = {
+    "spearman": (np.float32, False),
+    "overlap": (np.float32, False),
+}
+
+# values of the judgements column (Google-RE only)
+JUDGEMENTS = {None: -1, "negative": 0, "positive": 1}
+
+
+class ResultWriter():
+    """Append-only writer of the columnar results of a run
+
+    The results are a directory with one .npy file per column, a
+    uuids.jsonl file and a meta.json file. Every append writes the rows of a
+    batch to raw column files; close turns them into .npy files and moves
+    the directory in place, so a crash never leaves a half-written result.
+
+    Rows hold the label id and rank (0 if the label is not ranked), the label
+    log probability, the Google-RE judgement (see JUDGEMENTS) and the ids and
+    log probabilities (float16) of the topk predictions, padded with -1 and
+    -inf. The ids are in the vocabulary of the model.
+    """
+
+    def __init__(self, path, topk, negated=False, state=None):
+        self.path = path
+        self.topk = topk
+        self.columns = dict(RESULT_COLUMNS)
+        if negated:
+            self.columns.update(NEGATION_COLUMNS)
+        self.num_rows = 0
+
+        # rows are appended to path.partial until close
+        self.tmp_path = path + ".partial"
+        column_paths = {name: os.path.join(self.tmp_path, name + ".bin") for name in self.columns}
+        uuids_path = os.path.join(self.tmp_path, "uuids.jsonl")
+        if state is not None:
+            if state["topk"] != topk or set(state["sizes"]) != set(self.columns) | {"uuids"}:
+                raise ValueError("the checkpoint has other columns")
+            # resume from a checkpoint, dropping the rows appended after it
+            for name, column_path in column_paths.items():
+                os.truncate(column_path, state["sizes"][name])
+            os.truncate(uuids_path, state["sizes"]["uuids"])
+            self.num_rows = state["num_rows"]
+        else:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            os.makedirs(self.tmp_path)
+        self.files = {name: open(column_path, "ab") for name, column_path in column_paths.items()}
+        self.uuids_file = open(uuids_path, "a")
+
+    def append(self, uuids, **columns):
+        """Append the rows of a batch, one array (or list) per column"""
+        if len(uuids) == 0:
+            return
+        for name, (dtype, per_prediction) in self.columns.items():
+            array = np.asarray(columns[name])
+            if per_prediction:
+                array = self._pad_topk(array.reshape(len(uuids), -1), dtype)
+            self.files[name].write(array.astype(dtype, copy=False).tobytes())
+        for uuid in uuids:
+            self.uuids_file.write(json.dumps(uuid) + "\n")
+        self.num_rows += len(uuids)
+
+    def _pad_topk(self, array, dtype):
+        array = array[:, : self.topk]
+        if array.shape[1] < self.topk:
+            fill = -1 if np.issubdtype(dtype, np.integer) else -np.inf
+            padded = np.full((array.shape[0], self.topk), fill, dtype=dtype)
+            padded[:, : array.shape[1]] = array
+            array = padded
+        return array
+
+    def checkpoint(self):
+        """Flush the rows appended so far to disk
+
+        Returns:
+            The state to resume from, see __init__.
+        """
+        sizes = {}
+        for name, f in list(self.files.items()) + [("uuids", self.uuids_file)]:
+            f.flush()
+            os.fsync(f.fileno())
+            sizes[name] = f.tell()
+        return dict(num_rows=self.num_rows, topk=self.topk, sizes=sizes)
+
+    def uuids(self):
+        """uuids of the rows appended so far"""
+        self.uuids_file.flush()
+        with open(self.uuids_file.name) as f:
+            return [json.loads(line) for line in f]
+
+    def close(self, **meta):
+        """Write the .npy files and meta.json, then move the results in place"""
+        for name, (dtype, per_prediction) in self.columns.items():
+            self.files[name].close()
+            shape = (self.num_rows, self.topk) if per_prediction else (self.num_rows,)
+            bin_path = os.path.join(self.tmp_path, name + ".bin")
+            with open(os.path.join(self.tmp_path, name + ".npy"), "wb") as f:
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        "fortran_order": False,
+                        "shape": shape,
+                    },
+                )
+                with open(bin_path, "rb") as raw:
+                    shutil.copyfileobj(raw, f)
+            os.remove(bin_path)
+        self.uuids_file.close()
+
+        meta = dict(
+            meta,
+            version=RESULT_FORMAT_VERSION,
+            num_rows=self.num_rows,
+            topk=self.topk,
+            columns=list(self.columns),
+        )
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        for f in list(self.files.values()) + [self.uuids_file]:
+            f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class ResultTable():
+    """Columnar results of a run, memory-mapped from disk
+
+    Every column is an array with one row per sample (see ResultWriter),
+    e.g. table.ranks or table.topk_ids; meta holds the global metrics.
+    """
+
+    def __init__(self, path, arrays, uuids, meta):
+        self.path = path
+        self.arrays = arrays
+        self.uuids = uuids
+        self.meta = meta
+        self.rows = {uuid: row for row, uuid in enumerate(uuids)}
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != RESULT_FORMAT_VERSION:
+            raise ValueError("unsupported result format version: {}".format(meta["version"]))
+        # empty files can not be memory-mapped
+        mmap_mode = "r" if mmap and meta["num_rows"] > 0 else None
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in meta["columns"]
+        }
+        with open(os.path.join(path, "uuids.jsonl")) as f:
+            uuids = [json.loads(line) for line in f]
+        return cls(path, arrays, uuids, meta)
+
+    def __getattr__(self, name):
+        arrays = self.__dict__.get("arrays", {})
+        if name in arrays:
+            return arrays[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def precision_at(self, k):
+        ranks = self.arrays["ranks"]
+        if len(ranks) == 0:
+            return 0.0
+        return float(np.mean((ranks > 0) & (ranks <= k)))
+
+    def mean_reciprocal_rank(self):
+        ranks = self.arrays["ranks"]
+        if len(ranks) == 0:
+            return 0.0
+        return float(np.mean(np.where(ranks > 0, 1.0 / np.maximum(ranks, 1), 0.0)))
+
+    def row(self, uuid):
+        """Values of every column for the sample with this uuid"""
+        row = self.rows[uuid]
+        return {name: array[row] for name, array in self.arrays.items()}
+
+
+def load_results(path, mmap=True):
+    """Load the results of a run: a ResultTable, or the dict of a legacy result.pkl"""
+    if os.path.isdir(path):
+        return ResultTable.load(path, mmap=mmap)
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -17,6 +17,12 @@ class LamaConfig:
     log_dir: str = "/home/angelie/Documents/PhD/LAMA/results/logs/" # where to store the log
     data_path : str = "" # location of pre-trained_language_models folder in which the models and tokenizers are stored
                             # see scripts/run_experiments.py
+    share_batches: bool = False # evaluate the LMs sharing a connector and a tokenizer together,
+                                # on the same tokenized batches (CoLAKE always runs on its own)
+    pool_relations: bool = False # pool the samples of all the relations of a dataset into shared batches
+    workers: int = 1 # evaluate the relations on a pool of processes sharing one copy of the models
+    resume: bool = False # skip the relations completed in log_dir by a previous run
+    checkpoint_every: int = 0 # save the results of a relation every N batches, to resume it after a crash
 
 
 cs = ConfigStore.instance()
@@ -4,6 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import argparse
 from lama.modules import build_model_by_name
 import lama.utils as utils
 from lama.utils import print_sentence_predictions, load_vocab
@@ -12,7 +13,6 @@ from tqdm import tqdm
 from random import shuffle
 import os
 import json
-import spacy
 import lama.modules.base_connector as base
 from pprint import pprint
 import logging.config
@@ -21,15 +21,60 @@ import pickle
 from multiprocessing.pool import ThreadPool
 import multiprocessing
 import lama.evaluation_metrics as metrics
+import lama.probe_shards as probe_shards
+import lama.result_store as result_store
+import lama.log_handlers as log_handlers
+from lama.pipeline import run_stages
+from lama.execution_profile import apply_execution_profile, execution_profile, set_replica_threads
 import time, sys
+import collections
+import gc
+import numpy as np
+import torch
+
+# use a faster JSON parser if one is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+
+# top predictions of every sample in the legacy result.pkl
+LEGACY_RESULT_TOPK = 10000
+
+
+def iter_file(filename):
+    # stream the file, one parsed line at a time
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json_loads(line)
 
 
 def load_file(filename):
-    data = []
-    with open(filename, "r") as f:
-        for line in f.readlines():
-            data.append(json.loads(line))
-    return data
+    return list(iter_file(filename))
+
+
+def iter_samples(filename):
+    for sample in iter_file(filename):
+        # TREx data
+        if "masked_sentences" not in sample and "evidences" in sample:
+            sample["masked_sentences"] = [
+                evidence["masked_sentence"] for evidence in sample["evidences"]
+            ]
+        yield sample
+
+
+def load_samples(filename):
+    """Parse a relation file in a single pass
+
+    TREx evidences are normalized into masked_sentences while parsing, so the
+    samples can be handed to main as they are.
+    """
+    return list(iter_samples(filename))
 
 
 def create_logdir_with_timestamp(base_logdir, modelname):
@@ -56,9 +101,15 @@ def parse_template(template, subject_label, object_label):
     return [template]
 
 
-def init_logging(log_directory):
-    logger = logging.getLogger("LAMA")
-    logger.setLevel(logging.DEBUG)
+def init_logging(log_directory, name="LAMA", level=logging.DEBUG, max_bytes=0, backup_count=5):
+    """Logger writing to info.log in log_directory (and warnings to stdout)
+
+    The records are written by a listener thread (see lama.log_handlers).
+    With max_bytes > 0, info.log is rotated at max_bytes and the backup_count
+    previous logs are kept gzipped.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
 
     os.makedirs(log_directory, exist_ok=True)
 
@@ -69,8 +120,13 @@ def init_logging(log_directory):
     )
 
     # file handler
-    fh = logging.FileHandler(str(log_directory) + "/info.log")
-    fh.setLevel(logging.DEBUG)
+    if max_bytes > 0:
+        fh = log_handlers.CompressedRotatingFileHandler(
+            str(log_directory) + "/info.log", max_bytes, backup_count=backup_count
+        )
+    else:
+        fh = logging.FileHandler(str(log_directory) + "/info.log")
+    fh.setLevel(level)
     fh.setFormatter(formatter)
 
     # console handler
@@ -78,71 +134,87 @@ def init_logging(log_directory):
     ch.setLevel(logging.WARNING)
     ch.setFormatter(formatter)
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    # replaces the handlers of a previous run with the same logger
+    log_handlers.attach_queue_listener(logger, [fh, ch])
 
     logger.propagate = False
 
     return logger
 
 
+def batchify_indices(lengths, batch_size=None, max_tokens=None):
+    """Sort the samples by length and cut them into batches of indices
+
+    A batch is closed after batch_size samples or, with max_tokens, when one
+    more sample would take its padded size (number of samples times the
+    longest sample) over max_tokens. A sample longer than the budget gets a
+    batch of its own.
+    """
+    batches = []
+    current_batch = []
+    current_max_length = 0
+
+    # sort to group togheter samples with similar length
+    for k in sorted(range(len(lengths)), key=lambda k: lengths[k]):
+        max_length = max(current_max_length, lengths[k])
+        if current_batch and (
+            (batch_size is not None and len(current_batch) >= batch_size)
+            or (max_tokens is not None and max_length * (len(current_batch) + 1) > max_tokens)
+        ):
+            batches.append(current_batch)
+            current_batch = []
+            max_length = lengths[k]
+        current_batch.append(k)
+        current_max_length = max_length
+
+    # last batch
+    if current_batch:
+        batches.append(current_batch)
+
+    return batches
+
+
+def word_lengths(samples):
+    return [len(" ".join(sample["masked_sentences"]).split()) for sample in samples]
+
+
 def batchify(data, batch_size):
     msg = ""
     list_samples_batches = []
     list_sentences_batches = []
-    current_samples_batch = []
-    current_sentences_batches = []
-    c = 0
+    for batch in batchify_indices(word_lengths(data), batch_size=batch_size):
+        list_samples_batches.append([data[k] for k in batch])
+        list_sentences_batches.append([data[k]["masked_sentences"] for k in batch])
+    return list_samples_batches, list_sentences_batches, msg
 
-    # sort to group togheter sentences with similar length
-    for sample in sorted(
-        data, key=lambda k: len(" ".join(k["masked_sentences"]).split())
-    ):
-        masked_sentences = sample["masked_sentences"]
-        current_samples_batch.append(sample)
-        current_sentences_batches.append(masked_sentences)
-        c += 1
-        if c >= batch_size:
-            list_samples_batches.append(current_samples_batch)
-            list_sentences_batches.append(current_sentences_batches)
-            current_samples_batch = []
-            current_sentences_batches = []
-            c = 0
 
-    # last batch
-    if current_samples_batch and len(current_samples_batch) > 0:
-        list_samples_batches.append(current_samples_batch)
-        list_sentences_batches.append(current_sentences_batches)
+def batchify_by_tokens(data, max_tokens, token_lengths):
+    """Same as batchify, with batches filled up to a token budget
 
+    Samples are sorted by their tokenized length, see batchify_indices.
+    """
+    msg = ""
+    list_samples_batches = []
+    list_sentences_batches = []
+    for batch in batchify_indices(token_lengths, max_tokens=max_tokens):
+        list_samples_batches.append([data[k] for k in batch])
+        list_sentences_batches.append([data[k]["masked_sentences"] for k in batch])
+    msg += "batches of at most {} tokens: {}\n".format(max_tokens, len(list_samples_batches))
     return list_samples_batches, list_sentences_batches, msg
 
 
 def batchify_negated(data, batch_size):
-    msg = ""
-    list_sentences_batches = []
-    current_sentences_batches = []
-    c = 0
-
-    # sort to group togheter sentences with similar length
-    for sample in sorted(
-        data, key=lambda k: len(" ".join(k["masked_sentences"]).split())
-    ):
-        if "negated" in sample:
-            masked_sentences = sample["negated"]
-            current_sentences_batches.append(masked_sentences)
-        else:
-            current_sentences_batches.append([""])
-        c += 1
-        if c >= batch_size:
-            list_sentences_batches.append(current_sentences_batches)
-            current_sentences_batches = []
-            c = 0
+    samples_batches, _, _ = batchify(data, batch_size)
+    return batchify_negated_by_samples(samples_batches)
 
-    # last batch
-    if current_sentences_batches and len(current_sentences_batches) > 0:
-        list_sentences_batches.append(current_sentences_batches)
 
-    return list_sentences_batches, msg
+def batchify_negated_by_samples(samples_batches):
+    # negated sentences of already batched samples, batch for batch
+    list_sentences_batches = [
+        [sample["negated"] if "negated" in sample else [""] for sample in samples_b]
+        for samples_b in samples_batches
+    ]
+    return list_sentences_batches, ""
 
 
 def run_thread(arguments):
@@ -179,22 +251,27 @@ def run_thread(arguments):
     return experiment_result, sample_MRR, sample_P, sample_perplexity, msg
 
 
-def run_thread_negated(arguments):
+def run_batch(filtered_log_probs_list, masked_indices_list, label_index_list,
+              vocab, index_list=None, topk=10, printed=None):
 
-    msg = ""
+    # the labels are scored in the (possibly filtered) vocabulary of the log_probs
+    label_indices = [label_index[0] for label_index in label_index_list]
+    if index_list is not None:
+        label_indices = index_list.to_subset(label_indices)
 
-    overlap, spearman, return_msg = metrics.get_negation_metric(
-        arguments["log_probs"],
-        arguments["masked_indices"],
-        arguments["log_probs_negated"],
-        arguments["masked_indices_negated"],
-        arguments["vocab"],
-        index_list=arguments["index_list"],
+    # 1. compute the ranking metrics for the whole batch at once
+    ranking = metrics.get_ranking_batch(
+        filtered_log_probs_list, masked_indices_list, label_indices, topk=topk
     )
 
-    msg += "\n" + return_msg
-
-    return overlap, spearman, msg
+    res = []
+    for sample_MRR, sample_P, experiment_result, return_msg in metrics.get_ranking_results(
+        ranking, vocab, index_list=index_list, printed=printed
+    ):
+        # the predictions of the samples that are not logged are not formatted
+        msg = "\n" + return_msg if return_msg else ""
+        res.append((experiment_result, sample_MRR, sample_P, 0.0, msg))
+    return res
 
 
 def lowercase_samples(samples, use_negated_probes=False):
@@ -234,18 +311,17 @@ def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
     msg = ""
     new_samples = []
     samples_exluded = 0
+    # every distinct label is tokenized once
+    label_table = model.get_label_table(
+        [sample["obj_label"] for sample in samples if "obj_label" in sample],
+        vocab_subset,
+    )
     for sample in samples:
         excluded = False
         if "obj_label" in sample and "sub_label" in sample:
 
-            obj_label_ids = model.get_id(sample["obj_label"])
-
-            if obj_label_ids:
-                recostructed_word = " ".join(
-                    [model.vocab[x] for x in obj_label_ids]
-                ).strip()
-            else:
-                recostructed_word = None
+            obj_label = label_table[sample["obj_label"]]
+            obj_label_ids = obj_label.token_ids
 
             excluded = False
             if not template or len(template) == 0:
@@ -259,15 +335,12 @@ def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
                     excluded = True
 
             # MAKE SURE THAT obj_label IS IN VOCABULARIES
-            if vocab_subset:
-                for x in sample["obj_label"].split(" "):
-                    if x not in vocab_subset:
-                        excluded = True
-                        msg += "\tEXCLUDED object label {} not in vocab subset\n".format(
-                            sample["obj_label"]
-                        )
-                        samples_exluded += 1
-                        break
+            if vocab_subset is not None and not obj_label.in_subset:
+                excluded = True
+                msg += "\tEXCLUDED object label {} not in vocab subset\n".format(
+                    sample["obj_label"]
+                )
+                samples_exluded += 1
 
             if excluded:
                 pass
@@ -276,7 +349,7 @@ def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
                     sample["obj_label"]
                 )
                 samples_exluded += 1
-            elif not recostructed_word or recostructed_word != sample["obj_label"]:
+            elif not obj_label.in_vocab:
                 msg += "\tEXCLUDED object label {} not in model vocabulary\n".format(
                     sample["obj_label"]
                 )
@@ -309,19 +382,7 @@ def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
     return new_samples, msg
 
 
-def main(args, shuffle_data=True, model=None):
-
-    if len(args.models_names) > 1:
-        raise ValueError('Please specify a single language model (e.g., --lm "bert").')
-
-    msg = ""
-
-    [model_type_name] = args.models_names
-
-    print(model)
-    if model is None:
-        model = build_model_by_name(model_type_name, args)
-
+def get_model_name(model_type_name, args):
     if model_type_name == "fairseq":
         model_name = "fairseq_{}".format(args.fairseq_model_name)
     elif model_type_name == "bert":
@@ -334,173 +395,348 @@ def main(args, shuffle_data=True, model=None):
         model_name = "hfRoBERTa_{}".format(args.hfroberta_model_name)
     else:
         model_name = model_type_name.title()
+    return model_name
 
-    # initialize logging
-    if args.full_logdir:
-        log_directory = args.full_logdir
-    else:
-        log_directory = create_logdir_with_timestamp(args.logdir, model_name)
-    logger = init_logging(log_directory)
-    msg += "model name: {}\n".format(model_name)
-
-    # deal with vocab subset
-    vocab_subset = None
-    index_list = None
-    msg += "args: {}\n".format(args)
-    if args.common_vocab_filename is not None:
-        vocab_subset = load_vocab(args.common_vocab_filename)
-        msg += "common vocabulary size: {}\n".format(len(vocab_subset))
-
-        # optimization for some LM (such as ELMo)
-        model.optimize_top_layer(vocab_subset)
-
-        filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(
-            vocab_subset, logger
-        )
-
-    logger.info("\n" + msg + "\n")
 
-    # dump arguments on file for log
-    with open("{}/args.json".format(log_directory), "w") as outfile:
-        json.dump(vars(args), outfile)
+def run_key(args):
+    """Options of a run that change its results
 
-    # stats
-    samples_with_negative_judgement = 0
-    samples_with_positive_judgement = 0
-
-    # Mean reciprocal rank
-    MRR = 0.0
-    MRR_negative = 0.0
-    MRR_positive = 0.0
-
-    # Precision at (default 10)
-    Precision = 0.0
-    Precision1 = 0.0
-    Precision_negative = 0.0
-    Precision_positivie = 0.0
-
-    # spearman rank correlation
-    # overlap at 1
-    if args.use_negated_probes:
-        Spearman = 0.0
-        Overlap = 0.0
-        num_valid_negation = 0.0
+    A checkpoint or a completed run (see ModelEvaluation.finish) is only
+    reused by a run with the same key.
+    """
+    [model_type_name] = args.models_names
+    return dict(
+        model_name=get_model_name(model_type_name, args),
+        dataset_filename=os.path.abspath(args.dataset_filename) if args.dataset_filename else None,
+        template=args.template,
+        common_vocab_filename=args.common_vocab_filename,
+        subset_output_layer=args.subset_output_layer,
+        lowercase=args.lowercase,
+        max_sentence_length=args.max_sentence_length,
+        use_negated_probes=args.use_negated_probes,
+    )
 
-    data = load_file(args.dataset_filename)
 
-    print(len(data))
+def load_completed_run(args):
+    """Summary written by a completed run with the same options, or None"""
+    if not args.full_logdir:
+        return None
+    try:
+        with open(os.path.join(args.full_logdir, "summary.json")) as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if summary.get("key") != json.loads(json.dumps(run_key(args))):
+        return None
+    return summary
+
+
+def result_columns(list_of_results, use_negated_probes=False):
+    """Columns of the results of some samples, see lama.result_store.ResultWriter"""
+    names = ["uuids"] + list(result_store.RESULT_COLUMNS)
+    if use_negated_probes:
+        names += list(result_store.NEGATION_COLUMNS)
+    columns = {name: [] for name in names}
+    for element in list_of_results:
+        masked_topk = element["masked_topk"]
+        columns["uuids"].append(element["uuid"])
+        columns["label_ids"].append(element["label_index"][0])
+        # the interactive ranking doesn't return the rank itself
+        rank = masked_topk.get("rank")
+        if rank is None:
+            rank = int(round(1.0 / element["sample_MRR"])) if element["sample_MRR"] > 0 else 0
+        columns["ranks"].append(rank)
+        columns["label_log_probs"].append(masked_topk["PERPLEXITY"])
+        columns["judgements"].append(result_store.JUDGEMENTS[element.get("judgement")])
+        # no top predictions were ranked with topk=0
+        topk = masked_topk.get("topk", [])
+        columns["topk_ids"].append([prediction["token_idx"] for prediction in topk])
+        columns["topk_log_probs"].append([prediction["log_prob"] for prediction in topk])
+        if use_negated_probes:
+            columns["spearman"].append(element.get("spearmanr", float("nan")))
+            columns["overlap"].append(element.get("overlap", float("nan")))
+    return columns
+
+
+def write_json_atomically(obj, path):
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+class ModelEvaluation():
+    """Evaluation of one language model on a relation
+
+    Holds what is specific to a model: its log directory, vocab subset,
+    label table, metrics and results. The batches are prepared by
+    evaluate_models and go through every ModelEvaluation in turn.
+    """
+
+    # running sums of the metrics, saved with the checkpoints
+    CHECKPOINT_SUMS = (
+        "samples_with_negative_judgement",
+        "samples_with_positive_judgement",
+        "MRR",
+        "MRR_negative",
+        "MRR_positive",
+        "Precision",
+        "Precision1",
+        "Precision_negative",
+        "Precision_positivie",
+        "Spearman",
+        "Overlap",
+        "num_valid_negation",
+    )
 
-    if args.lowercase:
-        # lowercase all samples
-        logger.info("lowercasing all samples...")
-        all_samples = lowercase_samples(
-            data, use_negated_probes=args.use_negated_probes
-        )
-    else:
-        # keep samples as they are
-        all_samples = data
-        # TREx data
-        for i, sample in enumerate(all_samples):
-            if 'masked_sentences' not in sample.keys():
-                sample['masked_sentences'] = []
-                for evidence in sample['evidences']:
-                    sample['masked_sentences'].append(evidence['masked_sentence'])
-                if i == 0:
-                    print('not masked_sentences, but masked_sentence.')
+    def __init__(self, args, model, logger_name="LAMA"):
 
-    all_samples, ret_msg = filter_samples(
-        model, data, vocab_subset, args.max_sentence_length, args.template
-    )
+        if len(args.models_names) > 1:
+            raise ValueError('Please specify a single language model (e.g., --lm "bert").')
 
-    # OUT_FILENAME = "{}.jsonl".format(args.dataset_filename)
-    # with open(OUT_FILENAME, 'w') as outfile:
-    #     for entry in all_samples:
-    #         json.dump(entry, outfile)
-    #         outfile.write('\n')
+        msg = ""
 
-    logger.info("\n" + ret_msg + "\n")
+        [model_type_name] = args.models_names
 
-    print(len(all_samples))
+        self.args = args
+        self.model = model
+        self.model_name = get_model_name(model_type_name, args)
 
-    # if template is active (1) use a single example for (sub,obj) and (2) ...
-    if args.template and args.template != "":
-        facts = []
-        for sample in all_samples:
-            sub = sample["sub_label"]
-            obj = sample["obj_label"]
-            if (sub, obj) not in facts:
-                facts.append((sub, obj))
-        local_msg = "distinct template facts: {}".format(len(facts))
-        logger.info("\n" + local_msg + "\n")
-        print(local_msg)
-        all_samples = []
-        for fact in facts:
-            (sub, obj) = fact
-            sample = {}
-            sample["sub_label"] = sub
-            sample["obj_label"] = obj
-            # sobstitute all sentences with a standard template
-            sample["masked_sentences"] = parse_template(
-                args.template.strip(), sample["sub_label"].strip(), base.MASK
+        # initialize logging
+        if args.full_logdir:
+            self.log_directory = args.full_logdir
+        else:
+            self.log_directory = create_logdir_with_timestamp(args.logdir, self.model_name)
+        self.logger = init_logging(
+            self.log_directory,
+            name=logger_name,
+            level=getattr(logging, args.log_level.upper()),
+            max_bytes=args.log_max_bytes,
+            backup_count=args.log_backups,
+        )
+        msg += "model name: {}\n".format(self.model_name)
+
+        # deal with vocab subset
+        self.vocab_subset = None
+        self.index_list = None
+        self.filter_logprob_indices = None
+        self.subset_output_layer = False
+        msg += "args: {}\n".format(args)
+        # the model might have been restricted to a vocab subset by a previous run
+        model.reset_output_layer()
+        if args.common_vocab_filename is not None:
+            self.vocab_subset = load_vocab(args.common_vocab_filename)
+            msg += "common vocabulary size: {}\n".format(len(self.vocab_subset))
+
+            # optimization for some LM (such as ELMo)
+            model.optimize_top_layer(self.vocab_subset)
+
+            # built once per (model vocab, vocab subset) and cached next to the vocab file
+            self.index_list = model.get_vocab_subset_index(
+                self.vocab_subset, vocab_filename=args.common_vocab_filename, logger=self.logger
             )
-            if args.use_negated_probes:
-                # substitute all negated sentences with a standard template
-                sample["negated"] = parse_template(
-                    args.template_negated.strip(),
-                    sample["sub_label"].strip(),
-                    base.MASK,
-                )
-            all_samples.append(sample)
+            self.filter_logprob_indices = self.index_list.indices
 
-    # create uuid if not present
-    i = 0
-    for sample in all_samples:
-        if "uuid" not in sample:
-            sample["uuid"] = i
-        i += 1
+            # compute only the logits of the vocab subset
+            # (the interactive mode prints the predictions over the whole vocab)
+            if args.subset_output_layer and not args.interactive:
+                self.subset_output_layer = model.init_subset_output_layer(
+                    self.filter_logprob_indices, normalization=args.subset_output_layer
+                )
+                msg += "subset output layer: {}\n".format(self.subset_output_layer)
+
+        self.logger.info("\n" + msg + "\n")
+
+        # dump arguments on file for log
+        with open("{}/args.json".format(self.log_directory), "w") as outfile:
+            json.dump(vars(args), outfile)
+
+        # the interactive mode prints the predictions for the whole sentence
+        self.masked_only = args.masked_only and not args.interactive
+
+        # object labels of the evaluated samples, see evaluate_models
+        self.label_table = None
+
+        # stats
+        self.samples_with_negative_judgement = 0
+        self.samples_with_positive_judgement = 0
+
+        # Mean reciprocal rank
+        self.MRR = 0.0
+        self.MRR_negative = 0.0
+        self.MRR_positive = 0.0
+
+        # Precision at (default 10)
+        self.Precision = 0.0
+        self.Precision1 = 0.0
+        self.Precision_negative = 0.0
+        self.Precision_positivie = 0.0
+
+        # spearman rank correlation
+        # overlap at 1
+        self.Spearman = 0.0
+        self.Overlap = 0.0
+        self.num_valid_negation = 0.0
+
+        self.num_results = 0
+        # samples ranked so far, see log_predictions_every
+        self.num_ranked = 0
+        # the results are streamed to a ResultWriter, batch by batch, except
+        # for the legacy result.pkl which needs all of them
+        self.writer = None
+        self.list_of_results = []
+        # results already appended to checkpoint.pkl
+        self.num_checkpointed = 0
+
+    def checkpoint_paths(self):
+        return (
+            os.path.join(self.log_directory, "checkpoint.pkl"),
+            os.path.join(self.log_directory, "checkpoint.json"),
+        )
 
-    # shuffle data
-    if shuffle_data:
-        shuffle(all_samples)
+    def open_writer(self, state=None):
+        self.writer = result_store.ResultWriter(
+            os.path.join(self.log_directory, "results"),
+            topk=self.args.result_topk,
+            negated=self.args.use_negated_probes,
+            state=state,
+        )
 
-    samples_batches, sentences_batches, ret_msg = batchify(all_samples, args.batch_size)
-    logger.info("\n" + ret_msg + "\n")
-    if args.use_negated_probes:
-        sentences_batches_negated, ret_msg = batchify_negated(
-            all_samples, args.batch_size
+    def save_checkpoint(self):
+        """Save the results and metric sums accumulated so far
+
+        The streamed results are flushed (the legacy results are appended to
+        checkpoint.pkl), then checkpoint.json (the metric sums and the valid
+        length of the results) is replaced atomically: a crash at any point
+        leaves the previous checkpoint usable.
+        """
+        results_path, state_path = self.checkpoint_paths()
+        state = dict(
+            key=run_key(self.args),
+            num_results=self.num_results,
+            sums={name: getattr(self, name) for name in self.CHECKPOINT_SUMS},
         )
-        logger.info("\n" + ret_msg + "\n")
+        if self.args.result_format == "pickle":
+            new_results = self.list_of_results[self.num_checkpointed:]
+            with open(results_path, "ab") as f:
+                if new_results:
+                    pickle.dump(new_results, f)
+                f.flush()
+                os.fsync(f.fileno())
+                state["size"] = f.tell()
+            self.num_checkpointed = len(self.list_of_results)
+        else:
+            if self.writer is None:
+                self.open_writer()
+            state["writer"] = self.writer.checkpoint()
+        write_json_atomically(state, state_path)
+
+    def restore_checkpoint(self):
+        """Resume from the checkpoint of a run with the same options
+
+        Returns:
+            The uuids of the samples already evaluated.
+        """
+        results_path, state_path = self.checkpoint_paths()
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state["key"] != json.loads(json.dumps(run_key(self.args))):
+                raise ValueError("options changed")
+            if self.args.result_format == "pickle":
+                # drop what a crash left after the last checkpoint
+                os.truncate(results_path, state["size"])
+                list_of_results = []
+                with open(results_path, "rb") as f:
+                    while f.tell() < state["size"]:
+                        list_of_results.extend(pickle.load(f))
+                uuids = [element["uuid"] for element in list_of_results]
+            else:
+                list_of_results = []
+                self.open_writer(state=state["writer"])
+                uuids = self.writer.uuids()
+            if len(uuids) != state["num_results"]:
+                raise ValueError("truncated results")
+        except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError) as e:
+            if os.path.exists(state_path):
+                self.logger.warning("checkpoint ignored: {}".format(e))
+            self.writer = None
+            self.remove_checkpoint()
+            return set()
+
+        for name, value in state["sums"].items():
+            setattr(self, name, value)
+        self.num_results = len(uuids)
+        self.list_of_results = list_of_results
+        self.num_checkpointed = len(list_of_results)
+        self.logger.info("\nresumed from checkpoint: {} samples\n".format(len(uuids)))
+        return set(uuids)
+
+    def reset_results(self):
+        for name in self.CHECKPOINT_SUMS:
+            setattr(self, name, type(getattr(self, name))(0))
+        self.num_results = 0
+        self.writer = None
+        self.list_of_results = []
+        self.num_checkpointed = 0
+        self.remove_checkpoint()
+
+    def remove_checkpoint(self):
+        for path in self.checkpoint_paths():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_log_probs(self, sentences_b, encodings):
+        model = self.model
+        if encodings is not None:
+            (
+                original_log_probs_list,
+                token_ids_list,
+                masked_indices_list,
+            ) = model.get_batch_generation_from_ids(
+                encodings, logger=self.logger, masked_only=self.masked_only
+            )
+        else:
+            (
+                original_log_probs_list,
+                token_ids_list,
+                masked_indices_list,
+            ) = model.get_batch_generation(
+                sentences_b, logger=self.logger, masked_only=self.masked_only
+            )
 
-    # ThreadPool
-    num_threads = args.threads
-    if num_threads <= 0:
-        # use all available threads
-        num_threads = multiprocessing.cpu_count()
-    pool = ThreadPool(num_threads)
-    list_of_results = []
+        if self.vocab_subset is not None and not self.subset_output_layer:
+            # filter log_probs
+            filtered_log_probs_list = model.filter_logprobs(
+                original_log_probs_list, self.filter_logprob_indices
+            )
+        else:
+            filtered_log_probs_list = original_log_probs_list
 
-    for i in tqdm(range(len(samples_batches))):
+        return original_log_probs_list, filtered_log_probs_list, token_ids_list, masked_indices_list
 
-        samples_b = samples_batches[i]
-        sentences_b = sentences_batches[i]
+    def forward(self, batch):
+        outputs = dict(log_probs=self.get_log_probs(batch["sentences"], batch["encodings"]))
+        if self.args.use_negated_probes and batch["has_negated"]:
+            outputs["log_probs_negated"] = self.get_log_probs(
+                batch["sentences_negated"], batch["encodings_negated"]
+            )
+        return outputs
 
+    def rank(self, batch, outputs, pool):
+        args = self.args
+        samples_b = batch["samples"]
         (
             original_log_probs_list,
+            filtered_log_probs_list,
             token_ids_list,
             masked_indices_list,
-        ) = model.get_batch_generation(sentences_b, logger=logger)
-
-        if vocab_subset is not None:
-            # filter log_probs
-            filtered_log_probs_list = model.filter_logprobs(
-                original_log_probs_list, filter_logprob_indices
-            )
-        else:
-            filtered_log_probs_list = original_log_probs_list
+        ) = outputs["log_probs"]
 
         label_index_list = []
         for sample in samples_b:
-            obj_label_id = model.get_id(sample["obj_label"])
+            obj_label = self.label_table[sample["obj_label"]]
+            obj_label_id = obj_label.token_ids
 
             # MAKE SURE THAT obj_label IS IN VOCABULARIES
             if obj_label_id is None:
@@ -509,96 +745,114 @@ def main(args, shuffle_data=True, model=None):
                         sample["obj_label"]
                     )
                 )
-            elif model.vocab[obj_label_id[0]] != sample["obj_label"]:
+            elif not obj_label.single_token:
                 raise ValueError(
                     "object label {} not in model vocabulary".format(
                         sample["obj_label"]
                     )
                 )
-            elif vocab_subset is not None and sample["obj_label"] not in vocab_subset:
+            elif self.index_list is not None and not obj_label.in_subset:
                 raise ValueError(
                     "object label {} not in vocab subset".format(sample["obj_label"])
                 )
 
             label_index_list.append(obj_label_id)
-
-        arguments = [
-            {
-                "original_log_probs": original_log_probs,
-                "filtered_log_probs": filtered_log_probs,
-                "token_ids": token_ids,
-                "vocab": model.vocab,
-                "label_index": label_index[0],
-                "masked_indices": masked_indices,
-                "interactive": args.interactive,
-                "index_list": index_list,
-                "sample": sample,
-            }
-            for original_log_probs, filtered_log_probs, token_ids, masked_indices, label_index, sample in zip(
-                original_log_probs_list,
+        outputs["label_index_list"] = label_index_list
+
+        if args.interactive:
+            arguments = [
+                {
+                    "original_log_probs": original_log_probs,
+                    "filtered_log_probs": filtered_log_probs,
+                    "token_ids": token_ids,
+                    "vocab": self.model.vocab,
+                    "label_index": label_index[0],
+                    "masked_indices": masked_indices,
+                    "interactive": args.interactive,
+                    "index_list": self.index_list,
+                    "sample": sample,
+                }
+                for original_log_probs, filtered_log_probs, token_ids, masked_indices, label_index, sample in zip(
+                    original_log_probs_list,
+                    filtered_log_probs_list,
+                    token_ids_list,
+                    masked_indices_list,
+                    label_index_list,
+                    samples_b,
+                )
+            ]
+            # single thread for debug
+            # for isx,a in enumerate(arguments):
+            #     print(samples_b[isx])
+            #     run_thread(a)
+
+            # multithread
+            outputs["res"] = pool.map(run_thread, arguments)
+        else:
+            # vectorized ranking of the whole batch, the predictions of every
+            # log_predictions_every-th sample are logged
+            printed = [False] * len(samples_b)
+            if args.log_predictions_every > 0 and self.logger.isEnabledFor(logging.INFO):
+                printed = [
+                    (self.num_ranked + i) % args.log_predictions_every == 0
+                    for i in range(len(samples_b))
+                ]
+            self.num_ranked += len(samples_b)
+            outputs["res"] = run_batch(
                 filtered_log_probs_list,
-                token_ids_list,
                 masked_indices_list,
                 label_index_list,
-                samples_b,
+                self.model.vocab,
+                index_list=self.index_list,
+                topk=LEGACY_RESULT_TOPK if args.result_format == "pickle" else args.result_topk,
+                printed=printed,
             )
-        ]
-        # single thread for debug
-        # for isx,a in enumerate(arguments):
-        #     print(samples_b[isx])
-        #     run_thread(a)
-
-        # multithread
-        res = pool.map(run_thread, arguments)
 
         if args.use_negated_probes:
-            sentences_b_negated = sentences_batches_negated[i]
-
-            # if no negated sentences in batch
-            if all(s[0] == "" for s in sentences_b_negated):
-                res_negated = [(float("nan"), float("nan"), "")] * args.batch_size
+            if not batch["has_negated"]:
+                outputs["res_negated"] = [(float("nan"), float("nan"), "")] * len(samples_b)
             # eval negated batch
             else:
                 (
-                    original_log_probs_list_negated,
-                    token_ids_list_negated,
+                    _,
+                    filtered_log_probs_list_negated,
+                    _,
                     masked_indices_list_negated,
-                ) = model.get_batch_generation(sentences_b_negated, logger=logger)
-                if vocab_subset is not None:
-                    # filter log_probs
-                    filtered_log_probs_list_negated = model.filter_logprobs(
-                        original_log_probs_list_negated, filter_logprob_indices
-                    )
-                else:
-                    filtered_log_probs_list_negated = original_log_probs_list_negated
-
-                arguments = [
-                    {
-                        "log_probs": filtered_log_probs,
-                        "log_probs_negated": filtered_log_probs_negated,
-                        "token_ids": token_ids,
-                        "vocab": model.vocab,
-                        "label_index": label_index[0],
-                        "masked_indices": masked_indices,
-                        "masked_indices_negated": masked_indices_negated,
-                        "index_list": index_list,
-                    }
-                    for filtered_log_probs, filtered_log_probs_negated, token_ids, masked_indices, masked_indices_negated, label_index in zip(
-                        filtered_log_probs_list,
-                        filtered_log_probs_list_negated,
-                        token_ids_list,
-                        masked_indices_list,
-                        masked_indices_list_negated,
-                        label_index_list,
-                    )
+                ) = outputs["log_probs_negated"]
+
+                # compute the negation metrics for the whole batch at once
+                overlap, spearman = metrics.get_negation_metrics_batch(
+                    filtered_log_probs_list,
+                    masked_indices_list,
+                    filtered_log_probs_list_negated,
+                    masked_indices_list_negated,
+                )
+                outputs["res_negated"] = [
+                    (float(o), float(s), "\n") for o, s in zip(overlap, spearman)
                 ]
-                res_negated = pool.map(run_thread_negated, arguments)
 
-        for idx, result in enumerate(res):
+        # the log_probs are not needed anymore
+        outputs["token_ids_list"] = token_ids_list
+        outputs["masked_indices_list"] = masked_indices_list
+        del outputs["log_probs"]
+        outputs.pop("log_probs_negated", None)
+        return outputs
+
+    def add_results(self, batch, outputs):
+        samples_b = batch["samples"]
+        token_ids_list = outputs["token_ids_list"]
+        masked_indices_list = outputs["masked_indices_list"]
+        label_index_list = outputs["label_index_list"]
+        if self.args.use_negated_probes:
+            res_negated = outputs["res_negated"]
+
+        batch_results = []
+        for idx, result in enumerate(outputs["res"]):
 
             result_masked_topk, sample_MRR, sample_P, sample_perplexity, msg = result
 
-            logger.info("\n" + msg + "\n")
+            if msg:
+                self.logger.info("\n" + msg + "\n")
 
             sample = samples_b[idx]
 
@@ -625,19 +879,19 @@ def main(args, shuffle_data=True, model=None):
             # print("sample: {}".format(sample))
             # print()
 
-            if args.use_negated_probes:
+            if self.args.use_negated_probes:
                 overlap, spearman, msg = res_negated[idx]
                 # sum overlap and spearmanr if not nan
                 if spearman == spearman:
                     element["spearmanr"] = spearman
                     element["overlap"] = overlap
-                    Overlap += overlap
-                    Spearman += spearman
-                    num_valid_negation += 1.0
+                    self.Overlap += overlap
+                    self.Spearman += spearman
+                    self.num_valid_negation += 1.0
 
-            MRR += sample_MRR
-            Precision += sample_P
-            Precision1 += element["sample_Precision1"]
+            self.MRR += sample_MRR
+            self.Precision += sample_P
+            self.Precision1 += element["sample_Precision1"]
 
             # the judgment of the annotators recording whether they are
             # evidence in the sentence that indicates a relation between two entities.
@@ -652,75 +906,628 @@ def main(args, shuffle_data=True, model=None):
                     else:
                         num_no += 1
                 if num_no >= num_yes:
-                    samples_with_negative_judgement += 1
+                    self.samples_with_negative_judgement += 1
                     element["judgement"] = "negative"
-                    MRR_negative += sample_MRR
-                    Precision_negative += sample_P
+                    self.MRR_negative += sample_MRR
+                    self.Precision_negative += sample_P
                 else:
-                    samples_with_positive_judgement += 1
+                    self.samples_with_positive_judgement += 1
                     element["judgement"] = "positive"
-                    MRR_positive += sample_MRR
-                    Precision_positivie += sample_P
+                    self.MRR_positive += sample_MRR
+                    self.Precision_positivie += sample_P
 
-            list_of_results.append(element)
+            batch_results.append(element)
 
-    pool.close()
-    pool.join()
+        self.num_results += len(batch_results)
+        if self.args.result_format == "pickle":
+            self.list_of_results.extend(batch_results)
+        else:
+            if self.writer is None:
+                self.open_writer()
+            self.writer.append(**result_columns(batch_results, self.args.use_negated_probes))
 
-    # stats
-    try:
-       # Mean reciprocal rank
-       MRR /= len(list_of_results)
-
-       # Precision
-       Precision /= len(list_of_results)
-       Precision1 /= len(list_of_results)
-    except ZeroDivisionError:
-       MRR = Precision = Precision1 = 0.0
-
-    msg = "all_samples: {}\n".format(len(all_samples))
-    msg += "list_of_results: {}\n".format(len(list_of_results))
-    msg += "global MRR: {}\n".format(MRR)
-    msg += "global Precision at 10: {}\n".format(Precision)
-    msg += "global Precision at 1: {}\n".format(Precision1)
-
-    if args.use_negated_probes:
-        Overlap /= num_valid_negation
-        Spearman /= num_valid_negation
-        msg += "\n"
-        msg += "results negation:\n"
-        msg += "all_negated_samples: {}\n".format(int(num_valid_negation))
-        msg += "global spearman rank affirmative/negated: {}\n".format(Spearman)
-        msg += "global overlap at 1 affirmative/negated: {}\n".format(Overlap)
-
-    if samples_with_negative_judgement > 0 and samples_with_positive_judgement > 0:
-        # Google-RE specific
-        MRR_negative /= samples_with_negative_judgement
-        MRR_positive /= samples_with_positive_judgement
-        Precision_negative /= samples_with_negative_judgement
-        Precision_positivie /= samples_with_positive_judgement
-        msg += "samples_with_negative_judgement: {}\n".format(
-            samples_with_negative_judgement
+    def finish(self, num_samples):
+        num_results = self.num_results
+
+        # stats
+        try:
+           # Mean reciprocal rank
+           MRR = self.MRR / num_results
+
+           # Precision
+           Precision = self.Precision / num_results
+           Precision1 = self.Precision1 / num_results
+        except ZeroDivisionError:
+           MRR = Precision = Precision1 = 0.0
+
+        msg = "all_samples: {}\n".format(num_samples)
+        msg += "list_of_results: {}\n".format(num_results)
+        msg += "global MRR: {}\n".format(MRR)
+        msg += "global Precision at 10: {}\n".format(Precision)
+        msg += "global Precision at 1: {}\n".format(Precision1)
+
+        if self.args.use_negated_probes:
+            Overlap = self.Overlap / self.num_valid_negation
+            Spearman = self.Spearman / self.num_valid_negation
+            msg += "\n"
+            msg += "results negation:\n"
+            msg += "all_negated_samples: {}\n".format(int(self.num_valid_negation))
+            msg += "global spearman rank affirmative/negated: {}\n".format(Spearman)
+            msg += "global overlap at 1 affirmative/negated: {}\n".format(Overlap)
+
+        if self.samples_with_negative_judgement > 0 and self.samples_with_positive_judgement > 0:
+            # Google-RE specific
+            MRR_negative = self.MRR_negative / self.samples_with_negative_judgement
+            MRR_positive = self.MRR_positive / self.samples_with_positive_judgement
+            Precision_negative = self.Precision_negative / self.samples_with_negative_judgement
+            Precision_positivie = self.Precision_positivie / self.samples_with_positive_judgement
+            msg += "samples_with_negative_judgement: {}\n".format(
+                self.samples_with_negative_judgement
+            )
+            msg += "samples_with_positive_judgement: {}\n".format(
+                self.samples_with_positive_judgement
+            )
+            msg += "MRR_negative: {}\n".format(MRR_negative)
+            msg += "MRR_positive: {}\n".format(MRR_positive)
+            msg += "Precision_negative: {}\n".format(Precision_negative)
+            msg += "Precision_positivie: {}\n".format(Precision_positivie)
+
+        self.logger.info("\n" + msg + "\n")
+        print("\n" + msg + "\n")
+
+        if self.args.result_format == "pickle":
+            # dump pickle with the result of the experiment
+            all_results = dict(
+                list_of_results=self.list_of_results, global_MRR=MRR, global_P_at_10=Precision
+            )
+            with open("{}/result.pkl".format(self.log_directory), "wb") as f:
+                pickle.dump(all_results, f)
+        else:
+            # columns of per-sample arrays, see lama.result_store
+            if self.writer is None:
+                self.open_writer()
+            self.writer.close(
+                model_name=self.model_name,
+                num_samples=num_samples,
+                global_MRR=MRR,
+                global_P_at_10=Precision,
+                global_P_at_1=Precision1,
+            )
+
+        # marks the run as completed, see load_completed_run
+        summary = dict(
+            key=run_key(self.args),
+            num_samples=num_samples,
+            num_results=num_results,
+            global_MRR=MRR,
+            global_P_at_10=Precision,
+            Precision1=Precision1,
         )
-        msg += "samples_with_positive_judgement: {}\n".format(
-            samples_with_positive_judgement
+        write_json_atomically(summary, os.path.join(self.log_directory, "summary.json"))
+        self.remove_checkpoint()
+
+        return Precision1
+
+
+def main(args, shuffle_data=True, model=None, samples=None):
+
+    if len(args.models_names) > 1:
+        raise ValueError('Please specify a single language model (e.g., --lm "bert").')
+
+    [model_type_name] = args.models_names
+
+    print(model)
+    if model is None:
+        model = build_model_by_name(model_type_name, args)
+
+    [Precision1] = evaluate_models(
+        [args], [model], shuffle_data=shuffle_data, samples=samples
+    )
+    return Precision1
+
+
+def prepare_samples(args, model, index_list, logger, samples=None):
+    """Load, filter and template the samples of a relation, and give them uuids"""
+
+    # samples already parsed by the caller (see run_experiments) are used as they are
+    if samples is not None:
+        data = samples
+    else:
+        data = load_samples(args.dataset_filename)
+
+    print(len(data))
+
+    if args.lowercase:
+        # lowercase all samples
+        logger.info("lowercasing all samples...")
+        all_samples = lowercase_samples(
+            data, use_negated_probes=args.use_negated_probes
         )
-        msg += "MRR_negative: {}\n".format(MRR_negative)
-        msg += "MRR_positive: {}\n".format(MRR_positive)
-        msg += "Precision_negative: {}\n".format(Precision_negative)
-        msg += "Precision_positivie: {}\n".format(Precision_positivie)
+    else:
+        # keep samples as they are
+        # (TREx evidences are normalized while loading)
+        all_samples = data
+
+    all_samples, ret_msg = filter_samples(
+        model, data, index_list, args.max_sentence_length, args.template
+    )
+
+    # OUT_FILENAME = "{}.jsonl".format(args.dataset_filename)
+    # with open(OUT_FILENAME, 'w') as outfile:
+    #     for entry in all_samples:
+    #         json.dump(entry, outfile)
+    #         outfile.write('\n')
 
-    logger.info("\n" + msg + "\n")
-    print("\n" + msg + "\n")
+    logger.info("\n" + ret_msg + "\n")
+
+    print(len(all_samples))
 
-    # dump pickle with the result of the experiment
-    all_results = dict(
-        list_of_results=list_of_results, global_MRR=MRR, global_P_at_10=Precision
+    # if template is active (1) use a single example for (sub,obj) and (2) ...
+    if args.template and args.template != "":
+        facts = []
+        for sample in all_samples:
+            sub = sample["sub_label"]
+            obj = sample["obj_label"]
+            if (sub, obj) not in facts:
+                facts.append((sub, obj))
+        local_msg = "distinct template facts: {}".format(len(facts))
+        logger.info("\n" + local_msg + "\n")
+        print(local_msg)
+        all_samples = []
+        for fact in facts:
+            (sub, obj) = fact
+            sample = {}
+            sample["sub_label"] = sub
+            sample["obj_label"] = obj
+            # sobstitute all sentences with a standard template
+            sample["masked_sentences"] = parse_template(
+                args.template.strip(), sample["sub_label"].strip(), base.MASK
+            )
+            if args.use_negated_probes:
+                # substitute all negated sentences with a standard template
+                sample["negated"] = parse_template(
+                    args.template_negated.strip(),
+                    sample["sub_label"].strip(),
+                    base.MASK,
+                )
+            all_samples.append(sample)
+
+    # create uuid if not present
+    i = 0
+    for sample in all_samples:
+        if "uuid" not in sample:
+            sample["uuid"] = i
+        i += 1
+
+    return all_samples
+
+
+def build_reference_model(args):
+    """Float model of a quantized model, see quantization_parity"""
+    [model_type_name] = args.models_names
+    return build_model_by_name(
+        model_type_name, argparse.Namespace(**dict(vars(args), quantize=None, compile_forward=None))
     )
-    with open("{}/result.pkl".format(log_directory), "wb") as f:
-        pickle.dump(all_results, f)
 
-    return Precision1
+
+def quantization_parity(evaluation, reference_model, samples):
+    """Compare the quantized model of evaluation with its float reference on samples
+
+    The P@1, MRR and the agreement of the top predictions of both models are
+    logged and written to quantization_parity.json in the log directory.
+    """
+    args = evaluation.args
+    ranks = {"int8": [], "fp32": []}
+    top1 = {"int8": [], "fp32": []}
+    for batch_start in range(0, len(samples), args.batch_size):
+        samples_b = samples[batch_start:batch_start + args.batch_size]
+        sentences_b = [sample["masked_sentences"] for sample in samples_b]
+        label_indices = [
+            evaluation.label_table[sample["obj_label"]].token_ids[0] for sample in samples_b
+        ]
+        if evaluation.index_list is not None:
+            label_indices = evaluation.index_list.to_subset(label_indices)
+
+        _, log_probs, _, masked_indices_list = evaluation.get_log_probs(sentences_b, None)
+        reference_log_probs, _, reference_masked_indices_list = reference_model.get_batch_generation(
+            sentences_b, masked_only=evaluation.masked_only
+        )
+        if evaluation.vocab_subset is not None:
+            reference_log_probs = reference_model.filter_logprobs(
+                reference_log_probs, evaluation.filter_logprob_indices
+            )
+
+        for name, (batch_log_probs, batch_masked_indices_list) in [
+            ("int8", (log_probs, masked_indices_list)),
+            ("fp32", (reference_log_probs, reference_masked_indices_list)),
+        ]:
+            ranking = metrics.get_ranking_batch(
+                batch_log_probs, batch_masked_indices_list, label_indices, topk=1
+            )
+            ranks[name].extend(ranking["rank"].tolist())
+            top1[name].extend(ranking["topk_indices"][:, 0].tolist())
+
+    report = dict(num_samples=len(samples))
+    for name, name_ranks in ranks.items():
+        name_ranks = np.asarray(name_ranks, dtype=np.float64)
+        report[name] = dict(
+            P_AT_1=float(np.mean(name_ranks == 1)) if len(name_ranks) else 0.0,
+            MRR=float(np.mean(1.0 / name_ranks)) if len(name_ranks) else 0.0,
+        )
+    report["delta"] = {
+        metric: report["int8"][metric] - report["fp32"][metric] for metric in ["P_AT_1", "MRR"]
+    }
+    report["top1_agreement"] = (
+        float(np.mean(np.asarray(top1["int8"]) == np.asarray(top1["fp32"]))) if samples else 1.0
+    )
+
+    with open(os.path.join(evaluation.log_directory, "quantization_parity.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    evaluation.logger.info("\nquantization parity: {}\n".format(report))
+    return report
+
+
+def get_probe_shard(evaluation, all_samples):
+    """Pre-tokenized probes of a relation, or None
+
+    The shard is compiled by the first run with --probe-shard-dir and
+    memory-mapped afterwards. --max-tokens needs the tokenized samples: without
+    a shard directory they are encoded once, in memory.
+    """
+    args = evaluation.args
+    model = evaluation.model
+    logger = evaluation.logger
+
+    probe_shard = None
+    unique_uuids = len(set(sample["uuid"] for sample in all_samples)) == len(all_samples)
+    if args.probe_shard_dir:
+        key = probe_shards.shard_key(
+            model,
+            args.dataset_filename,
+            template=args.template,
+            lowercase=args.lowercase,
+            max_sentence_length=args.max_sentence_length,
+            vocab_subset_index=evaluation.index_list,
+        )
+        if key is None:
+            logger.warning("probe shard disabled: {} not found".format(args.dataset_filename))
+        elif not unique_uuids:
+            logger.warning("probe shard disabled: the sample uuids are not unique")
+        else:
+            try:
+                probe_shard = probe_shards.load_or_compile_shard(
+                    args.probe_shard_dir, key, model, all_samples,
+                    label_table=evaluation.label_table, logger=logger,
+                )
+                logger.info("probe shard: {}\n".format(probe_shard.path))
+            except NotImplementedError:
+                logger.warning("probe shard disabled: {} can not encode sentences".format(
+                    evaluation.model_name))
+
+    if args.max_tokens and probe_shard is None:
+        if not unique_uuids:
+            logger.warning("--max-tokens ignored: the sample uuids are not unique")
+        else:
+            try:
+                probe_shard = probe_shards.ProbeShard.from_samples(
+                    model, all_samples, label_table=evaluation.label_table
+                )
+            except NotImplementedError:
+                logger.warning("--max-tokens ignored: {} can not encode sentences".format(
+                    evaluation.model_name))
+
+    return probe_shard
+
+
+def evaluate_models(args_list, models, shuffle_data=True, samples=None):
+    """Evaluate several models on a relation in a single pass
+
+    The models must share a tokenizer (e.g. RoBERTa, KEPLER and CoLAKE). The
+    samples are loaded, filtered, tokenized and batched once, with the data
+    options of args_list[0], and every batch goes through all the models in
+    turn. Each model keeps its own log directory, metrics and result.pkl.
+
+    Returns:
+        The P@1 of every model.
+    """
+    [Precision1_list] = evaluate_relations(
+        [args_list], models, shuffle_data=shuffle_data, samples_list=[samples]
+    )
+    return Precision1_list
+
+
+def evaluate_relations(relation_args, models, shuffle_data=True, samples_list=None):
+    """Evaluate models on several relations, with the samples pooled in shared batches
+
+    relation_args[r][m] holds the options of model m on relation r. The
+    samples of all the relations are sorted by length together and cut in
+    full batches, so small relations no longer end in half-empty batches.
+    Every batch goes through each model once and is split back by relation
+    for the ranking: every (relation, model) pair keeps its own log
+    directory, metrics and result.pkl. The batching options are the ones of
+    relation_args[0][0].
+
+    Returns:
+        The P@1 of every model, for every relation.
+    """
+    if samples_list is None:
+        samples_list = [None] * len(relation_args)
+
+    if len(set(model.tokenizer_signature() for model in models)) > 1:
+        raise ValueError("models evaluated together must share a tokenizer")
+
+    # every batch runs through a model once: its options can not change by relation
+    for m in range(len(models)):
+        options = set(
+            (args_list[m].common_vocab_filename, args_list[m].subset_output_layer,
+             args_list[m].masked_only, args_list[m].interactive)
+            for args_list in relation_args
+        )
+        if len(options) > 1:
+            raise ValueError(
+                "relations evaluated together must use the same vocab subset and output layer")
+
+    # every (relation, model) logs to its own directory
+    evaluations = [
+        [
+            ModelEvaluation(
+                model_args, model,
+                logger_name="LAMA" if r == 0 and m == 0 else "LAMA.{}.{}".format(r, m),
+            )
+            for m, (model_args, model) in enumerate(zip(args_list, models))
+        ]
+        for r, args_list in enumerate(relation_args)
+    ]
+
+    # the data is prepared with the first model
+    args = relation_args[0][0]
+    model = models[0]
+    logger = evaluations[0][0].logger
+
+    relation_samples = []
+    relation_shards = []
+    relation_num_samples = []
+    for r, samples in enumerate(samples_list):
+        evaluation = evaluations[r][0]
+        all_samples = prepare_samples(
+            evaluation.args, model, evaluation.index_list, evaluation.logger, samples=samples
+        )
+
+        # object labels of the remaining samples (already tokenized by filter_samples)
+        for model_evaluation in evaluations[r]:
+            model_evaluation.label_table = model_evaluation.model.get_label_table(
+                [sample["obj_label"] for sample in all_samples], model_evaluation.index_list
+            )
+
+        relation_shards.append(get_probe_shard(evaluation, all_samples))
+        relation_num_samples.append(len(all_samples))
+        parity_samples = all_samples
+
+        done_uuids = [set()]
+        if args.checkpoint_every:
+            # skip the samples evaluated before a crash (by every model)
+            if len(set(sample["uuid"] for sample in all_samples)) < len(all_samples):
+                evaluation.logger.warning("cannot resume: the sample uuids are not unique")
+                done_uuids = [set()]
+                for model_evaluation in evaluations[r]:
+                    model_evaluation.remove_checkpoint()
+            else:
+                done_uuids = [
+                    model_evaluation.restore_checkpoint() for model_evaluation in evaluations[r]
+                ]
+            if any(uuids != done_uuids[0] for uuids in done_uuids):
+                # the models were checkpointed at different points, start over
+                for model_evaluation in evaluations[r]:
+                    model_evaluation.reset_results()
+                done_uuids = [set()]
+            all_samples = [sample for sample in all_samples if sample["uuid"] not in done_uuids[0]]
+
+        # measure the accuracy lost by the quantized models on the first samples
+        # of the first relation they evaluate
+        for model_evaluation in evaluations[r]:
+            model = model_evaluation.model
+            model_args = model_evaluation.args
+            if not model.quantization or model_args.quantize_parity_samples <= 0:
+                continue
+            if model.parity_report is not None:
+                continue
+            parity_path = os.path.join(model_evaluation.log_directory, "quantization_parity.json")
+            if done_uuids[0] and os.path.exists(parity_path):
+                # measured before the relation was checkpointed
+                with open(parity_path) as f:
+                    model.parity_report = json.load(f)
+                continue
+            # the float model is only kept for the comparison
+            reference_model = build_reference_model(model_args)
+            model.parity_report = quantization_parity(
+                model_evaluation,
+                reference_model,
+                parity_samples[:model_args.quantize_parity_samples],
+            )
+            del reference_model
+            gc.collect()
+
+        # shuffle data
+        if shuffle_data:
+            shuffle(all_samples)
+
+        relation_samples.append(all_samples)
+
+    # pool the samples of all the relations, tagged with their relation
+    items = [
+        (r, sample) for r, all_samples in enumerate(relation_samples) for sample in all_samples
+    ]
+
+    batch_by_tokens = bool(args.max_tokens) and all(
+        probe_shard is not None for probe_shard in relation_shards
+    )
+    if batch_by_tokens:
+        lengths = []
+        for probe_shard, all_samples in zip(relation_shards, relation_samples):
+            lengths.extend(probe_shard.token_lengths(all_samples))
+        index_batches = batchify_indices(lengths, max_tokens=args.max_tokens)
+        ret_msg = "batches of at most {} tokens: {}\n".format(args.max_tokens, len(index_batches))
+    else:
+        index_batches = batchify_indices(
+            word_lengths([sample for _, sample in items]), batch_size=args.batch_size
+        )
+        ret_msg = ""
+    logger.info("\n" + ret_msg + "\n")
+
+    # torch threads, metric workers and model replicas
+    profile = execution_profile(args)
+    apply_execution_profile(profile, logger=logger)
+    # only the interactive ranking runs sample by sample on a thread pool
+    pool = ThreadPool(profile.metric_workers) if args.interactive else None
+
+    # tokenize ahead of the models and rank behind them, on background threads
+    # (the interactive mode waits for the user after every sample)
+    pipelined = (args.pipeline or profile.replicas > 1) and not args.interactive
+
+    # the samples are encoded once for all the models and relations
+    pre_encode = pipelined or len(models) > 1 or len(relation_args) > 1
+
+    def encode_batch(sentences_b):
+        try:
+            return [model.encode_sentences(sentences) for sentences in sentences_b]
+        except NotImplementedError:
+            # tokenized by get_batch_generation
+            return None
+
+    def tokenize_stage(index_batch):
+        batch_items = [items[k] for k in index_batch]
+        batch = dict(
+            relations=[r for r, _ in batch_items],
+            samples=[sample for _, sample in batch_items],
+        )
+        batch["sentences"] = [sample["masked_sentences"] for sample in batch["samples"]]
+        batch["encodings"] = None
+        if any(probe_shard is not None for probe_shard in relation_shards) or pre_encode:
+            encodings = []
+            for r, sample in batch_items:
+                probe_shard = relation_shards[r]
+                if probe_shard is not None:
+                    encodings.append(probe_shard.encoding(probe_shard.rows[sample["uuid"]]))
+                else:
+                    encodings.append(None)
+            if any(encoding is None for encoding in encodings):
+                live_encodings = encode_batch(batch["sentences"])
+                encodings = live_encodings if live_encodings is None else [
+                    encoding if encoding is not None else live_encoding
+                    for encoding, live_encoding in zip(encodings, live_encodings)
+                ]
+            batch["encodings"] = encodings
+
+        if args.use_negated_probes:
+            [batch["sentences_negated"]], _ = batchify_negated_by_samples([batch["samples"]])
+            # if no negated sentences in batch
+            batch["has_negated"] = not all(s[0] == "" for s in batch["sentences_negated"])
+            batch["encodings_negated"] = None
+            if pre_encode and batch["has_negated"]:
+                batch["encodings_negated"] = encode_batch(batch["sentences_negated"])
+        return batch
+
+    def forward_stage(batch):
+        set_replica_threads(profile)
+        # the options of a model are the same for all the relations
+        batch["outputs"] = [evaluation.forward(batch) for evaluation in evaluations[0]]
+        return batch
+
+    def rank_stage(batch):
+        batch["relation_batches"] = split_batch_by_relation(batch)
+        for r, (relation_batch, relation_outputs) in batch["relation_batches"].items():
+            for evaluation, outputs in zip(evaluations[r], relation_outputs):
+                evaluation.rank(relation_batch, outputs, pool)
+        return batch
+
+    # load -> tokenize -> forward -> rank, results are aggregated and logged below
+    batches = run_stages(
+        index_batches,
+        [tokenize_stage, forward_stage, rank_stage],
+        pipelined=pipelined,
+        queue_size=args.pipeline_queue_size,
+        # the replicas share the weights of the models
+        workers=[1, profile.replicas, 1],
+    )
+    for i, batch in enumerate(tqdm(batches, total=len(index_batches))):
+        for r, (relation_batch, relation_outputs) in batch["relation_batches"].items():
+            for evaluation, outputs in zip(evaluations[r], relation_outputs):
+                evaluation.add_results(relation_batch, outputs)
+
+        if args.checkpoint_every and (i + 1) % args.checkpoint_every == 0:
+            for relation_evaluations in evaluations:
+                for evaluation in relation_evaluations:
+                    evaluation.save_checkpoint()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    Precision1_lists = [
+        [evaluation.finish(num_samples) for evaluation in evaluations[r]]
+        for r, num_samples in enumerate(relation_num_samples)
+    ]
+
+    # write the pending log records
+    for relation_evaluations in evaluations:
+        for evaluation in relation_evaluations:
+            log_handlers.detach_queue_listener(evaluation.logger)
+
+    return Precision1_lists
+
+
+def split_batch_by_relation(batch):
+    """Split a pooled batch and the model outputs on it by relation
+
+    Returns:
+        A dict mapping every relation of the batch to its sub-batch and to the
+        outputs of every model restricted to its rows.
+    """
+    rows_by_relation = collections.OrderedDict()
+    for row, r in enumerate(batch["relations"]):
+        rows_by_relation.setdefault(r, []).append(row)
+
+    # a batch from a single relation is used as it is
+    if len(rows_by_relation) == 1:
+        [r] = rows_by_relation
+        return {r: (batch, batch["outputs"])}
+
+    def select(log_probs, rows):
+        (
+            original_log_probs_list,
+            filtered_log_probs_list,
+            token_ids_list,
+            masked_indices_list,
+        ) = log_probs
+        index = torch.as_tensor(rows, dtype=torch.long)
+        original = original_log_probs_list.index_select(0, index)
+        if filtered_log_probs_list is original_log_probs_list:
+            filtered = original
+        else:
+            filtered = filtered_log_probs_list.index_select(0, index)
+        return (
+            original,
+            filtered,
+            [token_ids_list[row] for row in rows],
+            [masked_indices_list[row] for row in rows],
+        )
+
+    relation_batches = collections.OrderedDict()
+    for r, rows in rows_by_relation.items():
+        relation_batch = dict(samples=[batch["samples"][row] for row in rows])
+        if "sentences_negated" in batch:
+            relation_batch["sentences_negated"] = [batch["sentences_negated"][row] for row in rows]
+            relation_batch["has_negated"] = batch["has_negated"] and not all(
+                s[0] == "" for s in relation_batch["sentences_negated"]
+            )
+        relation_outputs = []
+        for outputs in batch["outputs"]:
+            sub_outputs = dict(log_probs=select(outputs["log_probs"], rows))
+            if relation_batch.get("has_negated"):
+                sub_outputs["log_probs_negated"] = select(outputs["log_probs_negated"], rows)
+            relation_outputs.append(sub_outputs)
+        relation_batches[r] = (relation_batch, relation_outputs)
+    return relation_batches
 
 
 if __name__ == "__main__":
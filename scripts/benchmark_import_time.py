@@ -0,0 +1,81 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Measure the time it takes to import the LAMA modules and CLIs, each in a
+# fresh interpreter:
+#
+#   python scripts/benchmark_import_time.py --repeats 5
+#   python scripts/benchmark_import_time.py lama.modules --importtime
+#
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+DEFAULT_TARGETS = [
+    "lama.modules",
+    "lama.modules.base_connector",
+    "lama.modules.hfroberta_connector",
+    "lama.eval_generation",
+    "scripts.batch_eval_KB_completion",
+    "scripts.run_experiments",
+    "run_lama",
+]
+
+TIMER = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+
+
+def import_time(target, python=sys.executable):
+    """Seconds it takes a fresh interpreter to import target"""
+    output = subprocess.run(
+        [python, "-c", TIMER.format(target)],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stdout
+    return float(output.split()[-1])
+
+
+def slowest_imports(target, top=15, python=sys.executable):
+    """(cumulative seconds, module) of the slowest imports of target, from -X importtime"""
+    stderr = subprocess.run(
+        [python, "-X", "importtime", "-c", "import {}".format(target)],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) / 1e6, fields[2].rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(args):
+    print("{:<40} {:>10} {:>10}".format("import", "median", "min"))
+    for target in args.targets or DEFAULT_TARGETS:
+        times = [import_time(target) for _ in range(args.repeats)]
+        print("{:<40} {:>9.2f}s {:>9.2f}s".format(target, statistics.median(times), min(times)))
+        if args.importtime:
+            for seconds, module in slowest_imports(target):
+                print("    {:>9.2f}s {}".format(seconds, module))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("targets", nargs="*", help="modules to import (defaults: the LAMA CLIs)")
+    parser.add_argument("--repeats", type=int, default=3, help="imports per module")
+    parser.add_argument("--importtime", action="store_true",
+                        help="also list the slowest imports of every module")
+    main(parser.parse_args())
@@ -11,8 +11,10 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 import argparse
 from scripts.batch_eval_KB_completion import main as run_evaluation
-from scripts.batch_eval_KB_completion import load_file
+from scripts.batch_eval_KB_completion import evaluate_models, evaluate_relations
+from scripts.batch_eval_KB_completion import load_file, load_samples, load_completed_run
 from lama.modules import build_model_by_name
+from lama.process_pool import run_in_workers, threads_per_worker
 import pprint
 import statistics
 from os import listdir
@@ -97,101 +99,264 @@ def run_experiments(
     log_dir,
     data_path,
     use_negated_probes=False,
+    pool_relations=False,
+    workers=1,
+    resume=False,
+    checkpoint_every=0,
 ):
-    model = None
+    [result] = run_experiments_together(
+        relations,
+        data_path_pre,
+        data_path_post,
+        [input_param],
+        results_file,
+        log_dir,
+        data_path,
+        use_negated_probes=use_negated_probes,
+        pool_relations=pool_relations,
+        workers=workers,
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+    )
+    return result
+
+
+def run_experiments_together(
+    relations,
+    data_path_pre,
+    data_path_post,
+    input_params,
+    results_file,
+    log_dir,
+    data_path,
+    use_negated_probes=False,
+    pool_relations=False,
+    workers=1,
+    resume=False,
+    checkpoint_every=0,
+):
+    # the models of input_params share a tokenizer: every relation is loaded,
+    # tokenized and batched once for all of them (see evaluate_models)
+    # with pool_relations, the samples of all the relations share the batches
+    # too (see evaluate_relations); with workers > 1, the relations are
+    # evaluated by a pool of processes sharing the weights of the models
+    # with resume, the relations completed in log_dir by a previous run with
+    # the same options are not evaluated again, and checkpoint_every > 0
+    # resumes the relation that was interrupted (see ModelEvaluation.save_checkpoint)
+    models = [None] * len(input_params)
     pp = pprint.PrettyPrinter(width=41, compact=True)
 
-    all_Precision1 = []
-    type_Precision1 = defaultdict(list)
+    all_Precision1 = [[] for _ in input_params]
+    type_Precision1 = [defaultdict(list) for _ in input_params]
     type_count = defaultdict(list)
 
+    # with several models the result lines are written model by model at the end
+    results_lines = [[] for _ in input_params]
     results_file = open(results_file, "a+")
-    results_file.write(
-        "=={}==\n".format(input_param["label"])
-    )
-    results_file.flush()
-
-    for relation in relations:
-        pp.pprint(relation)
-        PARAMETERS = {
-            "dataset_filename": os.path.join(
-                data_path_pre, relation["relation"] + data_path_post
-            ),
-            "common_vocab_filename": None,
-            "template": "",
-            "bert_vocab_name": "vocab.txt",
-            "batch_size": 32,
-            "logdir": log_dir,
-            "data_path": data_path,
-            "full_logdir": os.path.join(log_dir,
-                input_param["label"], relation["relation"]
-            ),
-            "lowercase": False,
-            "max_sentence_length": 100,
-            "threads": -1,
-            "interactive": False,
-            "use_negated_probes": use_negated_probes,
-        }
-
-        if "template" in relation:
-            PARAMETERS["template"] = relation["template"]
-            if use_negated_probes:
-                PARAMETERS["template_negated"] = relation["template_negated"]
-
-        PARAMETERS.update(input_param)
-        print(PARAMETERS)
-
-        args = argparse.Namespace(**PARAMETERS)
-
-        # see if file exists
-        try:
-            data = load_file(args.dataset_filename)
-        except Exception as e:
-            print("Relation {} excluded.".format(relation["relation"]))
-            print("Exception: {}".format(e))
-            continue
-
-        # fix https://github.com/facebookresearch/LAMA/issues/30
-        if input_param["lm"] in ["elmo"]:
-            if model is not None:
-                del model
-                model = None
-
-        if model is None:
-            [model_type_name] = args.models_names
-            model = build_model_by_name(model_type_name, args)
-
-        Precision1 = run_evaluation(args, shuffle_data=False, model=model)
-        print("P@1 : {}".format(Precision1), flush=True)
-        all_Precision1.append(Precision1)
-
+    if len(input_params) == 1:
         results_file.write(
-            "{},{}\n".format(relation["relation"], round(Precision1 * 100, 2))
+            "=={}==\n".format(input_params[0]["label"])
         )
         results_file.flush()
 
+    def iter_relations():
+        for relation in relations:
+            pp.pprint(relation)
+            args_list = []
+            for input_param in input_params:
+                PARAMETERS = {
+                    "dataset_filename": os.path.join(
+                        data_path_pre, relation["relation"] + data_path_post
+                    ),
+                    "common_vocab_filename": None,
+                    "template": "",
+                    "bert_vocab_name": "vocab.txt",
+                    "batch_size": 32,
+                    "max_tokens": None,
+                    "pipeline": False,
+                    "pipeline_queue_size": 2,
+                    "logdir": log_dir,
+                    "data_path": data_path,
+                    "full_logdir": os.path.join(log_dir,
+                        input_param["label"], relation["relation"]
+                    ),
+                    "lowercase": False,
+                    "max_sentence_length": 100,
+                    "threads": -1,
+                    "interactive": False,
+                    "masked_only": False,
+                    "subset_output_layer": None,
+                    "probe_shard_dir": None,
+                    "checkpoint_every": checkpoint_every,
+                    "result_format": "columnar",
+                    "result_topk": 10,
+                    "intra_op_threads": 0,
+                    "inter_op_threads": 0,
+                    "replicas": 1,
+                    "quantize": None,
+                    "compile_forward": None,
+                    "compile_buckets": "16,32,64,128,256,512",
+                    "quantize_parity_samples": 100,
+                    "log_level": "debug",
+                    "log_predictions_every": 1,
+                    "log_max_bytes": 0,
+                    "log_backups": 5,
+                    "use_negated_probes": use_negated_probes,
+                }
+
+                if "template" in relation:
+                    PARAMETERS["template"] = relation["template"]
+                    if use_negated_probes:
+                        PARAMETERS["template_negated"] = relation["template_negated"]
+
+                PARAMETERS.update(input_param)
+                print(PARAMETERS)
+
+                args_list.append(argparse.Namespace(**PARAMETERS))
+
+            # see if file exists
+            # the relation file is parsed only once and handed to the evaluation
+            try:
+                data = load_samples(args_list[0].dataset_filename)
+            except Exception as e:
+                print("Relation {} excluded.".format(relation["relation"]))
+                print("Exception: {}".format(e))
+                continue
+
+            # relations completed by a previous run are not evaluated again
+            completed = None
+            if resume:
+                summaries = [load_completed_run(args) for args in args_list]
+                if all(summary is not None for summary in summaries):
+                    print("Relation {} already completed.".format(relation["relation"]))
+                    completed = [summary["Precision1"] for summary in summaries]
+
+            yield relation, args_list, data, completed
+
+    def build_models(args_list):
+        for k, (input_param, args) in enumerate(zip(input_params, args_list)):
+            # fix https://github.com/facebookresearch/LAMA/issues/30
+            if input_param["lm"] in ["elmo"]:
+                if models[k] is not None:
+                    models[k] = None
+
+            if models[k] is None:
+                [model_type_name] = args.models_names
+                models[k] = build_model_by_name(model_type_name, args)
+
+    def evaluate_pooled():
+        # all the relation files are loaded before the evaluation
+        loaded = list(iter_relations())
+        pending = [i for i, (_, _, _, completed) in enumerate(loaded) if completed is None]
+        done = {i: completed for i, (_, _, _, completed) in enumerate(loaded) if completed is not None}
+        if pending:
+            build_models(loaded[pending[0]][1])
+            pooled_Precision1 = evaluate_relations(
+                [loaded[i][1] for i in pending],
+                models,
+                shuffle_data=False,
+                samples_list=[loaded[i][2] for i in pending],
+            )
+            done.update(zip(pending, pooled_Precision1))
+        for i, (relation, _, data, _) in enumerate(loaded):
+            yield relation, data, done[i]
+
+    def evaluate_in_workers():
+        # the models are built once and shared by the forked workers, which
+        # evaluate one relation at a time
+        loaded = list(iter_relations())
+        pending = [i for i, (_, _, _, completed) in enumerate(loaded) if completed is None]
+        done = {i: completed for i, (_, _, _, completed) in enumerate(loaded) if completed is not None}
+        num_threads = threads_per_worker(workers)
+        if pending:
+            for i in pending:
+                for args in loaded[i][1]:
+                    if args.threads <= 0:
+                        args.threads = num_threads
+            build_models(loaded[pending[0]][1])
+            for model in models:
+                model.share_memory()
+
+        def evaluate(j):
+            _, args_list, data, _ = loaded[pending[j]]
+            return evaluate_models(args_list, models, shuffle_data=False, samples=data)
+
+        # report the relations in order, as soon as the previous ones are done
+        next_i = 0
+        results = run_in_workers(evaluate, len(pending), workers, num_threads)
+        while next_i < len(loaded):
+            if next_i not in done:
+                j, Precision1_list = next(results)
+                done[pending[j]] = Precision1_list
+                continue
+            relation, _, data, _ = loaded[next_i]
+            yield relation, data, done.pop(next_i)
+            next_i += 1
+        results.close()
+
+    def evaluate_one_by_one():
+        for relation, args_list, data, completed in iter_relations():
+            if completed is not None:
+                yield relation, data, completed
+                continue
+            build_models(args_list)
+            Precision1_list = evaluate_models(
+                args_list, models, shuffle_data=False, samples=data
+            )
+            yield relation, data, Precision1_list
+
+    if pool_relations:
+        evaluated_relations = evaluate_pooled()
+    elif workers > 1 and not any(ip["lm"] in ["elmo"] for ip in input_params):
+        evaluated_relations = evaluate_in_workers()
+    else:
+        evaluated_relations = evaluate_one_by_one()
+
+    for relation, data, Precision1_list in evaluated_relations:
+        num_samples = len(data)
+        for k, Precision1 in enumerate(Precision1_list):
+            print("P@1 : {}".format(Precision1), flush=True)
+            all_Precision1[k].append(Precision1)
+
+            line = "{},{}\n".format(relation["relation"], round(Precision1 * 100, 2))
+            if len(input_params) == 1:
+                results_file.write(line)
+                results_file.flush()
+            else:
+                results_lines[k].append(line)
+
+            if "type" in relation:
+                type_Precision1[k][relation["type"]].append(Precision1)
         if "type" in relation:
-            type_Precision1[relation["type"]].append(Precision1)
-            data = load_file(PARAMETERS["dataset_filename"])
-            type_count[relation["type"]].append(len(data))
+            type_count[relation["type"]].append(num_samples)
 
-    mean_p1 = statistics.mean(all_Precision1)
-    print("@@@ {} - mean P@1: {}".format(input_param["label"], mean_p1))
+    if len(input_params) > 1:
+        for input_param, lines in zip(input_params, results_lines):
+            results_file.write("=={}==\n".format(input_param["label"]))
+            results_file.writelines(lines)
+        results_file.flush()
     results_file.close()
 
-    for t, l in type_Precision1.items():
+    results = []
+    for k, input_param in enumerate(input_params):
+        mean_p1 = statistics.mean(all_Precision1[k])
+        print("@@@ {} - mean P@1: {}".format(input_param["label"], mean_p1))
 
-        print(
-            "@@@ ",
-            input_param["label"],
-            t,
-            statistics.mean(l),
-            sum(type_count[t]),
-            len(type_count[t]),
-            flush=True,
-        )
+        for t, l in type_Precision1[k].items():
+
+            print(
+                "@@@ ",
+                input_param["label"],
+                t,
+                statistics.mean(l),
+                sum(type_count[t]),
+                len(type_count[t]),
+                flush=True,
+            )
+
+        results.append((mean_p1, all_Precision1[k]))
 
-    return mean_p1, all_Precision1
+    return results
 
 
 def get_TREx_parameters(data_path_pre="data/"):
@@ -238,18 +403,55 @@ def get_Squad_parameters(data_path_pre="data/"):
     return relations, data_path_pre, data_path_post
 
 
+def group_LMs(lms):
+    # LMs of the same connector and tokenizer can be evaluated in a single pass.
+    # CoLAKE always runs on its own: its tokenizer adds a prefix space, so it
+    # doesn't encode the samples like the hfroberta LMs (KEPLER, KELM, ...).
+    groups = defaultdict(list)
+    for ip in lms:
+        groups[(tuple(ip["models_names"]), ip.get("tokenizer_dir"))].append(ip)
+    return list(groups.values())
+
+
 def run_all_LMs(parameters, cfg):
+    use_negated_probes = False  # vanilla LAMA
+    # use_negated_probes = True  # Negated-LAMA
+
+    pool_relations = getattr(cfg, "pool_relations", False)
+    workers = getattr(cfg, "workers", 1)
+    resume = getattr(cfg, "resume", False)
+    checkpoint_every = getattr(cfg, "checkpoint_every", 0)
+
+    if getattr(cfg, "share_batches", False):
+        # see group_LMs: CoLAKE is never grouped with the other LMs
+        for ips in group_LMs(LMs):
+            print(", ".join(ip["label"] for ip in ips))
+
+            run_experiments_together(*parameters,
+                                     input_params=ips,
+                                     results_file=cfg.results_file,
+                                     log_dir=cfg.log_dir,
+                                     data_path=cfg.data_path,
+                                     use_negated_probes=use_negated_probes,
+                                     pool_relations=pool_relations,
+                                     workers=workers,
+                                     resume=resume,
+                                     checkpoint_every=checkpoint_every)
+        return
+
     for ip in LMs:
         print(ip["label"])
 
-        use_negated_probes = False  # vanilla LAMA
-        # use_negated_probes = True  # Negated-LAMA
         run_experiments(*parameters,
                         input_param=ip,
                         results_file=cfg.results_file,
                         log_dir=cfg.log_dir,
                         data_path=cfg.data_path,
-                        use_negated_probes=use_negated_probes)
+                        use_negated_probes=use_negated_probes,
+                        pool_relations=pool_relations,
+                        workers=workers,
+                        resume=resume,
+                        checkpoint_every=checkpoint_every)
 
 
 def run_lama(cfg):
@@ -0,0 +1,215 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import threading
+
+import numpy as np
+import pytest
+import torch
+from transformers.pytorch_utils import Conv1D
+from transformers import (
+    GPT2Config, GPT2LMHeadModel, GPT2Model, LukeConfig, LukeForMaskedLM, RobertaConfig, RobertaForMaskedLM)
+from lama.modules.base_connector import (
+    Base_Connector, SubsetOutputLayer, VocabSubsetIndex, _parameters_on_meta, build_pretrained,
+    collate_token_ids, from_pretrained_mmap, load_state_dict_mmap, quantize_linear_layers)
+
+
+def test_vocab_subset_index(tmp_path):
+    vocab = ["<s>", "cat", "dog", "table", "Paris"]
+    inverse_vocab = {w: i for i, w in enumerate(vocab)}
+    index = VocabSubsetIndex.from_words(
+        ["Paris", "cat", "London"], inverse_vocab, len(vocab))
+
+    assert len(index) == 2
+    assert index[0] == 4 and index[1] == 1
+    assert index.index(1) == 1
+    assert 4 in index and 2 not in index and 10 not in index
+    assert index.to_subset([4, 2, 1]).tolist() == [0, -1, 1]
+    assert index.indices.tolist() == [4, 1]
+    with pytest.raises(ValueError):
+        index.index(2)
+
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = VocabSubsetIndex.load(path)
+    assert loaded.subset_to_model.tolist() == [4, 1]
+    assert loaded.model_to_subset.tolist() == index.model_to_subset.tolist()
+
+
+def test_subset_output_layer():
+    torch.manual_seed(0)
+    output_layer = torch.nn.Linear(8, 20)
+    indices = [3, 17, 0, 9]
+    x = torch.randn(5, 8)
+    with torch.no_grad():
+        logits = output_layer(x)
+        full = SubsetOutputLayer(output_layer, indices, normalization="full")(x)
+        subset = SubsetOutputLayer(output_layer, indices, normalization="subset")(x)
+
+    # normalized over the full vocabulary, then gathered on the subset
+    assert torch.allclose(full, torch.log_softmax(logits, dim=-1)[:, indices], atol=1e-6)
+    # normalized over the subset rows only
+    assert torch.allclose(subset, torch.log_softmax(logits[:, indices], dim=-1), atol=1e-6)
+    assert torch.allclose(subset.exp().sum(dim=-1), torch.ones(5))
+    with pytest.raises(ValueError):
+        SubsetOutputLayer(output_layer, indices, normalization="other")
+
+
+class WordConnector(Base_Connector):
+
+    def __init__(self, vocab):
+        super().__init__()
+        self.vocab = vocab
+        self._init_inverse_vocab()
+        self.tokenized = []
+
+    def get_id(self, string):
+        return [self.inverse_vocab.get(word, 0) for word in string.split()]
+
+    def get_ids(self, strings):
+        self.tokenized.append(list(strings))
+        return super().get_ids(strings)
+
+
+def test_get_label_table():
+    model = WordConnector(["<unk>", "Paris", "New", "York", "Rome"])
+    subset = VocabSubsetIndex.from_words(["Paris", "New", "York"], model.inverse_vocab, len(model.vocab))
+
+    table = model.get_label_table(["Paris", "New York", "Berlin", "Paris", "Rome"], vocab_subset=subset)
+    assert table["Paris"] == ([1], True, True, True)
+    assert table["New York"].token_ids == [2, 3]
+    assert table["New York"].in_vocab and not table["New York"].single_token
+    assert not table["Berlin"].in_vocab and not table["Berlin"].in_subset
+    assert table["Rome"].single_token and not table["Rome"].in_subset
+    assert model.get_label_table(["Rome"])["Rome"].in_subset is None
+
+    # every distinct label is tokenized once, in a single get_ids call
+    model.get_label_table(["Paris", "Rome", "York"])
+    assert [sorted(strings) for strings in model.tokenized] == [
+        ["Berlin", "New York", "Paris", "Rome"], ["York"]]
+
+
+def test_collate_token_ids():
+    encodings = [
+        ([0, 5, 6, 2], [0, 0, 0, 0], [1]),
+        (np.array([0, 7, 2], dtype=np.int32), np.zeros(3, dtype=np.int8), np.array([2])),
+        ([0, 8, 9, 10, 2], [0, 0, 0, 1, 1], []),
+    ]
+    input_ids, token_type_ids, attention_mask, masked_indices_list = collate_token_ids(
+        encodings, pad_id=1, share_memory=True)
+
+    assert input_ids.tolist() == [[0, 5, 6, 2, 1], [0, 7, 2, 1, 1], [0, 8, 9, 10, 2]]
+    assert token_type_ids.tolist() == [[0, 0, 0, 0, 0], [0, 0, 0, 0, 0], [0, 0, 0, 1, 1]]
+    assert attention_mask.sum(dim=1).tolist() == [4, 3, 5]
+    assert masked_indices_list == [[1], [2], []]
+    assert input_ids.is_shared()
+
+
+def test_quantize_linear_layers():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(16, 32), Conv1D(32, 32), torch.nn.Linear(32, 8))
+    x = torch.randn(4, 16)
+    expected = model(x)
+
+    output_layer = model[2]
+    quantize_linear_layers(model, exclude=[output_layer])
+    assert "quantized" in type(model[0]).__module__
+    # Conv1D is turned into a linear layer before the quantization
+    assert "quantized" in type(model[1]).__module__
+    assert model[2] is output_layer
+    assert torch.allclose(model(x), expected, atol=0.05)
+
+
+def test_from_pretrained_mmap(tmp_path):
+    torch.manual_seed(0)
+    config = RobertaConfig(
+        vocab_size=50, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=40, pad_token_id=1)
+    RobertaForMaskedLM(config).save_pretrained(str(tmp_path))
+    expected = RobertaForMaskedLM.from_pretrained(str(tmp_path)).eval()
+
+    model = from_pretrained_mmap(RobertaForMaskedLM, str(tmp_path))
+    assert not model.training
+    # the output projection is still tied to the embeddings
+    assert model.lm_head.decoder.weight is model.roberta.embeddings.word_embeddings.weight
+    input_ids = torch.tensor([[0, 5, 6, 7, 2]])
+    with torch.no_grad():
+        assert torch.equal(model(input_ids)[0], expected(input_ids)[0])
+
+    # a checkpoint missing weights is not loaded without their init
+    state_dict = expected.state_dict()
+    del state_dict["lm_head.dense.weight"]
+    assert build_pretrained(RobertaForMaskedLM, config, state_dict) is None
+
+
+def test_from_pretrained_mmap_hub_checkpoints(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    input_ids = torch.tensor([[0, 5, 6, 7, 2]])
+
+    # the hub GPT-2 checkpoint holds the weights of GPT2Model (no "transformer." prefix)
+    gpt2_path = str(tmp_path / "gpt2")
+    GPT2Model(GPT2Config(vocab_size=50, n_positions=20, n_embd=16, n_layer=2, n_head=2)).save_pretrained(gpt2_path)
+    # LUKE checkpoints have no entity prediction head
+    luke_path = str(tmp_path / "luke")
+    luke = LukeForMaskedLM(LukeConfig(
+        vocab_size=50, entity_vocab_size=10, hidden_size=16, entity_emb_size=8, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=32, max_position_embeddings=40, pad_token_id=1))
+    luke.save_pretrained(luke_path, state_dict={
+        key: tensor for key, tensor in luke.state_dict().items() if not key.startswith("entity_predictions.")})
+
+    for model_class, path in [(GPT2LMHeadModel, gpt2_path), (LukeForMaskedLM, luke_path)]:
+        expected = model_class.from_pretrained(path).eval()
+        with monkeypatch.context() as m:
+            # the weights are memory-mapped, without falling back to from_pretrained
+            m.setattr(model_class, "from_pretrained", None)
+            model = from_pretrained_mmap(model_class, path)
+        assert not any(param.is_meta for param in model.parameters())
+        with torch.no_grad():
+            assert torch.equal(model(input_ids).logits, expected(input_ids).logits)
+
+
+def test_build_pretrained_from_mmap_state_dict(tmp_path):
+    # a raw state dict, like the CoLAKE checkpoint
+    torch.manual_seed(0)
+    config = RobertaConfig(
+        vocab_size=50, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=40, pad_token_id=1, type_vocab_size=3)
+    expected = RobertaForMaskedLM(config).eval()
+    input_ids = torch.tensor([[0, 5, 6, 7, 2]])
+    token_type_ids = torch.tensor([[0, 1, 2, 1, 0]])
+    with torch.no_grad():
+        expected_log_probs = expected(input_ids, token_type_ids=token_type_ids)[0]
+
+    for name, legacy in [("model.bin", False), ("legacy.bin", True)]:
+        path = str(tmp_path / name)
+        torch.save(expected.state_dict(), path, _use_new_zipfile_serialization=not legacy)
+        state_dict = load_state_dict_mmap(path)
+        weight = state_dict["roberta.encoder.layer.0.attention.self.query.weight"]
+        model = build_pretrained(RobertaForMaskedLM, config, state_dict)
+        # the weights are the loaded tensors, not copies
+        assert model.roberta.encoder.layer[0].attention.self.query.weight.data_ptr() == weight.data_ptr()
+        with torch.no_grad():
+            assert torch.equal(model(input_ids, token_type_ids=token_type_ids)[0], expected_log_probs)
+
+
+def test_parameters_on_meta_only_in_calling_thread():
+    built = threading.Event()
+    other = {}
+
+    def build_other():
+        other["linear"] = torch.nn.Linear(2, 2)
+        built.set()
+
+    with _parameters_on_meta():
+        linear = torch.nn.Linear(2, 2)
+        thread = threading.Thread(target=build_other)
+        thread.start()
+        assert built.wait(10)
+    thread.join()
+
+    assert linear.weight.is_meta and linear.bias.is_meta
+    assert not other["linear"].weight.is_meta
+    assert not torch.nn.Linear(2, 2).weight.is_meta
@@ -0,0 +1,96 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import argparse
+import json
+
+import pytest
+import torch
+import lama.options as options
+import scripts.batch_eval_KB_completion as batch_eval
+
+
+def test_load_samples_normalizes_trex_evidences(tmp_path):
+    path = str(tmp_path / "P19.jsonl")
+    samples = [
+        {"sub_label": "Dante", "obj_label": "Florence", "masked_sentences": ["Dante was born in [MASK] ."]},
+        {"sub_label": "Raphael", "obj_label": "Urbino", "evidences": [
+            {"masked_sentence": "Raphael was born in [MASK] ."},
+            {"masked_sentence": "[MASK] is the birthplace of Raphael ."},
+        ]},
+    ]
+    with open(path, "w") as f:
+        for sample in samples:
+            f.write(json.dumps(sample) + "\n")
+        # blank lines are skipped
+        f.write("\n")
+
+    assert batch_eval.load_file(path) == samples
+    loaded = batch_eval.load_samples(path)
+    assert [sample["obj_label"] for sample in loaded] == ["Florence", "Urbino"]
+    assert loaded[0]["masked_sentences"] == ["Dante was born in [MASK] ."]
+    assert loaded[1]["masked_sentences"] == [
+        "Raphael was born in [MASK] .", "[MASK] is the birthplace of Raphael ."]
+
+
+def test_batchify_indices_under_a_token_budget():
+    lengths = [5, 2, 9, 2, 4, 30, 3]
+    batches = batch_eval.batchify_indices(lengths, max_tokens=12)
+    # sorted by length, every batch padded to its longest sample fits the budget
+    assert batches == [[1, 3, 6], [4, 0], [2], [5]]
+    assert sorted(k for batch in batches for k in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or max(lengths[k] for k in batch) * len(batch) <= 12
+
+    assert batch_eval.batchify_indices(lengths, batch_size=3) == [[1, 3, 6], [4, 0, 2], [5]]
+
+    samples = [{"masked_sentences": ["s{}".format(k)]} for k in range(len(lengths))]
+    samples_batches, sentences_batches, _ = batch_eval.batchify_by_tokens(samples, 12, lengths)
+    assert [len(batch) for batch in samples_batches] == [3, 2, 1, 1]
+    assert sentences_batches[1] == [["s4"], ["s0"]]
+
+
+def test_split_batch_by_relation():
+    log_probs = torch.arange(12, dtype=torch.float).view(4, 3)
+    batch = dict(
+        relations=[1, 0, 1, 0],
+        samples=[{"uuid": k} for k in range(4)],
+        sentences_negated=[["not {}".format(k)] if k < 3 else [""] for k in range(4)],
+        has_negated=True,
+    )
+    batch["outputs"] = [dict(
+        log_probs=(log_probs, log_probs, [[k] for k in range(4)], [[0]] * 4),
+        log_probs_negated=(-log_probs, -log_probs, [[k] for k in range(4)], [[0]] * 4),
+    )]
+
+    relation_batches = batch_eval.split_batch_by_relation(batch)
+    assert list(relation_batches) == [1, 0]
+    relation_batch, [outputs] = relation_batches[0]
+    assert [sample["uuid"] for sample in relation_batch["samples"]] == [1, 3]
+    assert relation_batch["has_negated"]
+    original, filtered, token_ids, _ = outputs["log_probs"]
+    assert original.tolist() == [[3.0, 4.0, 5.0], [9.0, 10.0, 11.0]]
+    assert filtered is original and token_ids == [[1], [3]]
+    assert outputs["log_probs_negated"][0].tolist() == (-original).tolist()
+
+    # a batch from a single relation is used as it is
+    batch["relations"] = [2] * 4
+    assert batch_eval.split_batch_by_relation(batch) == {2: (batch, batch["outputs"])}
+
+
+def test_result_columns_without_top_predictions():
+    log_probs = torch.log_softmax(torch.tensor([[0.1, 2.0, 0.5], [3.0, 1.0, 2.0]]), dim=-1)
+    results = batch_eval.run_batch(log_probs, [[0], [0]], [[1], [2]], ["a", "b", "c"], topk=0)
+    elements = [
+        dict(uuid=k, masked_topk=experiment_result, label_index=[k + 1], sample_MRR=sample_MRR)
+        for k, (experiment_result, sample_MRR, _, _, _) in enumerate(results)
+    ]
+    columns = batch_eval.result_columns(elements)
+    assert columns["ranks"] == [1, 2]
+    assert columns["topk_ids"] == [[], []] and columns["topk_log_probs"] == [[], []]
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        options.positive_int("0")
@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import torch
+from transformers import RobertaConfig, RobertaModel
+from lama.modules.compiled_encoder import BucketedEncoder, batch_bucket_size, bucket_size
+
+
+def test_bucket_sizes():
+    assert bucket_size(5, (8, 16)) == 8
+    assert bucket_size(16, (8, 16)) == 16
+    assert bucket_size(17, (8, 16)) is None
+    assert [batch_bucket_size(n) for n in (1, 3, 8, 9)] == [1, 4, 8, 16]
+
+
+def test_bucketed_encoder_matches_eager():
+    torch.manual_seed(0)
+    config = RobertaConfig(
+        vocab_size=50, hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=40, pad_token_id=1)
+    model = RobertaModel(config).eval()
+    encoder = BucketedEncoder(model, backend="trace", length_buckets=(8, 16), pad_id=1)
+
+    input_ids = torch.tensor([[0, 5, 6, 7, 2], [0, 8, 2, 1, 1], [0, 9, 10, 11, 2]])
+    token_type_ids = torch.zeros_like(input_ids)
+    attention_mask = (input_ids != 1).long()
+    with torch.no_grad():
+        expected = model(input_ids=input_ids, token_type_ids=token_type_ids,
+                         attention_mask=attention_mask)[0]
+    hidden_states = encoder(input_ids, token_type_ids, attention_mask)
+
+    assert hidden_states.shape == expected.shape
+    assert torch.allclose(hidden_states, expected, atol=1e-5)
+    # compiled once for the (4, 8) bucket, then reused
+    assert list(encoder.compiled) == [(4, 8)]
+    encoder(input_ids[:2], token_type_ids[:2], attention_mask[:2])
+    assert list(encoder.compiled) == [(4, 8), (2, 8)]
+
+    # longer than the largest bucket: eager
+    long_ids = torch.randint(3, 50, (1, 20))
+    ones = torch.ones_like(long_ids)
+    with torch.no_grad():
+        assert torch.allclose(
+            encoder(long_ids, torch.zeros_like(long_ids), ones),
+            model(input_ids=long_ids, attention_mask=ones)[0], atol=1e-5)
+    assert len(encoder.compiled) == 2
+
+    # warm up: every batch bucket up to the batch size, for every length bucket
+    encoder.reset()
+    encoder.warm_up(3)
+    assert sorted(encoder.compiled) == [(b, n) for b in (1, 2, 4) for n in (8, 16)]
@@ -0,0 +1,68 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import torch
+import lama.evaluation_metrics as metrics
+
+
+def test_get_ranking_batch_matches_get_ranking():
+    torch.manual_seed(0)
+    vocab = ["w{}".format(i) for i in range(50)]
+    log_probs = torch.log_softmax(torch.randn(4, 6, len(vocab)), dim=-1)
+    masked_indices_list = [[1], [3, 4], [0], [5]]
+    label_indices = [7, 0, 49, 12]
+
+    ranking = metrics.get_ranking_batch(
+        log_probs, masked_indices_list, label_indices, topk=5)
+    results = metrics.get_ranking_results(ranking, vocab)
+
+    for i in range(4):
+        MRR, P_AT_X, experiment_result, _ = metrics.get_ranking(
+            log_probs[i], masked_indices_list[i], vocab,
+            label_index=label_indices[i], topk=len(vocab), print_generation=False)
+        batch_MRR, batch_P_AT_X, batch_result, _ = results[i]
+        assert abs(MRR - batch_MRR) < 1e-9
+        assert P_AT_X == batch_P_AT_X
+        assert experiment_result["P_AT_1"] == batch_result["P_AT_1"]
+        assert abs(experiment_result["PERPLEXITY"] - batch_result["PERPLEXITY"]) < 1e-6
+        assert experiment_result["topk"][:5] == batch_result["topk"]
+
+
+def test_get_ranking_batch_masked_only_rows():
+    log_probs = torch.log_softmax(torch.tensor([[0.1, 2.0, 0.5], [3.0, 1.0, 2.0]]), dim=-1)
+    ranking = metrics.get_ranking_batch(log_probs, [[2], [1]], [2, 0])
+    assert ranking["rank"].tolist() == [2, 1]
+    assert ranking["P_AT_1"].tolist() == [0.0, 1.0]
+    assert "topk_indices" not in ranking
+
+
+def test_average_ranks_match_rankdata():
+    values = torch.tensor([[0.5, 0.1, 0.5, 0.3, 0.5], [2.0, 2.0, 1.0, 1.0, 3.0]])
+    assert metrics.average_ranks(values).tolist() == [
+        [4.0, 1.0, 4.0, 2.0, 4.0], [3.5, 3.5, 1.5, 1.5, 5.0]]
+
+
+def test_get_negation_metrics_batch_matches_get_negation_metric():
+    torch.manual_seed(0)
+    log_probs = torch.log_softmax(torch.randn(4, 6, 200), dim=-1)
+    log_probs_negated = torch.log_softmax(log_probs + torch.randn(4, 6, 200), dim=-1)
+    # many ties
+    log_probs_negated[3] = torch.round(log_probs_negated[3] * 2) / 2
+    masked_indices_list = [[1], [3, 4], [0], [5]]
+    masked_indices_negated_list = [[1], [2], [], [0]]
+
+    overlap, spearman = metrics.get_negation_metrics_batch(
+        log_probs, masked_indices_list, log_probs_negated, masked_indices_negated_list)
+
+    for i in range(4):
+        sample_overlap, sample_spearman, _ = metrics.get_negation_metric(
+            log_probs[i], masked_indices_list[i], log_probs_negated[i],
+            masked_indices_negated_list[i], vocab=None)
+        if masked_indices_negated_list[i]:
+            assert overlap[i] == sample_overlap
+            assert abs(spearman[i] - sample_spearman) < 1e-9
+        else:
+            assert overlap[i] != overlap[i] and spearman[i] != spearman[i]
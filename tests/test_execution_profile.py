@@ -0,0 +1,24 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import argparse
+import multiprocessing
+
+import lama.execution_profile as execution_profile
+
+
+def test_replicas_share_the_cores_only_with_per_thread_counts(monkeypatch):
+    args = argparse.Namespace(threads=2, intra_op_threads=0, inter_op_threads=0, replicas=2)
+
+    monkeypatch.setattr(execution_profile, "per_thread_intra_op_threads", lambda: True)
+    profile = execution_profile.execution_profile(args)
+    assert profile.intra_op_threads == max(1, multiprocessing.cpu_count() // 2)
+    assert profile.metric_workers == 2 and profile.replicas == 2
+
+    monkeypatch.setattr(execution_profile, "per_thread_intra_op_threads", lambda: False)
+    assert execution_profile.execution_profile(args).intra_op_threads is None
+    args.intra_op_threads = 3
+    assert execution_profile.execution_profile(args).intra_op_threads == 3
@@ -0,0 +1,41 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import gzip
+import logging
+import lama.log_handlers as log_handlers
+
+
+def test_queue_listener_writes_on_detach(tmp_path):
+    logger = logging.getLogger("test_log_handlers")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    path = tmp_path / "info.log"
+    log_handlers.attach_queue_listener(logger, [logging.FileHandler(str(path))])
+    for i in range(100):
+        logger.info("line %d", i)
+    logger.debug("not written")
+    log_handlers.detach_queue_listener(logger)
+
+    lines = path.read_text().splitlines()
+    assert lines == ["line {}".format(i) for i in range(100)]
+    assert not logger.handlers
+
+
+def test_compressed_rotation(tmp_path):
+    path = tmp_path / "info.log"
+    handler = log_handlers.CompressedRotatingFileHandler(str(path), max_bytes=100, backup_count=2)
+    logger = logging.getLogger("test_log_rotation")
+    logger.propagate = False
+    logger.addHandler(handler)
+    for i in range(50):
+        logger.warning("x" * 20)
+    handler.close()
+    logger.removeHandler(handler)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["info.log", "info.log.1.gz", "info.log.2.gz"]
+    with gzip.open(str(tmp_path / "info.log.1.gz"), "rt") as f:
+        assert f.read().startswith("x" * 20)
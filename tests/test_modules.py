@@ -0,0 +1,32 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import subprocess
+import sys
+
+import pytest
+import lama.modules as modules
+
+
+def test_connectors_are_imported_lazily():
+    # a fresh interpreter: the tests may have imported transformers already
+    code = (
+        "import sys, lama.modules.base_connector, lama.modules; "
+        "print('transformers' in sys.modules, 'lama.modules.hfroberta_connector' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    assert output.split() == ["False", "False"]
+
+
+def test_get_connector_class():
+    assert modules.get_connector_class("hfroberta").__name__ == "HfRoberta"
+    assert modules.HfRoberta is modules.get_connector_class("hfroberta")
+    with pytest.raises(ValueError):
+        modules.get_connector_class("bert-large")
+    with pytest.raises(AttributeError):
+        modules.Bert
@@ -0,0 +1,45 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import random
+import threading
+import time
+
+import pytest
+from lama.pipeline import run_stages
+
+
+def test_run_stages_keeps_order():
+    stages = [lambda x: x + 1, lambda x: x * 2, str]
+    expected = [str((i + 1) * 2) for i in range(20)]
+    assert list(run_stages(range(20), stages, pipelined=False)) == expected
+    assert list(run_stages(range(20), stages, pipelined=True, queue_size=1)) == expected
+
+
+def test_run_stages_raises_stage_errors():
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    outputs = []
+    with pytest.raises(ValueError, match="bad item"):
+        for x in run_stages(range(10), [fail_on_3, lambda x: x], queue_size=1):
+            outputs.append(x)
+    assert outputs == [0, 1, 2]
+
+
+def test_run_stages_with_several_workers():
+    seen_threads = set()
+
+    def slow_square(x):
+        seen_threads.add(threading.get_ident())
+        time.sleep(random.random() * 0.01)
+        return x * x
+
+    outputs = list(run_stages(range(30), [slow_square, lambda x: x + 1], queue_size=2, workers=[3, 1]))
+    assert outputs == [x * x + 1 for x in range(30)]
+    assert len(seen_threads) > 1
@@ -0,0 +1,123 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import threading
+
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector
+from lama.probe_server import ProbeServer, make_http_server, request_probe
+
+
+class WordCountConnector(Base_Connector):
+    # scores every word of the vocabulary by its count in the sample
+
+    def __init__(self):
+        super().__init__()
+        self.vocab = ["[MASK]", "is", "Paris", "France", "Rome", "Italy"]
+        self._init_inverse_vocab()
+        self.batch_sizes = []
+
+    def get_id(self, string):
+        return [self.inverse_vocab[string]] if string in self.inverse_vocab else []
+
+    def encode_sentences(self, sentences):
+        return " ".join(sentences).split()
+
+    def get_batch_generation_from_ids(self, encodings, logger=None, try_cuda=True, masked_only=False):
+        self.batch_sizes.append(len(encodings))
+        counts = torch.tensor(
+            [[float(words.count(word)) for word in self.vocab] for words in encodings])
+        return torch.log_softmax(counts, dim=-1), None, None
+
+
+def test_probe_ranks_labels():
+    server = ProbeServer({"count": WordCountConnector()}, topk=2, vocab_subset_cache_size=2)
+    response = server.probe({
+        "sentences": ["France France Paris [MASK]", ["Rome is in [MASK] .", "Italy Italy"]],
+        "labels": ["France", "Berlin"],
+    })
+    assert [p["token"] for p in response["predictions"][0]] == ["France", "Paris"]
+    assert response["predictions"][1][0]["token"] == "Italy"
+    assert response["ranks"] == [1, None]
+    assert response["metrics"] == {"num_ranked": 1, "P_AT_1": 1.0, "P_AT_10": 1.0, "MRR": 1.0}
+
+    response = server.probe({
+        "sentences": ["France Paris Paris [MASK]"],
+        "labels": ["France"],
+        "vocab_subset": ["Rome", "France"],
+    })
+    assert [p["token"] for p in response["predictions"][0]] == ["France", "Rome"]
+    assert response["ranks"] == [1]
+
+    # only the most recent vocab subsets stay indexed
+    model = server.models["count"]
+    for vocab_subset in [["Paris", "Rome"], ["Italy", "France"], ["Rome", "France"]]:
+        server.probe({"sentences": ["[MASK]"], "vocab_subset": vocab_subset})
+    assert len(model._vocab_subset_indices) == 2
+
+    with pytest.raises(ValueError):
+        server.probe({"sentences": ["no mask"]})
+    with pytest.raises(ValueError):
+        server.probe({"model": "other", "sentences": ["[MASK]"]})
+    for malformed in [
+        {"sentences": ["[MASK]"], "labels": [3]},
+        {"sentences": ["[MASK]"], "labels": "Paris"},
+        {"sentences": ["[MASK]"], "topk": -1},
+        {"sentences": ["[MASK]"], "topk": "10"},
+        {"sentences": ["[MASK]"], "vocab_subset": "Paris"},
+        {"sentences": [["[MASK]", 3]]},
+        {"sentences": [3]},
+    ]:
+        with pytest.raises(ValueError):
+            server.probe(malformed)
+    server.close()
+
+
+def test_concurrent_probes_are_coalesced():
+    model = WordCountConnector()
+    server = ProbeServer({"count": model}, max_batch_size=4, max_wait=0.2)
+    words = ["Paris", "France", "Rome", "Italy"] * 2
+    responses = [None] * len(words)
+
+    def probe(i):
+        responses[i] = server.probe({"sentences": ["{0} {0} [MASK]".format(words[i])]})
+
+    threads = [threading.Thread(target=probe, args=(i,)) for i in range(len(words))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.close()
+
+    assert [r["predictions"][0][0]["token"] for r in responses] == words
+    assert sum(model.batch_sizes) == len(words)
+    assert max(model.batch_sizes) <= 4
+    assert len(model.batch_sizes) < len(words)
+
+
+def test_http_server_on_unix_socket(tmp_path):
+    socket_path = str(tmp_path / "probe.sock")
+    probe_server = ProbeServer({"count": WordCountConnector()})
+    http_server = make_http_server(probe_server, socket_path=socket_path)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        models = request_probe(path="/models", socket_path=socket_path)
+        assert models["models"]["count"]["vocab_size"] == 6
+        response = request_probe(
+            {"sentences": ["Rome Rome [MASK]"], "labels": ["Rome"], "topk": 1},
+            socket_path=socket_path)
+        assert response["predictions"][0][0]["token"] == "Rome"
+        assert response["ranks"] == [1]
+        with pytest.raises(RuntimeError, match="400"):
+            request_probe({"sentences": []}, socket_path=socket_path)
+        with pytest.raises(RuntimeError, match="400"):
+            request_probe({"sentences": ["[MASK]"], "topk": -1}, socket_path=socket_path)
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+        probe_server.close()
@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import numpy as np
+import pytest
+from lama.modules.base_connector import ObjectLabel
+import lama.probe_shards as probe_shards
+
+
+class WhitespaceModel():
+    # encodes every word with its length, [MASK] with 0
+
+    def __init__(self):
+        self.calls = 0
+
+    def tokenizer_signature(self):
+        return "whitespace"
+
+    def encode_sentences(self, sentences):
+        self.calls += 1
+        words = " ".join(sentences).split()
+        token_ids = [0 if w == "[MASK]" else len(w) for w in words]
+        masked_indices = [i for i, w in enumerate(words) if w == "[MASK]"]
+        return token_ids, [0] * len(token_ids), masked_indices
+
+
+def test_probe_shard_round_trip(tmp_path):
+    relation = tmp_path / "P19.jsonl"
+    relation.write_text("{}\n")
+    samples = [
+        {"uuid": "a", "obj_label": "Paris", "masked_sentences": ["born in [MASK] ."]},
+        {"uuid": "b", "obj_label": "New York", "masked_sentences": ["[MASK] is", "big [MASK]"]},
+    ]
+    label_table = {
+        "Paris": ObjectLabel([7], True, True, True),
+        "New York": ObjectLabel([3, 4], True, False, None),
+    }
+    model = WhitespaceModel()
+    key = probe_shards.shard_key(model, str(relation), template="", lowercase=False)
+    assert key != probe_shards.shard_key(model, str(relation), template="[X] [Y]")
+    assert probe_shards.shard_key(model, str(tmp_path / "missing.jsonl")) is None
+
+    shard_dir = str(tmp_path / "shards")
+    shard = probe_shards.load_or_compile_shard(shard_dir, key, model, samples, label_table)
+    assert model.calls == 2
+    assert len(shard) == 2
+    assert shard.label_ids.tolist() == [7, -1]
+
+    # the second run memory-maps the shard without encoding anything
+    shard = probe_shards.load_or_compile_shard(shard_dir, key, model, samples, label_table)
+    assert model.calls == 2
+    assert isinstance(shard.token_ids, np.memmap)
+    assert shard.encodings(samples[::-1]) == [
+        model.encode_sentences(sample["masked_sentences"]) for sample in samples[::-1]
+    ]
+
+
+def test_probe_shard_segment_ids(tmp_path):
+    samples = [{"uuid": "a", "obj_label": "Paris", "masked_sentences": ["born in [MASK] ."]}]
+    model = WhitespaceModel()
+    for segment_id in [200, 1000]:
+        model.encode_sentences = lambda sentences: ([1, 2, 0, 3], [0, 1, segment_id, 2], [2])
+        shard = probe_shards.ProbeShard.from_samples(model, samples)
+        assert shard.encodings(samples) == [([1, 2, 0, 3], [0, 1, segment_id, 2], [2])]
+
+    model.encode_sentences = lambda sentences: ([1], [1 << 16], [0])
+    with pytest.raises(ValueError):
+        probe_shards.ProbeShard.from_samples(model, samples)
@@ -0,0 +1,31 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import pytest
+from lama.process_pool import run_in_workers
+
+
+def test_run_in_workers_returns_every_item():
+    weights = list(range(10))
+
+    def square(i):
+        return weights[i] * weights[i], os.getpid()
+
+    results = dict(run_in_workers(square, 10, num_workers=2, num_threads=1))
+    assert sorted(results) == list(range(10))
+    assert [results[i][0] for i in range(10)] == [i * i for i in range(10)]
+    assert os.getpid() not in {pid for _, pid in results.values()}
+
+
+def test_run_in_workers_raises_worker_errors():
+    def fail_on_3(i):
+        if i == 3:
+            raise ValueError("bad item")
+        return i
+
+    with pytest.raises(RuntimeError, match="bad item"):
+        list(run_in_workers(fail_on_3, 5, num_workers=2, num_threads=1))
@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import numpy as np
+from lama.result_store import ResultWriter, load_results
+
+
+def test_result_columns_round_trip(tmp_path):
+    path = str(tmp_path / "results")
+    writer = ResultWriter(path, topk=3)
+    for uuids, ranks in [(["a", "b"], [1, 4]), ([7], [0])]:
+        writer.append(
+            uuids,
+            label_ids=[10] * len(uuids),
+            ranks=ranks,
+            label_log_probs=[-0.5] * len(uuids),
+            judgements=[-1] * len(uuids),
+            topk_ids=[[10, 11]] * len(uuids),
+            topk_log_probs=[[-0.5, -1.0]] * len(uuids),
+        )
+    writer.close(global_P_at_1=0.5)
+
+    table = load_results(path)
+    assert len(table) == 3
+    assert table.meta["global_P_at_1"] == 0.5
+    assert isinstance(table.ranks, np.memmap)
+    assert table.topk_ids.dtype == np.int32 and table.topk_log_probs.dtype == np.float16
+    # missing predictions are padded
+    assert table.topk_ids[0].tolist() == [10, 11, -1]
+    assert np.isneginf(table.topk_log_probs[0, 2])
+    assert table.row(7)["ranks"] == 0
+    assert table.precision_at(1) == 1 / 3
+    assert table.mean_reciprocal_rank() == (1 + 1 / 4) / 3
+
+
+def test_empty_results(tmp_path):
+    path = str(tmp_path / "results")
+    writer = ResultWriter(path, topk=10)
+    writer.close()
+    table = load_results(path)
+    assert len(table) == 0
+    assert table.topk_ids.shape == (0, 10)
+    assert table.precision_at(1) == 0.0
+
+
+def test_resume_from_checkpoint(tmp_path):
+    path = str(tmp_path / "results")
+
+    def append(writer, uuids):
+        n = len(uuids)
+        writer.append(uuids, label_ids=[1] * n, ranks=[1] * n, label_log_probs=[0.0] * n,
+                      judgements=[-1] * n, topk_ids=[[1]] * n, topk_log_probs=[[0.0]] * n)
+
+    writer = ResultWriter(path, topk=1)
+    append(writer, ["a", "b"])
+    state = writer.checkpoint()
+    # rows written after the checkpoint are dropped on resume
+    append(writer, ["c"])
+    for f in list(writer.files.values()) + [writer.uuids_file]:
+        f.close()
+
+    writer = ResultWriter(path, topk=1, state=state)
+    assert writer.uuids() == ["a", "b"]
+    append(writer, ["c", "d"])
+    writer.close()
+    table = load_results(path)
+    assert table.uuids == ["a", "b", "c", "d"]
+    assert table.ranks.tolist() == [1, 1, 1, 1]
@@ -0,0 +1,105 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import json
+import os
+
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector
+import scripts.run_experiments as run_experiments
+
+
+class WordCountConnector(Base_Connector):
+    # scores every word of the vocabulary by its count in the sample
+
+    def __init__(self, crash_on=None):
+        super().__init__()
+        self.vocab = ["[MASK]", "<unk>", ".", "in", "Paris", "France", "Rome", "Italy", "Oslo", "Norway", "Bergen"]
+        self._init_inverse_vocab()
+        self.crash_on = crash_on
+        self.evaluated = []
+
+    def get_id(self, string):
+        return [self.inverse_vocab.get(word, 1) for word in string.split()]
+
+    def encode_sentences(self, sentences):
+        words = " ".join(sentences).split()
+        token_ids = [self.inverse_vocab.get(word, 1) for word in words]
+        masked_indices = [i for i, word in enumerate(words) if word == "[MASK]"]
+        return token_ids, [0] * len(token_ids), masked_indices
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True, masked_only=False):
+        encodings = [self.encode_sentences(sentences) for sentences in sentences_list]
+        return self.get_batch_generation_from_ids(encodings, masked_only=masked_only)
+
+    def get_batch_generation_from_ids(self, encodings, logger=None, try_cuda=True, masked_only=False):
+        for token_ids, _, _ in encodings:
+            if self.crash_on in token_ids:
+                raise KeyboardInterrupt()
+            self.evaluated.append(token_ids)
+        counts = torch.tensor(
+            [[float(token_ids.count(i)) for i in range(len(self.vocab))] for token_ids, _, _ in encodings])
+        log_probs = torch.log_softmax(counts, dim=-1)
+        if not masked_only:
+            length = max(len(token_ids) for token_ids, _, _ in encodings)
+            log_probs = log_probs.unsqueeze(1).expand(-1, length, -1)
+        return log_probs, [token_ids for token_ids, _, _ in encodings], [m for _, _, m in encodings]
+
+
+RELATIONS = {
+    "capital": [("France", "Paris"), ("Italy", "Italy"), ("Norway", "Oslo")],
+    "country": [("Paris", "Paris"), ("Rome", "Italy"), ("Oslo", "Oslo")],
+    "located": [("Oslo", "Oslo"), ("Bergen", "Norway"), ("Rome", "Rome")],
+}
+
+
+def run(tmp_path, monkeypatch, log_dir, model, resume=False, checkpoint_every=0):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir(exist_ok=True)
+    for relation, pairs in RELATIONS.items():
+        with open(str(data_dir / (relation + ".jsonl")), "w") as f:
+            for k, (sub_label, obj_label) in enumerate(pairs):
+                # the subject repeated in the sample wins the ranking
+                f.write(json.dumps({
+                    "uuid": "{}-{}".format(relation, k),
+                    "sub_label": sub_label,
+                    "obj_label": obj_label,
+                    "masked_sentences": ["{0} {0} in [MASK] .".format(sub_label)],
+                }) + "\n")
+    input_param = {"lm": "count", "label": "count", "models_names": ["count"], "batch_size": 1}
+    monkeypatch.setattr(run_experiments, "build_model_by_name", lambda name, args: model)
+    return run_experiments.run_experiments(
+        [{"relation": relation} for relation in RELATIONS],
+        str(data_dir) + os.sep,
+        ".jsonl",
+        input_param,
+        results_file=str(tmp_path / "results.csv"),
+        log_dir=str(tmp_path / log_dir),
+        data_path=str(tmp_path),
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+    )
+
+
+@pytest.mark.parametrize("checkpoint_every", [0, 1])
+def test_resume_skips_the_completed_relations(tmp_path, monkeypatch, checkpoint_every):
+    expected = run(tmp_path, monkeypatch, "uninterrupted", WordCountConnector())
+    assert [round(p, 6) for p in expected[1]] == [round(1 / 3, 6), round(2 / 3, 6), round(2 / 3, 6)]
+
+    # interrupted on the second sample of the third relation
+    crashing = WordCountConnector(crash_on=WordCountConnector().inverse_vocab["Bergen"])
+    with pytest.raises(KeyboardInterrupt):
+        run(tmp_path, monkeypatch, "resumed", crashing, resume=True, checkpoint_every=checkpoint_every)
+    assert len(crashing.evaluated) == 7
+
+    model = WordCountConnector()
+    resumed = run(tmp_path, monkeypatch, "resumed", model, resume=True, checkpoint_every=checkpoint_every)
+    assert resumed == expected
+    # only the interrupted relation is evaluated again, from its checkpoint
+    # if there is one
+    assert len(model.evaluated) == (2 if checkpoint_every else 3)
+    assert os.path.exists(str(tmp_path / "resumed" / "count" / "located" / "summary.json"))